@@ -7,6 +7,8 @@ import shutil
 import socket
 import threading
 import subprocess
+import queue
+import time
 from urllib.parse import urlparse, parse_qs
 
 # Import local utils
@@ -19,6 +21,9 @@ from utils import send_json, recv_json
 
 LOBBY_PORT = 10192
 LOBBY_HOST = 'linux1.cs.nycu.edu.tw'
+REQUEST_TIMEOUT = 60 # Seconds; generous because download_game ships whole games
+HEARTBEAT_INTERVAL = 10 # Seconds between pings; the lobby drops connections silent for 30s
+HEARTBEAT_TIMEOUT = 10 # A ping unanswered this long means the lobby is hung: reconnect
 
 WEB_DIR = os.path.join(os.path.dirname(__file__), 'web')
 DOWNLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../downloads'))
@@ -26,77 +31,166 @@ DOWNLOAD_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../downl
 # Global State
 session = {"id": None, "token": None}
 
+class EventHub:
+    """Fan-out of lobby push events to local subscribers (one queue per browser stream)."""
+    def __init__(self):
+        self.subscribers = []
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=100)
+        with self.lock:
+            self.subscribers.append(q)
+        return q
+
+    def unsubscribe(self, q):
+        with self.lock:
+            if q in self.subscribers:
+                self.subscribers.remove(q)
+
+    def publish(self, event):
+        with self.lock:
+            subs = list(self.subscribers)
+        for q in subs:
+            try:
+                q.put_nowait(event)
+            except queue.Full:
+                pass # Slow browser tab, drop rather than block the lobby connection
+
+events = EventHub()
+
+class PendingRequest:
+    def __init__(self, sock):
+        self.sock = sock
+        self.done = threading.Event()
+        self.response = None # Stays None if the connection drops first
+
 class LobbyConnection:
+    """
+    One multiplexed connection to the lobby. Requests are tagged with a req_id and
+    pipelined; a reader thread matches responses to waiting callers and hands push
+    events to the EventHub, so a slow download no longer blocks room actions.
+    """
     def __init__(self):
         self.sock = None
-        self.lock = threading.Lock()
+        self.lock = threading.Lock()          # Serializes connect/session restore
+        self.state_lock = threading.Lock()    # Guards sock + pending table
+        self.send_lock = threading.Lock()
+        self.pending = {} # {req_id: PendingRequest}
+        self.next_id = 0
+        threading.Thread(target=self._supervise, daemon=True).start()
 
     def connect(self):
         if self.sock: return True
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.sock.connect((LOBBY_HOST, LOBBY_PORT))
-            self.file = self.sock.makefile('r', encoding='utf-8')
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((LOBBY_HOST, LOBBY_PORT))
+            with self.state_lock:
+                self.sock = sock
+            threading.Thread(target=self._reader, args=(sock,), daemon=True).start()
             print("[LobbyConn] Connected to Lobby Server")
             
             # Auto-Reconnect if we have a token
             if session.get('token'):
                 print(f"[LobbyConn] Attempting Session Restore...")
-                try:
-                    send_json(self.sock, {"action": "reconnect", "token": session['token']})
-                    resp = recv_json(self.file)
-                    if resp and resp.get('status') == 'ok':
-                         print(f"[LobbyConn] Session Restored for {session['id']}")
-                    else:
-                         print(f"[LobbyConn] Session Restore Failed: {resp}")
-                         session['token'] = None # Invalid token
-                except Exception as e:
-                    print(f"[LobbyConn] Reconnect Error: {e}")
+                resp = self._call(sock, {"action": "reconnect", "token": session['token']})
+                if resp and resp.get('status') == 'ok':
+                     print(f"[LobbyConn] Session Restored for {session['id']}")
+                else:
+                     print(f"[LobbyConn] Session Restore Failed: {resp}")
+                     session['token'] = None # Invalid token
                     
             return True
         except Exception as e:
             print(f"[LobbyConn] Connection Failed: {e}")
-            self.sock = None
-            self.file = None
+            with self.state_lock:
+                self.sock = None
             return False
 
+    def _reader(self, sock):
+        f = sock.makefile('r', encoding='utf-8')
+        try:
+            while True:
+                msg = recv_json(f)
+                if not msg: break
+                if msg.get('type') == 'event':
+                    events.publish(msg)
+                    continue
+                with self.state_lock:
+                    slot = self.pending.pop(msg.get('req_id'), None)
+                if slot:
+                    slot.response = msg
+                    slot.done.set()
+        except (OSError, ValueError):
+            pass
+        finally:
+            f.close()
+            self._drop(sock)
+
+    def _drop(self, sock):
+        # Connection gone: wake every caller still waiting on it
+        with self.state_lock:
+            if self.sock is sock:
+                self.sock = None
+            lost = [rid for rid, slot in self.pending.items() if slot.sock is sock]
+            slots = [self.pending.pop(rid) for rid in lost]
+        for slot in slots:
+            slot.done.set()
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def _supervise(self):
+        # Keep the push stream alive while logged in, even if the UI is idle
+        last_ping = time.time()
+        while True:
+            time.sleep(1.0)
+            if not self.sock and session.get('token'):
+                with self.lock:
+                    self.connect()
+            sock = self.sock
+            if sock and time.time() - last_ping >= HEARTBEAT_INTERVAL:
+                last_ping = time.time()
+                resp = self._call(sock, {"action": "ping"}, timeout=HEARTBEAT_TIMEOUT)
+                if not resp or resp.get('status') != 'ok':
+                    print("[LobbyConn] Heartbeat failed, reconnecting")
+                    self._drop(sock)
+
+    def _call(self, sock, payload, timeout=REQUEST_TIMEOUT):
+        with self.state_lock:
+            self.next_id += 1
+            req_id = self.next_id
+            slot = PendingRequest(sock)
+            self.pending[req_id] = slot
+        try:
+            with self.send_lock:
+                send_json(sock, dict(payload, req_id=req_id))
+        except OSError:
+            self._drop(sock)
+            return None
+
+        if not slot.done.wait(timeout):
+            with self.state_lock:
+                self.pending.pop(req_id, None)
+            return {"status": "error", "message": "Lobby timeout"}
+        return slot.response
+
     def send_request(self, payload):
-        with self.lock:
-            if not self.sock:
-                if not self.connect():
+        # Retry once on a fresh connection if the current one dies mid-request
+        for attempt in range(2):
+            with self.lock:
+                if not self.sock and not self.connect():
                     return {"status": "error", "message": "Lobby Offline"}
-            
-            try:
-                send_json(self.sock, payload)
-                
-                # Drain events loop
-                while True:
-                    resp = recv_json(self.file)
-                    if not resp:
-                        raise Exception("Empty response (connection closed?)")
-                        
-                    if resp.get('type') == 'event':
-                        print(f"[LobbyConn] Ignored Event: {resp.get('event')}")
-                        continue
-                        
-                    return resp
-            except Exception as e:
-                print(f"[LobbyConn] Error: {e}. Reconnecting...")
-                if self.sock: 
-                    self.sock.close()
-                    if self.file: self.file.close()
-                self.sock = None
-                self.file = None
-                
-                # Retry once
-                if self.connect():
-                    try:
-                        send_json(self.sock, payload)
-                        return recv_json(self.file)
-                    except:
-                        pass
-                
-                return {"status": "error", "message": "Connection Lost"}
+                sock = self.sock
+            if not sock: continue
+
+            resp = self._call(sock, payload)
+            if resp is not None:
+                return resp
+            print(f"[LobbyConn] Connection lost during {payload.get('action')}. Reconnecting...")
+
+        return {"status": "error", "message": "Connection Lost"}
     
     def get_id(self):
         return id(self.sock)
@@ -147,9 +241,17 @@ class GameHandler(http.server.SimpleHTTPRequestHandler):
             
         elif path == '/api/library':
             self._handle_library()
+
+        elif path == '/api/admin/stats':
+            # Lobby refuses unless the session user is in LOBBY_ADMINS
+            self._send_json(lobby_req({"action": "game_stats"}))
             
         elif path == '/api/rooms':
-            resp = lobby_req({"action": "list_rooms"})
+            req = {"action": "list_rooms"}
+            for k in ('game_id', 'cursor', 'limit', 'joinable'):
+                if k in qs: req[k] = qs[k][0]
+            if 'status' in qs: req['status'] = qs['status'][0].split(',')
+            resp = lobby_req(req)
             self._send_json(resp)
             
         elif path == '/api/room/info':
@@ -160,10 +262,36 @@ class GameHandler(http.server.SimpleHTTPRequestHandler):
         elif path == '/api/reviews':
             gid = qs.get('game_id', [None])[0]
             print(f"[Client] Fetching reviews for GID: {gid}")
-            resp = lobby_req({"action": "get_reviews", "game_id": gid})
-            print(f"[Client] Review Response: {resp}")
+            resp = lobby_req({
+                "action": "get_reviews", "game_id": gid,
+                "cursor": qs.get('cursor', [None])[0],
+                "limit": qs.get('limit', [None])[0]
+            })
             self._send_json(resp)
 
+        elif path == '/api/events':
+            self._handle_events()
+
+    def _handle_events(self):
+        # Server-Sent Events: forward lobby pushes to the browser as they arrive
+        q = events.subscribe()
+        try:
+            self.send_response(200)
+            self.send_header('Content-type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            while True:
+                try:
+                    ev = q.get(timeout=15)
+                    self.wfile.write(f"event: {ev.get('event')}\ndata: {json.dumps(ev)}\n\n".encode())
+                except queue.Empty:
+                    self.wfile.write(b": keepalive\n\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            events.unsubscribe(q)
+
     def handle_api_post(self, path, body):
         if path == '/api/login' or path == '/api/register':
             action = 'login' if 'login' in path else 'register'
@@ -184,7 +312,7 @@ class GameHandler(http.server.SimpleHTTPRequestHandler):
              return self._handle_install(body.get('game_id'))
              
         if path == '/api/launch':
-             return self._handle_launch(body.get('game_id'), body.get('port'))
+             return self._handle_launch(body.get('game_id'), body.get('port'), body.get('ip'))
 
         if path == '/api/room/create':
              if not session['id']: return {"status": "error", "message": "Login Required"}
@@ -208,6 +336,18 @@ class GameHandler(http.server.SimpleHTTPRequestHandler):
              body['action'] = 'leave_room'
              return lobby_req(body)
 
+        if path == '/api/queue/join':
+             if not session['id']: return {"status": "error", "message": "Login Required"}
+             # Round-trip to the lobby puts us in a latency bucket with similar players
+             t0 = time.time()
+             lobby_req({"action": "ping"})
+             latency_ms = int((time.time() - t0) * 1000)
+             return lobby_req({"action": "queue_for_game", "game_id": body.get('game_id'), "latency_ms": latency_ms})
+
+        if path == '/api/queue/leave':
+             if not session['id']: return {"status": "error", "message": "Login Required"}
+             return lobby_req({"action": "leave_queue"})
+
         if path == '/api/review/add':
              if not session['id']: return {"status": "error", "message": "Login Required"}
              body['action'] = 'add_review'
@@ -226,41 +366,33 @@ class GameHandler(http.server.SimpleHTTPRequestHandler):
         root = os.path.join(DOWNLOAD_DIR, uid)
         games = []
         if os.path.exists(root):
-            # Fetch valid games from server to sync
-            valid_games_resp = lobby_req({"action": "list_games"})
-            valid_ids = set()
-            if valid_games_resp.get('status') == 'ok':
-                valid_ids = set(valid_games_resp['games'].keys())
-                
-                # Cleanup deleted games
-                for d in os.listdir(root):
-                    # d should be game_id
-                    if d not in valid_ids:
-                        print(f"[Library] Removing deleted game: {d}")
-                        shutil.rmtree(os.path.join(root, d))
-                        continue
-                        
+            # Collect installed versions first, then sync them with one round-trip
+            installed = {}
             for d in os.listdir(root):
                 meta_path = os.path.join(root, d, '.meta')
                 if os.path.exists(meta_path):
                     with open(meta_path, 'r') as f:
-                        data = json.load(f)
-                        
-                        # Double check if server still has it (in case list failed but folder exists)
-                        # If list succeded, we already cleaned up. 
-                        # If list failed, valid_ids is empty, we skipped cleanup? 
-                        # Wait, if list failed, we shouldn't delete everything. 
-                        # My logic above: if status == 'ok', then valid_ids populated.
-                        # If status != 'ok', valid_ids empty, we skip cleanup loop. SAFE.
-                        
-                        # Check update
-                        update = False
-                        svr_game = lobby_req({"action": "get_game_info", "game_id": data['id']})
-                        if svr_game.get('status') == 'ok':
-                            if svr_game['data'].get('version') != data.get('version'):
-                                update = True
-                        data['update_available'] = update
-                        games.append(data)
+                        installed[d] = json.load(f)
+                else:
+                    installed[d] = None
+
+            versions = {gid: (meta or {}).get('version') for gid, meta in installed.items()}
+            sync = lobby_req({"action": "check_versions", "versions": versions})
+            stale, deleted = set(), set()
+            # If the check failed we skip cleanup entirely, never wipe the library blindly
+            if sync.get('status') == 'ok':
+                stale = set(sync.get('stale', []))
+                deleted = set(sync.get('deleted', []))
+
+            for gid, data in installed.items():
+                if gid in deleted:
+                    print(f"[Library] Removing deleted game: {gid}")
+                    shutil.rmtree(os.path.join(root, gid))
+                    continue
+                if data is None: continue
+
+                data['update_available'] = gid in stale
+                games.append(data)
         
         self._send_json({"status": "ok", "games": games})
 
@@ -299,7 +431,7 @@ class GameHandler(http.server.SimpleHTTPRequestHandler):
             
         return {"status": "ok"}
 
-    def _handle_launch(self, gid, port):
+    def _handle_launch(self, gid, port, ip=None):
         uid = session['id']
         game_dir = os.path.join(DOWNLOAD_DIR, uid, gid)
         
@@ -314,7 +446,7 @@ class GameHandler(http.server.SimpleHTTPRequestHandler):
         if not os.path.exists(script_path):
              return {"status": "error", "message": "Client script missing"}
              
-        cmd = [sys.executable, script_path, "--ip", LOBBY_HOST, "--port", str(port), "--username", uid]
+        cmd = [sys.executable, script_path, "--ip", ip or LOBBY_HOST, "--port", str(port), "--username", uid]
         
         # Launch Logic
         try:
@@ -3,7 +3,8 @@ const appState = {
     authMode: 'login', // login | register
     user: null,
     gameToRoom: null, // current game id for room context
-    isLaunching: false
+    isLaunching: false,
+    games: null // store catalog, kept current by game_update events
 };
 
 // --- API ---
@@ -48,6 +49,7 @@ document.getElementById('auth-form').addEventListener('submit', async (e) => {
         appState.user = u;
         document.getElementById('user-display').textContent = u;
         toast(`Welcome, ${u}`);
+        connectEvents();
         showView('dashboard');
         showTab('store');
     } else {
@@ -57,6 +59,7 @@ document.getElementById('auth-form').addEventListener('submit', async (e) => {
 
 function logout() {
     appState.user = null;
+    disconnectEvents();
     showView('auth');
     document.getElementById('password').value = '';
 }
@@ -83,6 +86,7 @@ function showTab(tabName) {
 
     if (tabName === 'store') refreshStore();
     if (tabName === 'library') refreshLibrary();
+    if (tabName === 'stats') refreshStats();
 }
 
 // --- Store ---
@@ -92,15 +96,21 @@ async function refreshStore() {
     grid.innerHTML = '<div class="loading-spinner"></div>';
 
     const res = await api('/games');
+    appState.games = (res.status === 'ok' && res.games) ? res.games : null;
+    renderStore();
+}
+
+function renderStore() {
+    const grid = document.getElementById('store-grid');
     grid.innerHTML = '';
 
-    if (res.status === 'ok' && res.games) {
-        Object.entries(res.games).forEach(([gid, g]) => {
+    if (appState.games && Object.keys(appState.games).length) {
+        Object.entries(appState.games).forEach(([gid, g]) => {
             const card = document.createElement('div');
             card.className = 'game-card';
             card.innerHTML = `
                 <div class="card-title">${g.name} <span class="tag">v${g.version}</span> <span class="tag" style="border-color: #fff; color: #fff;">${g.type || 'GUI'}</span></div>
-                <span class="card-ver">by ${g.author}</span>
+                <span class="card-ver">by ${g.author} · ${formatRating(g.rating)}</span>
                 <p class="card-desc">${g.description}</p>
                 <button class="btn secondary sm full-width" style="margin-bottom: 0.5rem;" onclick="openGameDetails('${gid}')">Details & Reviews</button>
                 <button class="btn primary sm full-width" onclick="installGame('${gid}')">Install</button>
@@ -112,6 +122,10 @@ async function refreshStore() {
     }
 }
 
+function storeVisible() {
+    return !document.getElementById('tab-store').classList.contains('hidden');
+}
+
 async function installGame(gid) {
     toast(`Downloading game...`);
     const res = await api('/install', 'POST', { game_id: gid });
@@ -157,9 +171,66 @@ async function refreshLibrary() {
     }
 }
 
+// --- Stats (admins) ---
+
+function statsTable(columns, rows) {
+    if (rows.length === 0) return '<p class="subtitle">Nothing yet.</p>';
+    const head = columns.map(c => `<th>${c[0]}</th>`).join('');
+    const body = rows.map(r => '<tr>' + columns.map(c => `<td>${c[1](r)}</td>`).join('') + '</tr>').join('');
+    return `<table class="stats-table"><thead><tr>${head}</tr></thead><tbody>${body}</tbody></table>`;
+}
+
+async function refreshStats() {
+    const games = document.getElementById('stats-games');
+    const live = document.getElementById('stats-live');
+    const slow = document.getElementById('stats-slow');
+    games.innerHTML = '<div class="loading-spinner"></div>';
+    live.innerHTML = '';
+    slow.innerHTML = '';
+
+    const res = await api('/admin/stats');
+    if (res.status !== 'ok') {
+        games.innerHTML = `<p class="subtitle">${res.message || 'Stats unavailable'}</p>`;
+        return;
+    }
+
+    // Most expensive games first (lobby sorts by total CPU)
+    games.innerHTML = statsTable([
+        ['Game', g => g.name],
+        ['Matches', g => `${g.matches}${g.aborted ? ` (${g.aborted} aborted)` : ''}`],
+        ['Live', g => g.live],
+        ['Avg Length', g => `${g.avg_duration}s`],
+        ['CPU / Match', g => `${g.avg_cpu_seconds}s`],
+        ['CPU / Min', g => `${g.cpu_per_minute}s`],
+        ['Peak RSS', g => `${g.avg_peak_rss_mb} MB`],
+        ['Start', g => g.avg_start_ms !== null ? `${g.avg_start_ms} ms` : '-'],
+        ['Ticks', g => g.avg_ticks],
+        ['Messages', g => g.avg_messages],
+        ['Bytes', g => g.avg_bytes]
+    ], res.games);
+
+    live.innerHTML = statsTable([
+        ['Room', u => u.room_id],
+        ['Game', u => u.game_id],
+        ['Host', u => u.host],
+        ['Uptime', u => `${Math.round(u.uptime || 0)}s`],
+        ['CPU', u => u.cpu_percent !== undefined ? `${u.cpu_percent}%` : '-'],
+        ['RSS', u => `${u.rss_mb} MB`],
+        ['Sockets', u => u.sockets]
+    ], res.live);
+
+    // Test launch at upload vs. real starts (spawn until the game is ready)
+    slow.innerHTML = statsTable([
+        ['Game', g => g.name],
+        ['Cold Start', g => g.cold_start_ms !== null ? `${g.cold_start_ms} ms` : '-'],
+        ['Avg Start', g => g.avg_start_ms !== null ? `${g.avg_start_ms} ms` : '-'],
+        ['Bytecode', g => g.bytecode || 'none']
+    ], res.slow_starts || []);
+}
+
 async function updateGame(gid) {
-    installGame(gid); // Same logic re-downloads
-    setTimeout(refreshLibrary, 2000);
+    await installGame(gid); // Same logic re-downloads
+    refreshLibrary();
 }
 
 // --- Rooms ---
@@ -188,18 +259,28 @@ function closeModal(id) {
     if (lobbyWait) lobbyWait.classList.add('hidden');
 }
 
-async function refreshRooms() {
+let roomsCursor = null;
+
+async function refreshRooms(more = false) {
     const list = document.getElementById('room-list');
-    list.innerHTML = 'Loading...';
+    if (!more) {
+        roomsCursor = null;
+        list.innerHTML = 'Loading...';
+    }
 
-    const res = await api('/rooms');
-    list.innerHTML = '';
+    // Server-side filter + paging: only this game's open rooms, compact summaries
+    let qs = `game_id=${encodeURIComponent(appState.gameToRoom)}&status=waiting,starting,playing`;
+    if (roomsCursor) qs += `&cursor=${encodeURIComponent(roomsCursor)}`;
+    const res = await api('/rooms?' + qs);
+
+    if (!more) list.innerHTML = '';
+    const oldMore = document.getElementById('rooms-more');
+    if (oldMore) oldMore.remove();
 
     if (res.status === 'ok' && res.rooms) {
-        const myRooms = Object.values(res.rooms).filter(r => r.game_id === appState.gameToRoom);
-        if (myRooms.length === 0) list.innerHTML = 'No active rooms for this game.';
+        if (res.rooms.length === 0 && !more) list.innerHTML = 'No active rooms for this game.';
 
-        myRooms.forEach(r => {
+        res.rooms.forEach(r => {
             const item = document.createElement('div');
             item.className = 'room-item';
             item.innerHTML = `
@@ -207,15 +288,47 @@ async function refreshRooms() {
                     <strong>${r.name}</strong> <span style="font-size:0.8rem">(${r.id})</span>
                 </div>
                 <div>
-                    <span class="room-status">${r.status} (${r.players.length}/2)</span>
-                    <button class="btn sm" onclick="joinRoom('${r.id}')">Join</button>
+                    <span class="room-status">${r.status} (${r.player_count}/${r.max_players})</span>
+                    ${r.joinable ? `<button class="btn sm" onclick="joinRoom('${r.id}')">Join</button>` : ''}
                 </div>
             `;
             list.appendChild(item);
         });
+
+        roomsCursor = res.next_cursor;
+        if (roomsCursor) {
+            const btn = document.createElement('button');
+            btn.id = 'rooms-more';
+            btn.className = 'btn sm text-btn';
+            btn.textContent = 'Load more';
+            btn.onclick = () => refreshRooms(true);
+            list.appendChild(btn);
+        }
+    }
+}
+
+// --- Matchmaking ---
+
+function setMatchSearching(on) {
+    document.getElementById('btn-quick-match').classList.toggle('hidden', on);
+    document.getElementById('btn-cancel-match').classList.toggle('hidden', !on);
+    document.getElementById('match-status').classList.toggle('hidden', !on);
+}
+
+async function quickMatch() {
+    const res = await api('/queue/join', 'POST', { game_id: appState.gameToRoom });
+    if (res.status === 'ok') {
+        setMatchSearching(true); // match_found arrives over /api/events
+    } else {
+        toast(res.message, true);
     }
 }
 
+async function cancelMatch() {
+    await api('/queue/leave', 'POST', {});
+    setMatchSearching(false);
+}
+
 async function createRoom() {
     const name = document.getElementById('new-room-name').value;
     if (!name) return;
@@ -242,108 +355,147 @@ async function joinRoom(rid) {
 
 // --- Active Room Controller ---
 
-let roomPoller = null; // Polls for room updates (in addition to push if needed)
-
 function enterRoom(rid) {
     document.getElementById('modal-room').classList.add('hidden'); // Hide list
     document.getElementById('active-room-view').classList.remove('hidden');
     appState.currentRoomId = rid;
     appState.isLaunching = false;
 
-    // Start Polling
-    pollRoom(rid);
+    // One initial fetch, afterwards the lobby pushes room_update/game_over over /api/events
+    fetchRoomState(rid);
 }
 
-function pollRoom(rid) {
-    if (roomPoller) clearInterval(roomPoller);
+// --- Push Events (Server-Sent Events from the local lobby client) ---
 
-    // Initial fetch
-    fetchRoomState(rid);
+let eventSource = null;
 
-    roomPoller = setInterval(() => {
-        fetchRoomState(rid);
-    }, 1000);
-}
+function connectEvents() {
+    disconnectEvents();
+    eventSource = new EventSource('/api/events');
 
-async function fetchRoomState(rid) {
-    const res = await api(`/room/info?room_id=${rid}`);
-
-    // Handle Async Event Interception (Lobby Client might return a buffered event)
-    if (res.type === 'event') {
-        if (res.event === 'room_update') {
-            console.log("Received room_update via poll");
-            renderRoom(res.room);
-            return;
-        }
-        if (res.event === 'game_over') {
-            // Should verify if this game over is for this room? 
-            // Usually yes.
-            // Move back to room view (already there)
-            // Maybe show alert?
-            toast(`Game Over: ${res.winner} wins!(${res.reason})`);
-            // Show Review Modal
-            showReviewModal(res.winner, res.reason);
-            // Polling continues to catch 'idle' status updats
-            return;
-        }
-        // If other event, ignore and let poll happen again
-        return;
-    }
+    eventSource.addEventListener('room_update', (e) => {
+        const ev = JSON.parse(e.data);
+        if (ev.room && ev.room.id === appState.currentRoomId) applyRoomState(ev.room);
+    });
 
-    if (res.status === 'ok') {
-        const room = res.room;
+    eventSource.addEventListener('match_found', (e) => {
+        const ev = JSON.parse(e.data);
+        setMatchSearching(false);
+        toast("Match found!");
+        appState.gameToRoom = ev.room.game_id;
+        enterRoom(ev.room.id);
+    });
 
-        // Check Status
-        if (room.status === 'playing') {
-            if (appState.isLaunching) return;
+    eventSource.addEventListener('match_failed', (e) => {
+        const ev = JSON.parse(e.data);
+        setMatchSearching(false);
+        toast(`Match could not start (${ev.reason}). Please search again.`, true);
+    });
 
-            // Launch!
-            appState.isLaunching = true;
-            // DO NOT stop polling, or we won't know when it ends
-            // if (roomPoller) clearInterval(roomPoller); 
+    eventSource.addEventListener('game_over', (e) => {
+        const ev = JSON.parse(e.data);
+        if (ev.room_id && ev.room_id !== appState.currentRoomId) return;
+        toast(`Game Over: ${ev.winner} wins!(${ev.reason})`);
+        // Room is back to idle; one fetch brings the view (and review prompt) up to date
+        if (appState.currentRoomId) fetchRoomState(appState.currentRoomId);
+    });
 
-            // Hide room view so user focuses on Game Window
-            document.getElementById('active-room-view').classList.add('hidden');
+    eventSource.addEventListener('room_closed', (e) => {
+        const ev = JSON.parse(e.data);
+        // fetchRoomState sees the room is gone and returns to the room list
+        if (ev.room_id === appState.currentRoomId) fetchRoomState(ev.room_id);
+    });
 
-            launchGame(appState.gameToRoom, room.port);
+    eventSource.addEventListener('game_update', (e) => {
+        const ev = JSON.parse(e.data);
+        if (!appState.games) return; // Store not loaded yet; it fetches when opened
+        if (!ev.game_id) {
+            // The whole catalog may have changed
+            if (storeVisible()) refreshStore(); else appState.games = null;
             return;
         }
+        if (ev.game) appState.games[ev.game_id] = ev.game;
+        else delete appState.games[ev.game_id];
+        if (storeVisible()) renderStore();
+    });
 
-        // If we were launching, and now status is NOT playing (e.g. idle), means game ended
-        // If we were launching, and now status is NOT playing (e.g. idle), means game ended
-        if (appState.isLaunching && room.status !== 'playing') {
-            appState.isLaunching = false;
-            // Unhide room view
-            document.getElementById('active-room-view').classList.remove('hidden');
-        }
-
-        // Persistent Review Check: If game is over (idle) and has a winner
-        if (room.status === 'idle' && room.last_winner) {
-            // Check if we already showed this specific win
-            const winKey = `${room.id}_${room.last_winner}_${room.last_reason}`;
+    // EventSource reconnects by itself; resync whatever we missed while it was down
+    eventSource.onopen = () => {
+        if (appState.currentRoomId) fetchRoomState(appState.currentRoomId);
+        if (appState.games && storeVisible()) refreshStore();
+    };
+}
 
-            // Check session/local state (using appState for checks during this session)
-            // AND check if modal is currently visible (to avoid re-triggering animation)
-            const modal = document.getElementById('modal-review');
-            const isModalHidden = modal.classList.contains('hidden');
+function disconnectEvents() {
+    if (eventSource) eventSource.close();
+    eventSource = null;
+}
 
-            if (appState.lastShownWinKey !== winKey && isModalHidden) {
-                console.log("Persistent Review Check: Triggering Modal");
-                showReviewModal(room.last_winner, room.last_reason || 'End');
-                appState.lastShownWinKey = winKey;
-            }
-        }
+async function fetchRoomState(rid) {
+    const res = await api(`/room/info?room_id=${rid}`);
+    if (rid !== appState.currentRoomId) return; // Left meanwhile
 
-        renderRoom(room);
+    if (res.status === 'ok') {
+        applyRoomState(res.room);
     } else {
         // Room likely deleted or user kicked
-        if (roomPoller) clearInterval(roomPoller);
+        appState.currentRoomId = null;
         toast("Room closed or disconnected", true);
         document.getElementById('active-room-view').classList.add('hidden');
         openRoomModal(appState.gameToRoom, document.getElementById('room-game-title').textContent); // Back to list
     }
 }
 
+function applyRoomState(room) {
+    const prevStatus = appState.lastRoomStatus;
+    appState.lastRoomStatus = room.status;
+
+    // Check Status
+    if (room.status === 'playing') {
+        if (appState.isLaunching) return;
+
+        // Launch!
+        appState.isLaunching = true;
+
+        // Hide room view so user focuses on Game Window
+        document.getElementById('active-room-view').classList.add('hidden');
+
+        launchGame(appState.gameToRoom, room.port, room.server_ip);
+        return;
+    }
+
+    // If we were launching, and now status is NOT playing (e.g. idle), means game ended
+    if (appState.isLaunching && room.status !== 'playing') {
+        appState.isLaunching = false;
+        // Unhide room view
+        document.getElementById('active-room-view').classList.remove('hidden');
+    }
+
+    // Start failed: say so once, the host can try again
+    if (room.status === 'failed' && prevStatus !== 'failed') {
+        toast(`Game failed to start: ${room.last_reason || 'unknown error'}`, true);
+    }
+
+    // Persistent Review Check: If game is over (idle) and has a winner
+    if (room.status === 'idle' && room.last_winner) {
+        // Check if we already showed this specific win
+        const winKey = `${room.id}_${room.last_winner}_${room.last_reason}`;
+
+        // Check session/local state (using appState for checks during this session)
+        // AND check if modal is currently visible (to avoid re-triggering animation)
+        const modal = document.getElementById('modal-review');
+        const isModalHidden = modal.classList.contains('hidden');
+
+        if (appState.lastShownWinKey !== winKey && isModalHidden) {
+            console.log("Persistent Review Check: Triggering Modal");
+            showReviewModal(room.last_winner, room.last_reason || 'End');
+            appState.lastShownWinKey = winKey;
+        }
+    }
+
+    renderRoom(room);
+}
+
 function renderRoom(room) {
     document.getElementById('ar-room-name').textContent = room.name;
     document.getElementById('ar-room-id').textContent = room.id;
@@ -369,6 +521,14 @@ function renderRoom(room) {
     const btnStart = document.getElementById('btn-start-game');
     const txtStatus = document.getElementById('ar-status-msg');
 
+    if (room.status === 'starting') {
+        btnStart.classList.add('hidden');
+        txtStatus.innerHTML = '<span class="status-pulse"></span> Starting game server...';
+        txtStatus.classList.remove('hidden');
+        return;
+    }
+    txtStatus.innerHTML = '<span class="status-pulse"></span> Waiting for host...';
+
     if (isHost) {
         btnStart.classList.remove('hidden');
         txtStatus.classList.add('hidden');
@@ -389,7 +549,7 @@ async function leaveRoom() {
     const res = await api('/room/leave', 'POST', { room_id: appState.currentRoomId });
 
     // Cleanup Local
-    if (roomPoller) clearInterval(roomPoller);
+    appState.currentRoomId = null;
     document.getElementById('active-room-view').classList.add('hidden');
 
     // Go back to Room List
@@ -397,9 +557,10 @@ async function leaveRoom() {
 }
 
 // Fallback for launch if not handled by poller (e.g. manual call)
-async function launchGame(gid, port) {
+async function launchGame(gid, port, ip) {
     toast("Launching Game...");
-    const res = await api('/launch', 'POST', { game_id: gid, port: port });
+    // ip: the game host running this room; unset when the lobby machine runs it
+    const res = await api('/launch', 'POST', { game_id: gid, port: port, ip: ip });
     if (res.status !== 'ok') {
         toast("Launch failed: " + res.message, true);
         // If launch failed, maybe go back to room?
@@ -459,6 +620,13 @@ async function submitReview() {
     closeReviewModal();
 }
 
+function formatRating(rating) {
+    if (!rating || !rating.count) return '★ N/A';
+    return `★ ${Number(rating.average).toFixed(1)} (${rating.count})`;
+}
+
+let reviewsCursor = null;
+
 async function openGameDetails(gid) {
     // 1. Get Game Info (from full list for simplicity)
     const resG = await api('/games');
@@ -471,54 +639,66 @@ async function openGameDetails(gid) {
         return;
     }
 
-    // 2. Get Reviews
-    const resR = await api(`/reviews?game_id=${gid}`);
-    const reviews = (resR.status === 'ok') ? resR.reviews : [];
-
-    // 3. Calc Avg
-    let avg = 0;
-    if (reviews.length > 0) {
-        const sum = reviews.reduce((acc, r) => acc + parseInt(r.score || 0), 0);
-        avg = (sum / reviews.length).toFixed(1);
-    } else {
-        avg = "N/A";
-    }
-
-    // 4. Render Meta
+    // 2. Render Meta (average comes from the server-side aggregate)
     document.getElementById('gd-game-title').textContent = game.name;
     document.getElementById('gd-game-ver').textContent = 'v' + game.version;
-    document.getElementById('gd-rating-val').textContent = avg + (reviews.length > 0 ? ` (${reviews.length})` : '');
+    document.getElementById('gd-rating-val').textContent = formatRating(game.rating).replace('★ ', '');
     document.getElementById('gd-game-desc').textContent = game.description || "No description provided.";
 
-    // 5. Render Reviews
+    // 3. First page of reviews, newest first
+    document.getElementById('gd-reviews-list').innerHTML = '';
+    reviewsCursor = null;
+    await loadReviews(gid);
+
+    // 4. Show
+    document.getElementById('modal-game-details').classList.remove('hidden');
+}
+
+async function loadReviews(gid) {
     const list = document.getElementById('gd-reviews-list');
-    list.innerHTML = '';
-    if (reviews.length === 0) {
-        list.innerHTML = '<p class="subtitle">No reviews yet.</p>';
-    } else {
-        reviews.reverse().forEach(r => {
-            const item = document.createElement('div');
-            item.className = 'review-item';
+    const qs = reviewsCursor === null ? '' : `&cursor=${reviewsCursor}`;
+    const resR = await api(`/reviews?game_id=${gid}${qs}`);
+    const reviews = (resR.status === 'ok') ? resR.reviews : [];
 
-            // Stars
-            let stars = '';
-            for (let i = 0; i < 5; i++) {
-                stars += (i < r.score) ? '★' : '☆';
-            }
+    const more = document.getElementById('gd-reviews-more');
+    if (more) more.remove();
 
-            item.innerHTML = `
-                <div class="review-header">
-                    <span>${r.reviewer}</span>
-                    <span class="review-score">${stars}</span>
-                </div>
-                <div class="review-body">${r.comment || ''}</div>
-            `;
-            list.appendChild(item);
-        });
+    if (reviews.length === 0 && reviewsCursor === null) {
+        list.innerHTML = '<p class="subtitle">No reviews yet.</p>';
+        return;
     }
 
-    // 6. Show
-    document.getElementById('modal-game-details').classList.remove('hidden');
+    reviews.forEach(r => {
+        const item = document.createElement('div');
+        item.className = 'review-item';
+
+        // Stars
+        let stars = '';
+        for (let i = 0; i < 5; i++) {
+            stars += (i < r.score) ? '★' : '☆';
+        }
+
+        item.innerHTML = `
+            <div class="review-header">
+                <span>${r.reviewer}</span>
+                <span class="review-score">${stars}</span>
+            </div>
+            <div class="review-body">${r.comment || ''}</div>
+        `;
+        list.appendChild(item);
+    });
+
+    reviewsCursor = (resR.status === 'ok') ? resR.next_cursor : null;
+    if (reviewsCursor !== null && reviewsCursor !== undefined) {
+        const btn = document.createElement('button');
+        btn.id = 'gd-reviews-more';
+        btn.className = 'btn sm text-btn';
+        btn.textContent = 'Load more';
+        btn.onclick = () => loadReviews(gid);
+        list.appendChild(btn);
+    } else {
+        reviewsCursor = null;
+    }
 }
 
 // --- Utils ---
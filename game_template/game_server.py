@@ -3,9 +3,73 @@ import sys
 import threading
 import argparse
 import time
+import os
 
 import json
 
+HEARTBEAT_INTERVAL = 2.0
+
+class LobbyChannel:
+    # Persistent control connection to the lobby: game_ready, heartbeats, game_result.
+    # The lobby passes its address and our token in GAMESTORE_CONTROL(_TOKEN);
+    # without them we fall back to the one-shot report on --lobby_port.
+    def __init__(self, room_id, lobby_port):
+        self.room_id = room_id
+        self.lobby_port = lobby_port
+        self.addr = os.environ.get('GAMESTORE_CONTROL')
+        self.token = os.environ.get('GAMESTORE_CONTROL_TOKEN', '')
+        self.sock = None
+        self.lock = threading.Lock()
+        self.stats = {"ticks": 0, "messages": 0} # Sent along for the lobby's accounting
+
+    def connect(self):
+        if not self.addr: return
+        host, port = self.addr.rsplit(':', 1)
+        try:
+            self.sock = socket.create_connection((host, int(port)), timeout=2.0)
+            self.send({"action": "game_ready", "room_id": self.room_id, "token": self.token})
+        except OSError as e:
+            print(f"No lobby control channel: {e}")
+            self.sock = None
+            return
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+
+    def send(self, obj):
+        with self.lock:
+            if self.sock is None: raise OSError("control channel closed")
+            self.sock.sendall((json.dumps(obj) + "\n").encode())
+
+    def heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self.send({"action": "heartbeat", "stats": dict(self.stats)})
+            except OSError:
+                return
+
+    def report(self, payload):
+        payload = dict(payload, stats=dict(self.stats))
+        if self.sock is not None:
+            try:
+                self.send(payload)
+                sent = True
+            except OSError:
+                sent = False
+            try:
+                if sent: self.sock.recv(4096) # Ack: the lobby has the result
+            except OSError:
+                pass
+            finally:
+                with self.lock:
+                    self.sock.close()
+                    self.sock = None
+            if sent: return
+        # Legacy: one unframed message per connection
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.connect(('127.0.0.1', self.lobby_port))
+        s.sendall(json.dumps(dict(payload, token=self.token) if self.token else payload).encode())
+        s.close()
+
 class GameServer:
     def __init__(self, port, room_id, lobby_port=10192):
         self.host = '0.0.0.0'
@@ -17,12 +81,14 @@ class GameServer:
         self.clients = []
         self.lock = threading.Lock()
         self.game_over = False
+        self.lobby = LobbyChannel(room_id, self.lobby_port)
         
     def start(self):
         self.sock.bind((self.host, self.port))
         self.sock.listen(2)
         print(f"Game listening on {self.port}")
         sys.stdout.flush()
+        self.lobby.connect()
         
         # Wait for 2 players
         while len(self.clients) < 2:
@@ -54,6 +120,7 @@ class GameServer:
                 try:
                     data = self.clients[turn].recv(1024).strip()
                     if not data: raise Exception("Disconnected")
+                    self.lobby.stats["messages"] += 1
                 except Exception as e:
                     print(f"Player {turn+1} disconnected: {e}")
                     # Handle Disconnect: Opponent Wins
@@ -75,6 +142,7 @@ class GameServer:
                     self.report_result(turn, "NORMAL_WIN")
                     self.game_over = True
                     
+                self.lobby.stats["ticks"] += 1
                 turn = 1 - turn
             except Exception as e:
                 print(f"Game Loop Error: {e}")
@@ -107,10 +175,7 @@ class GameServer:
             }
             
             
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(('127.0.0.1', self.lobby_port))
-            s.sendall(json.dumps(payload).encode())
-            s.close()
+            self.lobby.report(payload)
             print(f"Reported result: {payload}")
         except Exception as e:
             print(f"Failed to report result: {e}")
@@ -0,0 +1,325 @@
+import contextlib
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+
+# Auth subsystem shared by the Lobby Server and the Developer Server.
+# - Credentials are looked up per user (HGET users/<bucket>/<name>),
+#   never by pulling the whole users collection.
+# - Sessions live in an LRU + TTL cache: idle tokens expire, and the
+#   table can't grow past max_entries.
+#   SharedSessionCache keeps them in the DB server instead, for multi-process lobbies.
+# - Passwords are stored as salted PBKDF2 hashes. Hashing runs in a small
+#   process pool with a bounded queue, so a login storm burns those cores
+#   instead of stalling lobby request threads on the GIL.
+
+SESSION_TTL = 3600 # Seconds a token stays valid without being used
+MAX_SESSIONS = 10000
+SESSION_L1_TTL = 30 # Seconds a worker trusts its local copy of a shared session
+
+PBKDF2_ITERATIONS = 200000
+HASH_WORKERS = 2           # Processes dedicated to password hashing
+MAX_PENDING_HASHES = 64    # Beyond this, logins are refused with "busy" instead of queueing
+HASH_TIMEOUT = 10          # Seconds
+LOGINS_PER_IP = 4          # Concurrent login/register attempts allowed per client IP
+VERIFIED_TTL = 300         # Seconds a successful password check is remembered
+
+def hash_password(password, salt=None, iterations=PBKDF2_ITERATIONS):
+    salt = salt or os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+def verify_password(password, stored):
+    try:
+        scheme, iterations, salt, expected = stored.split('$')
+    except (AttributeError, ValueError):
+        return False
+    if scheme != 'pbkdf2_sha256': return False
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt), int(iterations))
+    return hmac.compare_digest(digest.hex(), expected)
+
+class HasherBusy(Exception):
+    pass
+
+class PasswordHasher:
+    """
+    Runs hash_password/verify_password in a dedicated process pool with a bounded backlog.
+    The pool starts with the first hash, not at import; close() it before the server exits.
+    """
+    def __init__(self, workers=HASH_WORKERS, max_pending=MAX_PENDING_HASHES):
+        self.workers = workers
+        self.pool = None
+        self.pool_lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max_pending)
+
+    def _pool(self):
+        with self.pool_lock:
+            if self.pool is None:
+                # forkserver: never fork the (multi-threaded) server process itself. Preloading
+                # only this module keeps the forkserver single-threaded too; the default
+                # preload runs the server's module-level setup (and its threads) in it.
+                ctx = multiprocessing.get_context('forkserver')
+                ctx.set_forkserver_preload(['auth'])
+                self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx)
+            return self.pool
+
+    def close(self):
+        # Left running, the workers and forkserver outlive us. Waits out the hashes already
+        # running: without the wait, an os._exit right after still leaves them behind.
+        with self.pool_lock:
+            if self.pool is not None:
+                self.pool.shutdown(cancel_futures=True)
+                self.pool = None
+
+    def _run(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self._pool().submit(fn, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        # The slot is held until the task is really gone from the pool, not just until we stop waiting
+        future.add_done_callback(lambda f: self.slots.release())
+        try:
+            return future.result(timeout=HASH_TIMEOUT)
+        except FutureTimeout:
+            future.cancel() # Drops it if still queued; a running hash keeps its slot until it ends
+            raise HasherBusy()
+
+    def hash(self, password):
+        return self._run(hash_password, password)
+
+    def verify(self, password, stored):
+        return self._run(verify_password, password, stored)
+
+class ConcurrencyLimiter:
+    """Caps simultaneous in-flight operations per key (client IP)."""
+    def __init__(self, limit=LOGINS_PER_IP):
+        self.limit = limit
+        self.active = {} # {key: count}
+        self.lock = threading.Lock()
+
+    def acquire(self, key):
+        with self.lock:
+            if self.active.get(key, 0) >= self.limit: return False
+            self.active[key] = self.active.get(key, 0) + 1
+            return True
+
+    def release(self, key):
+        with self.lock:
+            n = self.active.get(key, 0) - 1
+            if n > 0:
+                self.active[key] = n
+            else:
+                self.active.pop(key, None)
+
+class LRUCache:
+    """
+    Bounded key -> value map with TTL. With sliding=True every hit pushes the
+    expiry forward; since all entries share one TTL and hits move to the end,
+    the OrderedDict is ordered by expiry and purging only touches expired entries.
+    """
+    def __init__(self, ttl, max_entries, sliding=True):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sliding = sliding
+        self.entries = OrderedDict() # {key: (value, expires_at)}
+        self.lock = threading.Lock()
+
+    def put(self, key, value):
+        now = time.time()
+        with self.lock:
+            self._purge_expired(now)
+            self.entries.pop(key, None)
+            self.entries[key] = (value, now + self.ttl)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False) # Evict least recently used
+
+    def get(self, key):
+        if not key: return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if not entry: return None
+            value, expires_at = entry
+            now = time.time()
+            if expires_at < now:
+                del self.entries[key]
+                return None
+            if self.sliding:
+                self.entries[key] = (value, now + self.ttl)
+                self.entries.move_to_end(key)
+            return value
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        return entry[0] if entry else None
+
+    def _purge_expired(self, now):
+        while self.entries:
+            key, (_, expires_at) = next(iter(self.entries.items()))
+            if expires_at >= now: break
+            self.entries.popitem(last=False)
+
+class SessionCache(LRUCache):
+    """Token -> user_session map with sliding expiry."""
+    def __init__(self, ttl=SESSION_TTL, max_entries=MAX_SESSIONS):
+        super().__init__(ttl, max_entries)
+
+    def issue(self, user_session):
+        token = str(uuid.uuid4())
+        self.put(token, user_session)
+        return token
+
+    def revoke(self, token):
+        self.pop(token)
+
+class SharedSessionCache:
+    """
+    Sessions stored in the DB `sessions` collection, so a token issued by one
+    lobby worker is accepted by every worker (and survives a restart).
+    A small local LRU sits in front: a revoked token may still be honoured by
+    other workers for up to local_ttl. The DB expiry slides on each local miss.
+    """
+    def __init__(self, db, ttl=SESSION_TTL, local_ttl=SESSION_L1_TTL, max_entries=MAX_SESSIONS):
+        self.db = db
+        self.ttl = ttl
+        self.local = LRUCache(local_ttl, max_entries, sliding=False)
+
+    def issue(self, user_session):
+        token = str(uuid.uuid4())
+        self.db.set('sessions', token, dict(user_session, expires=time.time() + self.ttl))
+        self.local.put(token, user_session)
+        return token
+
+    def get(self, token):
+        if not token: return None
+        user_session = self.local.get(token)
+        if user_session: return user_session
+
+        record = self.db.get('sessions', token)
+        if not record: return None
+        now = time.time()
+        if record.get('expires', 0) < now:
+            self.db.delete('sessions', token)
+            return None
+        user_session = {k: v for k, v in record.items() if k != 'expires'}
+        self.db.set('sessions', token, dict(user_session, expires=now + self.ttl))
+        self.local.put(token, user_session)
+        return user_session
+
+    def revoke(self, token):
+        self.local.pop(token)
+        self.db.delete('sessions', token)
+
+    def purge_expired(self, page=200):
+        # Drops tokens that expired without ever being looked up again
+        now, cursor, purged = time.time(), None, 0
+        while True:
+            items, cursor = self.db.scan('sessions', cursor, page)
+            for token, record in items:
+                if record.get('expires', 0) < now:
+                    self.db.delete('sessions', token)
+                    purged += 1
+            if cursor is None: return purged
+
+class Authenticator:
+    """Register / login for one role, backed by one bucket of the users collection."""
+    def __init__(self, db, role, bucket, sessions, hasher, record_locks=None):
+        self.db = db
+        self.role = role     # Session type: 'player' / 'dev'
+        self.bucket = bucket # users[bucket][username] = {"pwd_hash": ..., "data": {}}
+        self.sessions = sessions
+        self.hasher = hasher
+        # LockStripes the server takes for read-modify-write of these records, if any
+        self.record_locks = record_locks
+        self.limiter = ConcurrencyLimiter()
+        # Recently verified passwords: {username: keyed digest of (stored hash, password)}.
+        # A repeat login costs one HMAC instead of a full PBKDF2 run.
+        self.verified = LRUCache(VERIFIED_TTL, MAX_SESSIONS, sliding=False)
+        self.cache_key = os.urandom(32)
+
+    def register(self, username, password, ip=None):
+        if not username or not password:
+            return {"status": "error", "message": "Username and password required"}
+        if not self.limiter.acquire(ip):
+            return {"status": "error", "message": "Too many attempts, slow down"}
+        try:
+            if self.db.hget('users', self.bucket, username):
+                return {"status": "error", "message": "User exists"}
+            pwd_hash = self.hasher.hash(password)
+        except HasherBusy:
+            return {"status": "error", "message": "Server busy, try again"}
+        finally:
+            self.limiter.release(ip)
+
+        resp = self.db.hsetnx('users', self.bucket, username, {"pwd_hash": pwd_hash, "data": {}})
+        if resp.get('status') != 'ok':
+            return {"status": "error", "message": "Database unavailable"}
+        if not resp.get('created'):
+            return {"status": "error", "message": "User exists"}
+        return {"status": "ok", "message": "Registered successfully"}
+
+    def login(self, username, password, ip=None):
+        if not self.limiter.acquire(ip):
+            return {"status": "error", "message": "Too many attempts, slow down"}, None
+        try:
+            record = self.db.hget('users', self.bucket, username) if username else None
+            ok = bool(record) and self._check(username, record, password or '')
+        except HasherBusy:
+            return {"status": "error", "message": "Server busy, try again"}, None
+        finally:
+            self.limiter.release(ip)
+
+        if not ok:
+            return {"status": "error", "message": "Invalid credentials"}, None
+
+        user_session = {"type": self.role, "id": username}
+        token = self.sessions.issue(user_session)
+        return {"status": "ok", "token": token}, dict(user_session, token=token)
+
+    def _check(self, username, record, password):
+        stored = record.get('pwd_hash')
+        if not stored:
+            # Legacy plaintext record: compare once, then upgrade it in place
+            if record.get('pwd') is None or not hmac.compare_digest(str(record['pwd']), password):
+                return False
+            self._upgrade(username, record['pwd'], self.hasher.hash(password))
+            return True
+
+        fingerprint = hmac.new(self.cache_key, f"{stored}\0{password}".encode(), 'sha256').digest()
+        cached = self.verified.get(username)
+        if cached and hmac.compare_digest(cached, fingerprint):
+            return True
+        if not self.hasher.verify(password, stored):
+            return False
+        self.verified.put(username, fingerprint)
+        return True
+
+    def _upgrade(self, username, pwd, pwd_hash):
+        # Re-read after hashing and swap only pwd -> pwd_hash: the rest of the record
+        # (ratings) may have changed meanwhile
+        with self.record_locks.hold(username) if self.record_locks else contextlib.nullcontext():
+            record = self.db.hget('users', self.bucket, username)
+            if not record or record.get('pwd_hash') or record.get('pwd') != pwd:
+                return # Upgraded by a concurrent login, or the password changed
+            record = {k: v for k, v in record.items() if k != 'pwd'}
+            record['pwd_hash'] = pwd_hash
+            self.db.hset('users', self.bucket, username, record)
+
+    def resume(self, token):
+        user_session = self.sessions.get(token)
+        if not user_session or user_session['type'] != self.role:
+            return {"status": "error", "message": "Invalid token"}, None
+        return {"status": "ok", "message": "Session restored"}, dict(user_session, token=token)
+
+    def logout(self, token):
+        if token:
+            self.sessions.revoke(token)
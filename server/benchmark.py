@@ -0,0 +1,383 @@
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Benchmarks against a running Game Store system (start it with ./start_system.sh first).
+# Usage: python3 server/benchmark.py <scenario> [options]
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import send_json, recv_json, DBClient, describe_launch, precompile_game, measure_cold_start, raise_open_file_limit
+from utils import resource_profile
+import snapshot
+
+class Client:
+    """Minimal blocking lobby client (one request at a time, push events skipped)."""
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.f = self.sock.makefile('r', encoding='utf-8')
+
+    def req(self, **payload):
+        send_json(self.sock, payload)
+        while True:
+            resp = recv_json(self.f)
+            if resp is None: raise ConnectionError("lobby closed the connection")
+            if resp.get('type') != 'event': return resp
+
+    def close(self):
+        self.f.close()
+        self.sock.close()
+
+def percentiles(samples):
+    if not samples: return "n/a"
+    ms = sorted(s * 1000 for s in samples)
+    p99 = ms[min(len(ms) - 1, int(len(ms) * 0.99))]
+    return f"p50={statistics.median(ms):.2f}ms p99={p99:.2f}ms max={ms[-1]:.2f}ms (n={len(ms)})"
+
+def probe_latency(args, stop, samples):
+    # Cheap lobby action timed in a loop: this is what other players feel during the storm
+    c = Client(args.host, args.port)
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        c.req(action='list_rooms')
+        samples.append(time.perf_counter() - t0)
+        time.sleep(args.probe_interval)
+    c.close()
+
+def login_storm(args, users, password):
+    # args.clients connections logging in round-robin for args.duration, with the
+    # latency probe alongside. Returns (counts, elapsed, probe samples)
+    stop, samples = threading.Event(), []
+    counts = {"answered": 0, "ok": 0, "rejected": 0, "failed": 0}
+    counts_lock = threading.Lock()
+
+    def storm(worker):
+        cl = Client(args.host, args.port)
+        i = worker
+        while not stop.is_set():
+            resp = cl.req(action='login', username=users[i % len(users)], password=password)
+            msg = resp.get('message', '')
+            if resp.get('status') == 'ok':
+                keys = ('answered', 'ok')
+            elif msg == 'Invalid credentials':
+                keys = ('answered',) # A full password check that said no
+            else:
+                keys = ('rejected',) if 'busy' in msg or 'slow down' in msg else ('failed',)
+            with counts_lock:
+                for key in keys: counts[key] += 1
+            if keys == ('rejected',):
+                time.sleep(args.backoff) # Well-behaved client: retry later
+                continue
+            i += args.clients
+        cl.close()
+
+    probe = threading.Thread(target=probe_latency, args=(args, stop, samples))
+    workers = [threading.Thread(target=storm, args=(w,)) for w in range(args.clients)]
+    t0 = time.perf_counter()
+    probe.start()
+    for w in workers: w.start()
+    time.sleep(args.duration)
+    stop.set()
+    for w in workers: w.join()
+    probe.join()
+    return counts, time.perf_counter() - t0, samples
+
+def bench_login(args):
+    users = [f"bench_{i}" for i in range(args.users)]
+    print(f"[Bench] Registering {len(users)} users...")
+    c = Client(args.host, args.port)
+    for u in users:
+        c.req(action='register', username=u, password='bench-pw')
+    c.close()
+
+    # 1. Baseline lobby latency
+    stop, baseline = threading.Event(), []
+    t = threading.Thread(target=probe_latency, args=(args, stop, baseline))
+    t.start()
+    time.sleep(args.duration / 2)
+    stop.set()
+    t.join()
+    print(f"  list_rooms idle : {percentiles(baseline)}")
+
+    # 2. Cold: wrong passwords never enter the lobby's verified-password cache, so
+    #    every attempt is a full PBKDF2 check on the hasher pool
+    # 3. Warm: correct passwords, each user logged in once first, so every attempt
+    #    is a cache hit (the repeat-login path)
+    c = Client(args.host, args.port)
+    for u in users:
+        login(c, u, args.backoff)
+    c.close()
+    for phase, password in (("cold", "bench-wrong-pw"), ("warm", "bench-pw")):
+        counts, elapsed, under_load = login_storm(args, users, password)
+        print(f"[Bench] {phase.capitalize()} login storm: {args.clients} clients for {elapsed:.1f}s")
+        print(f"  checks answered : {counts['answered']} ({counts['answered'] / elapsed:.1f}/s, {counts['ok']} ok)")
+        print(f"  rejected (busy) : {counts['rejected']}")
+        print(f"  failed          : {counts['failed']}")
+        print(f"  list_rooms storm: {percentiles(under_load)}")
+
+def login(c, user, backoff=0.05):
+    # Register-or-login, retrying while the lobby sheds a login storm
+    c.req(action='register', username=user, password='bench-pw')
+    while True:
+        resp = c.req(action='login', username=user, password='bench-pw')
+        if resp.get('status') == 'ok': return
+        if 'busy' not in resp.get('message', '') and 'slow down' not in resp.get('message', ''):
+            raise RuntimeError(f"login {user}: {resp.get('message')}")
+        time.sleep(backoff)
+
+def keep_alive(c, stop):
+    # An idle client still gets pushes: read and drop them, pinging so the lobby keeps it
+    c.sock.settimeout(5.0)
+    while not stop.is_set():
+        try:
+            if not c.sock.recv(65536): return
+        except socket.timeout:
+            send_json(c.sock, {"action": "ping"})
+        except OSError:
+            return
+
+def contention_cycles(guest, rid, duration, results):
+    # One guest's join+leave loop, in its own process so the load isn't capped by this
+    # script's GIL; sends back (cycle times, errors)
+    samples, errors = [], 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        t0 = time.perf_counter()
+        for action in ('join_room', 'leave_room'):
+            if guest.req(action=action, room_id=rid).get('status') != 'ok': errors += 1
+        samples.append(time.perf_counter() - t0)
+    results.put((samples, errors))
+
+def bench_contention(args):
+    # Pairs of players in unrelated rooms: the host sits in the room, the guest joins and
+    # leaves in a loop, each guest from its own process. Rooms only contend if they share
+    # a lock, so throughput grows with the room count until the lobby runs out of CPU
+    # (cores, or workers with --workers); the speedup column shows how far it got.
+    levels = [int(n) for n in args.levels.split(',')]
+    pairs = []
+    print(f"[Bench] Setting up {max(levels)} rooms...")
+    for i in range(max(levels)):
+        host, guest = Client(args.host, args.port), Client(args.host, args.port)
+        login(host, f"bench_h{i}")
+        login(guest, f"bench_g{i}")
+        rid = host.req(action='create_room', game_id=args.game_id, room_name=f"bench {i}")['room_id']
+        pairs.append((host, guest, rid))
+    idle = threading.Event()
+    for host, _, _ in pairs:
+        threading.Thread(target=keep_alive, args=(host, idle), daemon=True).start()
+
+    print(f"[Bench] join+leave cycles, {args.duration:.0f}s per level, {os.cpu_count()} CPUs here")
+    ctx = multiprocessing.get_context('fork') # Children inherit the logged-in sockets
+    base = None
+    for n in levels:
+        results = ctx.Queue()
+        workers = [ctx.Process(target=contention_cycles, args=(guest, rid, args.duration, results))
+                   for _, guest, rid in pairs[:n]]
+        for w in workers: w.start()
+        samples, errors = [], 0
+        for _ in workers:
+            s, e = results.get()
+            samples += s
+            errors += e
+        for w in workers: w.join()
+        rate = len(samples) / args.duration
+        base = base or rate
+        print(f"  {n:3d} rooms: {rate:8.1f} cycles/s  x{rate / base:4.1f}  {percentiles(samples)}"
+              f"{f'  errors={errors}' if errors else ''}")
+
+    idle.set()
+    for host, guest, rid in pairs:
+        host.sock.settimeout(None)
+        guest.close()
+        host.close() # Last player out deletes the room
+
+def bench_startup(args):
+    # Spawn-to-listening per game, run on the lobby machine (reads the games' files).
+    # "bytecode" reuses the game's __pycache__; "compile" points each run at an empty
+    # cache (PYTHONPYCACHEPREFIX), so everything it imports, stdlib included, is compiled:
+    # the worst case, an interpreter that can neither read nor write any bytecode.
+    games = DBClient(args.host, args.db_port).get('games') or {}
+    if args.game: games = {gid: g for gid, g in games.items() if gid in args.game}
+    print(f"[Bench] Cold start of {len(games)} games, {args.runs} runs each")
+    for gid, game in sorted(games.items()):
+        launch = game.get('launch') or describe_launch(game['path'], game.get('entry_point', 'game_server.py'))
+        precompile_game(game['path'])
+        profile = resource_profile(game.get('resources')) # Launched the way the lobby would
+        cached, compiled, failed = [], [], 0
+        for _ in range(args.runs):
+            elapsed = measure_cold_start(launch, game['path'], args.timeout, profile=profile)
+            if elapsed is None: failed += 1
+            else: cached.append(elapsed)
+            with tempfile.TemporaryDirectory() as empty:
+                elapsed = measure_cold_start(launch, game['path'], args.timeout, env={"PYTHONPYCACHEPREFIX": empty}, profile=profile)
+            if elapsed is None: failed += 1
+            else: compiled.append(elapsed)
+        print(f"  {gid}{f' ({failed} runs never listened)' if failed else ''}")
+        print(f"    bytecode: {percentiles(cached)}")
+        print(f"    compile : {percentiles(compiled)}")
+
+def db_round_trips(host, port, clients, duration):
+    # HSET + HGET pairs on one scratch key from busy clients; returns (ops/s, samples)
+    stop, samples = threading.Event(), []
+
+    def client():
+        db = DBClient(host, port)
+        i = 0
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            db.hset('game_stats', 'bench_db', f"f{i % 100}", i)
+            db.hget('game_stats', 'bench_db', f"f{i % 100}")
+            samples.append(time.perf_counter() - t0)
+            i += 1
+
+    workers = [threading.Thread(target=client) for _ in range(clients)]
+    t0 = time.perf_counter()
+    for w in workers: w.start()
+    time.sleep(duration)
+    stop.set()
+    for w in workers: w.join()
+    return 2 * len(samples) / (time.perf_counter() - t0), samples
+
+def bench_db(args):
+    # Raw DB round trips from a few busy clients, first alone, then with many idle
+    # connections parked on the server.
+    print(f"[Bench] {args.clients} clients, HSET+HGET pairs, {args.duration:.0f}s per step")
+    rate, samples = db_round_trips(args.host, args.db_port, args.clients, args.duration)
+    print(f"  {'no idle':>14}: {rate:8.1f} ops/s  {percentiles(samples)}")
+    raise_open_file_limit()
+    idle = []
+    try:
+        for _ in range(args.idle):
+            idle.append(socket.create_connection((args.host, args.db_port)))
+    except OSError as e:
+        print(f"  (stopped at {len(idle)} idle connections: {e})")
+    rate, samples = db_round_trips(args.host, args.db_port, args.clients, args.duration)
+    print(f"  {f'{len(idle)} idle':>14}: {rate:8.1f} ops/s  {percentiles(samples)}")
+    for sock in idle: sock.close()
+    DBClient(args.host, args.db_port).delete('game_stats', 'bench_db')
+
+def wait_for_port(host, port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=0.5).close()
+            return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def bench_fsync(args):
+    # Starts its own DB server per policy (scratch data dir and port), so it does not
+    # touch a running system. Half the ops are writes; "always" replies after the fsync.
+    db_server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_server.py')
+    print(f"[Bench] {args.clients} clients, HSET+HGET pairs, {args.duration:.0f}s per policy")
+    for policy in args.policies.split(','):
+        with tempfile.TemporaryDirectory(dir=args.data_dir) as data_dir:
+            proc = subprocess.Popen([sys.executable, db_server, '--port', str(args.db_port),
+                                     '--data_dir', data_dir, '--fsync', policy], stdout=subprocess.DEVNULL)
+            try:
+                if not wait_for_port('127.0.0.1', args.db_port, 5):
+                    print(f"  {policy:>8}: DB server did not start")
+                    continue
+                rate, samples = db_round_trips('127.0.0.1', args.db_port, args.clients, args.duration)
+                print(f"  {policy:>8}: {rate:8.1f} ops/s  {percentiles(samples)}")
+            finally:
+                proc.terminate()
+                proc.wait()
+
+def peak_rss_mb(pid):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'): return int(line.split()[1]) / 1024
+    return None
+
+def bench_coldstart(args):
+    # One collection of --records sessions, stored as a pre-snapshot JSON file and as
+    # a snapshot. Ready = first GET answered (a JSON start also converts the file).
+    db_server = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'db_server.py')
+    print(f"[Bench] Generating {args.records} records...")
+    sessions = {f"token{i:09d}": {"username": f"player{i}", "expires": 1792400000 + i, "worker": i % 4}
+                for i in range(args.records)}
+    probe = f"token{args.records // 2:09d}"
+    for fmt in ('json', 'snap'):
+        with tempfile.TemporaryDirectory(dir=args.data_dir) as data_dir:
+            path = os.path.join(data_dir, f'sessions.{fmt}')
+            with open(path, 'wb') as f:
+                f.write(json.dumps(sessions, indent=2).encode() if fmt == 'json' else snapshot.encode(sessions))
+            size = os.path.getsize(path) / 1e6
+            t0 = time.perf_counter()
+            proc = subprocess.Popen([sys.executable, db_server, '--port', str(args.db_port), '--data_dir', data_dir],
+                                    stdout=subprocess.DEVNULL)
+            try:
+                db, value = DBClient('127.0.0.1', args.db_port), None
+                while value is None and time.perf_counter() - t0 < args.timeout and proc.poll() is None:
+                    value = db.get('sessions', probe)
+                    if value is None: time.sleep(0.01)
+                ready = time.perf_counter() - t0
+                if value is None:
+                    print(f"  {fmt:>4}: not ready after {args.timeout:.0f}s")
+                    continue
+                rss = peak_rss_mb(proc.pid)
+                print(f"  {fmt:>4}: {size:7.1f} MB file  ready in {ready:6.2f}s  peak RSS {rss:7.1f} MB")
+            finally:
+                proc.kill() # No shutdown checkpoint
+                proc.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Game Store benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10192, help='Lobby port')
+    sub = parser.add_subparsers(dest='scenario', required=True)
+
+    p = sub.add_parser('login', help='Login throughput and lobby latency under a login storm')
+    p.add_argument('--users', type=int, default=50)
+    p.add_argument('--clients', type=int, default=16, help='Concurrent login connections')
+    p.add_argument('--duration', type=float, default=10.0, help='Seconds of storm')
+    p.add_argument('--probe_interval', type=float, default=0.02)
+    p.add_argument('--backoff', type=float, default=0.05, help='Retry delay after a busy/limited reply')
+    p.set_defaults(run=bench_login)
+
+    p = sub.add_parser('contention', help='Room operation throughput as unrelated rooms are added')
+    p.add_argument('--levels', default='1,2,4,8,16', help='Concurrent rooms per step')
+    p.add_argument('--duration', type=float, default=5.0, help='Seconds per step')
+    p.add_argument('--game_id', default='bench_game', help='Rooms are never started, any id works')
+    p.set_defaults(run=bench_contention)
+
+    p = sub.add_parser('startup', help='Spawn-to-listening latency per uploaded game')
+    p.add_argument('--db_port', type=int, default=10195)
+    p.add_argument('--game', action='append', help='Only this game id (repeatable)')
+    p.add_argument('--runs', type=int, default=5)
+    p.add_argument('--timeout', type=float, default=10.0, help='Seconds a launch gets to open its port')
+    p.set_defaults(run=bench_startup)
+
+    p = sub.add_parser('db', help='DB server round-trip latency, with and without many idle connections')
+    p.add_argument('--db_port', type=int, default=10195)
+    p.add_argument('--clients', type=int, default=8, help='Concurrent busy clients')
+    p.add_argument('--idle', type=int, default=2000, help='Idle connections held open during the second step')
+    p.add_argument('--duration', type=float, default=5.0, help='Seconds per step')
+    p.set_defaults(run=bench_db)
+
+    p = sub.add_parser('fsync', help='DB throughput per fsync policy, on throwaway DB servers')
+    p.add_argument('--db_port', type=int, default=10295, help='Free port for the throwaway servers')
+    p.add_argument('--policies', default='none,100,10,always', help="Comma-separated --fsync values")
+    p.add_argument('--clients', type=int, default=16, help='Concurrent clients')
+    p.add_argument('--duration', type=float, default=5.0, help='Seconds per policy')
+    p.add_argument('--data_dir', default=None, help='Put the scratch data here (the disk you care about)')
+    p.set_defaults(run=bench_fsync)
+
+    p = sub.add_parser('coldstart', help='DB start time and peak RSS, JSON files vs snapshots')
+    p.add_argument('--db_port', type=int, default=10295, help='Free port for the throwaway servers')
+    p.add_argument('--records', type=int, default=1000000)
+    p.add_argument('--timeout', type=float, default=120.0)
+    p.add_argument('--data_dir', default=None, help='Put the scratch data here')
+    p.set_defaults(run=bench_coldstart)
+
+    args = parser.parse_args()
+    args.run(args)
@@ -0,0 +1,110 @@
+import argparse
+import json
+import os
+import socket
+import sys
+
+# Backups of the DB server (see SNAPSHOT in db_server.py and the format in snapshot.py).
+# Usage:
+#   python3 server/db_backup.py snapshot [--path FILE]    # ask the running DB for one
+#   python3 server/db_backup.py info FILE                 # check a backup, list its contents
+#   python3 server/db_backup.py restore FILE              # with the DB server stopped
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import DBClient
+import snapshot
+import db_server
+
+def cmd_snapshot(args):
+    resp = DBClient(args.host, args.port).snapshot(args.path)
+    if resp.get('status') != 'ok':
+        sys.exit(f"Snapshot failed: {resp.get('message')}")
+    print(f"{resp['path']}: seq {resp['seq']}, {resp['bytes'] / 1e6:.1f} MB in {resp['seconds']:.2f}s")
+
+def verify(path):
+    # Every collection's checksums, before anything is touched
+    seq, entries = snapshot.read_backup(path)
+    counts = {name: len(snapshot.parse(blob, f"{path}:{name}")[0]) for name, blob in entries}
+    return seq, entries, counts
+
+def cmd_info(args):
+    seq, _, counts = verify(args.file)
+    print(f"{args.file}: seq {seq}, checksums ok")
+    for name, count in counts.items():
+        print(f"  {name:<14} {count:8d} keys")
+
+def last_seq():
+    # Highest seq in the existing log, so numbering stays monotonic after a restore
+    segments = db_server.log_segments()
+    if not segments: return 0
+    first_seq, path = segments[-1]
+    last = None
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'): break # Torn tail
+            last = line
+    return max(first_seq - 1, json.loads(last)['seq']) if last else first_seq - 1
+
+def cmd_restore(args):
+    db_server.DATA_DIR = data_dir = os.path.abspath(args.data_dir)
+    try:
+        socket.create_connection((args.host, args.port), timeout=1).close()
+        if not args.force: sys.exit("The DB server is running; stop it first (or pass --force)")
+    except OSError:
+        pass
+    seq, entries, counts = verify(args.file)
+    os.makedirs(data_dir, exist_ok=True)
+    # The marker goes down first and comes off last: until then the DB server refuses
+    # to start, so a crash midway can't leave the backup's snapshots next to the old
+    # log (whose records would be replayed over them). It keeps the chosen seq, so a
+    # rerun doesn't number below records that were already deleted.
+    marker = db_server.restore_marker()
+    next_seq = max(seq, last_seq()) + 1
+    if os.path.exists(marker):
+        with open(marker) as f:
+            next_seq = max(next_seq, json.load(f)['next_seq'])
+    with open(marker + '.tmp', 'w') as f:
+        json.dump({"backup": os.path.abspath(args.file), "next_seq": next_seq}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(marker + '.tmp', marker)
+    db_server.fsync_dir(data_dir)
+
+    # Changes logged after the backup must not be replayed over it
+    for _, path in db_server.log_segments():
+        os.remove(path)
+    open(db_server.segment_path(next_seq), 'wb').close()
+    for name, blob in entries:
+        path = os.path.join(data_dir, f'{name}.snap')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+    db_server.fsync_dir(data_dir)
+    os.remove(marker)
+    db_server.fsync_dir(data_dir)
+    print(f"Restored {sum(counts.values())} keys in {len(counts)} collections from seq {seq} into {data_dir}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DB backups')
+    parser.add_argument('--host', default=db_server.HOST)
+    parser.add_argument('--port', type=int, default=db_server.PORT)
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('snapshot', help='Have the running DB server write a point-in-time backup')
+    p.add_argument('--path', help='Backup file on the DB machine (default: server_data/backups/)')
+    p.set_defaults(run=cmd_snapshot)
+
+    p = sub.add_parser('info', help='Verify a backup and list its collections')
+    p.add_argument('file')
+    p.set_defaults(run=cmd_info)
+
+    p = sub.add_parser('restore', help='Replace the DB data with a backup (DB server stopped)')
+    p.add_argument('file')
+    p.add_argument('--data_dir', default=db_server.DATA_DIR)
+    p.add_argument('--force', action='store_true', help='Even if something answers on the DB port')
+    p.set_defaults(run=cmd_restore)
+
+    args = parser.parse_args()
+    args.run(args)
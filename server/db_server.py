@@ -1,134 +1,879 @@
+import argparse
+import collections
+import gc
 import socket
+import selectors
+import signal
 import threading
 import json
 import os
 import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import scan_page, raise_open_file_limit
+import snapshot
 
 # DB Server (Port 8880)
 # Responsibilities:
 # - Maintain in-memory state of users, games, rooms, reviews
-# - Persist to JSON files
+# - Persist to binary snapshots (see snapshot.py) plus an append-only log of changes in between
 # - Handle requests from DevServer (8881) and LobbyServer (8888)
+# - Pub/sub bus and named leases shared by Lobby worker processes
 
 HOST = '127.0.0.1' # Internal only
 PORT = 10195
 DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../server_data'))
 
-os.makedirs(DATA_DIR, exist_ok=True)
+FSYNC = 'always'    # Append log policy: 'always', 'none' or N (ms), see AppendLog
+SAVE_INTERVAL = 5.0 # Seconds between snapshots; the append log covers the writes in between
+LISTEN_BACKLOG = 1024
+MAX_SUBSCRIBER_BACKLOG = 4 * 1024 * 1024 # Bytes queued for a subscriber before it is dropped
+WATCH_BACKLOG = 10000 # Recent change records a WATCH can resume from
+
+COLLECTIONS = ['users', 'games', 'rooms', 'reviews', 'review_stats', 'sessions', 'presence', 'game_stats', 'match_log']
+
+def log_segments():
+    # [(first_seq, path)] of the append log, oldest first
+    segments = []
+    for name in os.listdir(DATA_DIR):
+        parts = name.split('.')
+        if len(parts) == 3 and parts[0] == 'appendonly' and parts[2] == 'aof' and parts[1].isdigit():
+            segments.append((int(parts[1]), os.path.join(DATA_DIR, name)))
+    return sorted(segments)
+
+def change_keys(change):
+    # The keys a change record touches; None for all of them (a REPLACE)
+    if change['op'] == 'MSET': return set(change['v'])
+    if change['op'] == 'REPLACE': return None
+    return {change['k']}
+
+def segment_path(first_seq):
+    return os.path.join(DATA_DIR, f'appendonly.{first_seq}.aof')
+
+def restore_marker():
+    # Present while db_backup.py restore is replacing the files (see cmd_restore)
+    return os.path.join(DATA_DIR, 'restore.pending')
+
+def fsync_dir(path):
+    # Makes file creations/renames in the directory durable
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 class DBManager:
+    """
+    The data, owned by the event loop thread: commands run one at a time, like Redis,
+    so nothing here takes a lock. Every write marks its collection dirty and queues a
+    change record (with the next seq) for the AppendLog. Records hold resulting values,
+    not commands, so replaying one over a newer snapshot is harmless.
+    Values still in a snapshot file are decoded on first use: go through _value() or
+    _materialize() rather than reading self.data[collection] directly.
+    """
     def __init__(self):
-        self.lock = threading.Lock()
-        self.files = {
-            'users': os.path.join(DATA_DIR, 'users.json'),
-            'games': os.path.join(DATA_DIR, 'games.json'),
-            'rooms': os.path.join(DATA_DIR, 'rooms.json'),
-            'reviews': os.path.join(DATA_DIR, 'reviews.json')
-        }
+        os.makedirs(DATA_DIR, exist_ok=True)
+        if os.path.exists(restore_marker()):
+            # Half old files, half the backup's: neither state is safe to serve
+            sys.exit(f"[DB] A restore into {DATA_DIR} did not finish; run db_backup.py restore again")
+        self.files = {c: os.path.join(DATA_DIR, f'{c}.snap') for c in COLLECTIONS}
+        self.leases = {} # {name: (owner, expires_at)}, in memory only
+        self.dirty = set() # Collections changed since the last snapshot
+        self.seq = 0 # Last change record
+        self.log = [] # [(seq, collection, keys, JSON line)] not yet handed to the AppendLog
+        self.history = collections.deque(maxlen=WATCH_BACKLOG) # The same, for WATCH resumes
         self.data = {}
-        for k in self.files:
-            self.data[k] = self._load(k)
+        gc.disable() # Nothing cyclic is built here; collector passes only slow it down
+        try:
+            for k in self.files:
+                self.data[k] = self._load(k)
+            self._replay_log()
+        finally:
+            gc.enable()
             
     def _load(self, key):
-        if not os.path.exists(self.files[key]):
-            return {}
+        # A damaged file stops the server: starting empty would overwrite the data
+        legacy = os.path.join(DATA_DIR, f'{key}.json')
         try:
-            with open(self.files[key], 'r') as f:
-                return json.load(f)
-        except:
-            return {}
+            if os.path.exists(self.files[key]):
+                return snapshot.Snapshot(self.files[key]).items()
+            if os.path.exists(legacy):
+                # JSON files from older versions become snapshots at the first checkpoint
+                with open(legacy, 'r') as f:
+                    data = json.load(f)
+                self.dirty.add(key)
+                return data
+        except (OSError, ValueError, snapshot.SnapshotError) as e:
+            sys.exit(f"[DB] Cannot load {key}: {e}. Restore or move the file aside.")
+        return {}
+
+    def _value(self, collection, key, default=None):
+        # The decoded value, stored in its place; default is inserted if the key is missing
+        items = self.data[collection]
+        value = items.get(key)
+        if snapshot.is_stored(value):
+            value = items[key] = snapshot.load_value(value)
+        elif value is None and default is not None:
+            value = items[key] = default
+        return value
+
+    def _materialize(self, collection):
+        items = self.data[collection]
+        for key, value in items.items():
+            if snapshot.is_stored(value): items[key] = snapshot.load_value(value)
+        return items
+
+    def _save(self, collection, change):
+        self.dirty.add(collection)
+        self.seq += 1
+        change['seq'], change['c'] = self.seq, collection
+        self.log.append((self.seq, collection, change_keys(change), json.dumps(change) + '\n'))
+
+    def take_log(self):
+        # (bytes for the AppendLog, the records for watchers)
+        changes, self.log = self.log, []
+        self.history.extend(changes)
+        return ''.join(c[3] for c in changes).encode(), changes
+
+    def _replay_log(self):
+        # Re-apply what changed after the snapshots were taken
+        for first_seq, path in log_segments():
+            good = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'): raise ValueError
+                        change = json.loads(line)
+                    except ValueError:
+                        break # Torn last write of a crash
+                    self._apply(change)
+                    self.dirty.add(change['c']) # Not in any snapshot yet
+                    self.history.append((change['seq'], change['c'], change_keys(change), line.decode()))
+                    self.seq = max(self.seq, change['seq'])
+                    good += len(line)
+            if good < os.path.getsize(path):
+                print(f"[DB] Dropping a torn record at the end of {path}")
+                os.truncate(path, good)
+            self.seq = max(self.seq, first_seq - 1)
 
-    def _save(self, key):
-        with open(self.files[key], 'w') as f:
-            json.dump(self.data[key], f, indent=2)
+    def _apply(self, change):
+        items = self.data.get(change['c'])
+        if items is None: return
+        op, key, value = change['op'], change.get('k'), change.get('v')
+        if op == 'SET':
+            items[key] = value
+        elif op == 'DEL':
+            items.pop(key, None)
+        elif op == 'HSET':
+            self._value(change['c'], key, {}).update(value)
+        elif op == 'HDEL':
+            (self._value(change['c'], key) or {}).pop(change['f'], None)
+        elif op == 'RPUSH':
+            values = self._value(change['c'], key, [])
+            if len(values) > change['i']: values[change['i']] = value
+            else: values.append(value)
+        elif op == 'MSET':
+            for k, v in value.items():
+                if v is None: items.pop(k, None)
+                else: items[k] = v
+        elif op == 'REPLACE':
+            self.data[change['c']] = value
+
+    def snapshot_dirty(self):
+        # [(path, bytes)] for every changed collection; encoded here, on the loop
+        # thread, so the Persister never sees a collection mid-change
+        batch = [(self.files[key], snapshot.encode(self.data[key])) for key in self.dirty]
+        self.dirty.clear()
+        return batch
 
     def get(self, collection, key=None):
-        with self.lock:
-            if collection not in self.data: return None
-            if key:
-                return self.data[collection].get(key)
-            return self.data[collection]
+        if collection not in self.data: return None
+        if key:
+            return self._value(collection, key)
+        return self._materialize(collection)
 
     def set(self, collection, key, value):
-        with self.lock:
-            if collection not in self.data: return False
-            self.data[collection][key] = value
-            self._save(collection)
-            return True
-            
+        if collection not in self.data: return False
+        self.data[collection][key] = value
+        self._save(collection, {"op": "SET", "k": key, "v": value})
+        return True
+        
+    def count(self, collection):
+        return len(self.data.get(collection) or {})
+
     def delete(self, collection, key):
-        with self.lock:
-            if collection not in self.data: return False
-            if key in self.data[collection]:
-                del self.data[collection][key]
-                self._save(collection)
-                return True
-            return False
-            
+        if collection not in self.data: return False
+        if key in self.data[collection]:
+            del self.data[collection][key]
+            self._save(collection, {"op": "DEL", "k": key})
+            return True
+        return False
+        
+    # Field-level access inside one key, e.g. users/players/<name>,
+    # so callers don't have to move a whole bucket to touch one record
+    def hget(self, collection, key, field):
+        if collection not in self.data: return None
+        return (self._value(collection, key) or {}).get(field)
+
+    def hset(self, collection, key, field, value, only_new=False):
+        if collection not in self.data: return False
+        bucket = self._value(collection, key, {})
+        if only_new and field in bucket: return False
+        bucket[field] = value
+        self._save(collection, {"op": "HSET", "k": key, "v": {field: value}})
+        return True
+
+    def hdel(self, collection, key, field):
+        if collection not in self.data: return False
+        bucket = self._value(collection, key) or {}
+        if field in bucket:
+            del bucket[field]
+            self._save(collection, {"op": "HDEL", "k": key, "f": field})
+            return True
+        return False
+
+    # List values (append-only logs such as reviews/<game_id>)
+    def rpush(self, collection, key, value):
+        if collection not in self.data: return None
+        items = self._value(collection, key, [])
+        items.append(value)
+        self._save(collection, {"op": "RPUSH", "k": key, "i": len(items) - 1, "v": value})
+        return len(items)
+
+    def lrange(self, collection, key, start, stop):
+        # Python slice semantics; also returns the full length for paging
+        if collection not in self.data: return [], 0
+        items = self._value(collection, key) or []
+        return items[start:stop], len(items)
+
+    # Counters inside a dict value, e.g. review_stats/<game_id>
+    def hincrby(self, collection, key, increments):
+        if collection not in self.data: return None
+        counters = self._value(collection, key, {})
+        for field, amount in increments.items():
+            counters[field] = counters.get(field, 0) + amount
+        # Logged as the new totals, so a replay can't count twice
+        self._save(collection, {"op": "HSET", "k": key, "v": {f: counters[f] for f in increments}})
+        return dict(counters)
+
+    def scan(self, collection, cursor=None, count=50, where=None):
+        if collection not in self.data: return [], None
+        if where: self._materialize(collection) # Filters look at every value
+        page, next_cursor = scan_page(self.data[collection], cursor, count, where)
+        return [(k, self._value(collection, k)) for k, _ in page], next_cursor
+
+    def mset(self, collection, values):
+        # Many keys, one save; a None value deletes the key
+        if collection not in self.data: return False
+        items = self.data[collection]
+        for key, value in values.items():
+            if value is None:
+                items.pop(key, None)
+            else:
+                items[key] = value
+        self._save(collection, {"op": "MSET", "v": values})
+        return True
+
     def update_all(self, collection, new_data):
-        with self.lock:
-            if collection not in self.data: return False
-            self.data[collection] = new_data
-            self._save(collection)
+        if collection not in self.data: return False
+        self.data[collection] = new_data
+        self._save(collection, {"op": "REPLACE", "v": new_data})
+        return True
+
+    # Named leases: a cross-process mutex that frees itself if the holder dies
+    def acquire_lease(self, name, owner, ttl):
+        now = time.time()
+        holder = self.leases.get(name)
+        if holder and holder[0] != owner and holder[1] > now: return False
+        self.leases[name] = (owner, now + ttl)
+        return True
+
+    def release_lease(self, name, owner):
+        holder = self.leases.get(name)
+        if holder and holder[0] == owner:
+            del self.leases[name]
             return True
+        return False
+
+class Persister(threading.Thread):
+    """
+    Writes collection snapshots to disk off the event loop. Only the newest one per
+    file is kept. Callbacks passed with a batch run once it is safely on disk.
+    """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.cond = threading.Condition()
+        self.pending = {} # {path: bytes}
+        self.callbacks = []
+        self.writing = False
+        self.failed = False
+
+    def submit(self, batch, then=None):
+        with self.cond:
+            self.pending.update(batch)
+            if then: self.callbacks.append(then)
+            self.cond.notify()
+
+    def drain(self):
+        # Block until everything submitted so far is on disk (shutdown)
+        with self.cond:
+            while self.pending or self.callbacks or self.writing:
+                self.cond.wait()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.callbacks:
+                    self.cond.wait()
+                batch, self.pending = self.pending, {}
+                callbacks, self.callbacks = self.callbacks, []
+                self.writing = True
+            for path, data in batch.items():
+                try:
+                    # Write aside and swap in, so a crash never leaves a half-written file
+                    tmp = path + '.tmp'
+                    with open(tmp, 'wb') as f:
+                        f.write(data)
+                        f.flush()
+                        os.fsync(f.fileno())
+                    os.replace(tmp, path)
+                except OSError as e:
+                    # Keep every log segment from now on: they are the only copy
+                    print(f"[DB] Save failed for {path}: {e}")
+                    self.failed = True
+            if batch:
+                fsync_dir(DATA_DIR)
+            if not self.failed:
+                for callback in callbacks: callback()
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+class AppendLog(threading.Thread):
+    """
+    The append-only log of change records, one file per segment (appendonly.<seq>.aof),
+    and the thread that writes it. Whatever the loop queued while the last write was
+    in progress goes out in one write and one fsync (group commit). Policies:
+      'always' - replies to writes wait until the fsync covering them (see DBServer)
+      N        - fsync at most every N ms; replies don't wait, a crash loses <= N ms
+      'none'   - never fsync; the OS flushes when it likes
+    """
+    def __init__(self, policy, first_seq, on_sync):
+        super().__init__(daemon=True)
+        self.policy = policy
+        self.interval = policy / 1000 if isinstance(policy, (int, float)) else None
+        self.on_sync = on_sync
+        self.cond = threading.Condition()
+        self.queue = [] # bytes, or ('rotate', seq) / ('drop', seq)
+        self.queued = self.written = self.synced = first_seq - 1
+        self.busy = False
+        self.last_sync = time.monotonic()
+        segments = log_segments()
+        self.first_seq = segments[-1][0] if segments else first_seq
+        self.fd = self._open(self.first_seq)
+
+    def _open(self, first_seq):
+        fd = os.open(segment_path(first_seq), os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        fsync_dir(DATA_DIR)
+        return fd
+
+    def submit(self, data, seq):
+        with self.cond:
+            self.queue.append(data)
+            self.queued = seq
+            self.cond.notify()
+
+    def rotate(self, first_seq):
+        # Records from first_seq on go to a new segment
+        with self.cond:
+            self.queue.append(('rotate', first_seq))
+            self.cond.notify()
+
+    def drop_before(self, first_seq):
+        # The snapshots now cover everything before first_seq
+        with self.cond:
+            self.queue.append(('drop', first_seq))
+            self.cond.notify()
+
+    def drain(self):
+        with self.cond:
+            while self.queue or self.busy or self.synced < self.queued:
+                self.cond.wait()
+
+    def _write(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def _sync(self):
+        if self.policy != 'none':
+            os.fdatasync(self.fd) if hasattr(os, 'fdatasync') else os.fsync(self.fd)
+        self.last_sync = time.monotonic()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue:
+                    if self.written > self.synced and self.interval is not None:
+                        remaining = self.last_sync + self.interval - time.monotonic()
+                        if remaining <= 0: break
+                        self.cond.wait(remaining)
+                    else:
+                        self.cond.wait()
+                items, self.queue = self.queue, []
+                target = self.queued
+                self.busy = True
+            chunk = []
+            for item in items:
+                if isinstance(item, bytes):
+                    chunk.append(item)
+                    continue
+                self._write(b''.join(chunk))
+                chunk = []
+                kind, first_seq = item
+                if kind == 'rotate' and first_seq != self.first_seq:
+                    self._sync()
+                    os.close(self.fd)
+                    self.first_seq, self.fd = first_seq, self._open(first_seq)
+                elif kind == 'drop':
+                    for seq, path in log_segments():
+                        if seq < first_seq and seq != self.first_seq: os.remove(path)
+            self._write(b''.join(chunk))
+            self.written = target
+            due = self.interval is None or time.monotonic() - self.last_sync >= self.interval
+            if self.written > self.synced and due:
+                self._sync()
+                self.synced = self.written
+            with self.cond:
+                self.busy = False
+                self.cond.notify_all()
+            if self.policy == 'always': self.on_sync()
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = b''
+        self.outbuf = bytearray()
+        self.subscriber = False
+        self.closed = False
+        self.watching = None # Collection name once this is a WATCH connection
+        self.watch_seq = 0
+        self.held = collections.deque() # [[seq, reply]] waiting for the log to be fsynced (or a backup)
+
+class PubSub:
+    """Channel -> subscriber connections. Messages are pushed as newline-delimited JSON."""
+    def __init__(self, server):
+        self.server = server
+        self.channels = {} # {channel: set(Connection)}
+
+    def subscribe(self, conn, channels):
+        conn.subscriber = True
+        for ch in channels:
+            self.channels.setdefault(ch, set()).add(conn)
+
+    def unsubscribe(self, conn):
+        for ch in list(self.channels):
+            self.channels[ch].discard(conn)
+            if not self.channels[ch]: del self.channels[ch]
+
+    def publish(self, channel, message):
+        line = (json.dumps({"channel": channel, "message": message}) + '\n').encode()
+        delivered = 0
+        for conn in list(self.channels.get(channel, ())):
+            if self.server.send(conn, line):
+                delivered += 1
+        return delivered
+
+def handle_request(req, conn):
+    action = req.get('action')
+    collection = req.get('collection')
+    
+    # --- LOGGING ADDED ---
+    key_info = f" key={req.get('key')}" if req.get('key') else ""
+    print(f"[DB] {action} {collection}{key_info}")
+    # ---------------------
+    
+    resp = {"status": "error"}
+    
+    if action == 'GET':
+         res = db.get(collection, req.get('key'))
+         resp = {"status": "ok", "data": res}
+         
+    elif action == 'SET':
+         db.set(collection, req.get('key'), req.get('value'))
+         resp = {"status": "ok"}
+         
+    elif action == 'UPDATE_ALL':
+         db.update_all(collection, req.get('data'))
+         resp = {"status": "ok"}
+         
+    elif action == 'DELETE':
+         db.delete(collection, req.get('key'))
+         resp = {"status": "ok"}
+
+    elif action == 'MSET':
+         db.mset(collection, req.get('values') or {})
+         resp = {"status": "ok"}
+
+    elif action == 'COUNT':
+         resp = {"status": "ok", "count": db.count(collection)}
+
+    elif action == 'HGET':
+         res = db.hget(collection, req.get('key'), req.get('field'))
+         resp = {"status": "ok", "data": res}
+
+    elif action == 'HSET':
+         db.hset(collection, req.get('key'), req.get('field'), req.get('value'))
+         resp = {"status": "ok"}
+
+    elif action == 'HSETNX':
+         created = db.hset(collection, req.get('key'), req.get('field'), req.get('value'), only_new=True)
+         resp = {"status": "ok", "created": created}
+
+    elif action == 'HDEL':
+         db.hdel(collection, req.get('key'), req.get('field'))
+         resp = {"status": "ok"}
+
+    elif action == 'HINCRBY':
+         res = db.hincrby(collection, req.get('key'), req.get('increments') or {})
+         resp = {"status": "ok", "data": res}
+
+    elif action == 'RPUSH':
+         length = db.rpush(collection, req.get('key'), req.get('value'))
+         resp = {"status": "ok", "length": length}
+
+    elif action == 'SCAN':
+         count = max(1, min(int(req.get('count') or 50), 500))
+         items, next_cursor = db.scan(collection, req.get('cursor'), count, req.get('where'))
+         resp = {"status": "ok", "data": items, "next_cursor": next_cursor}
+
+    elif action == 'LRANGE':
+         items, length = db.lrange(collection, req.get('key'), req.get('start'), req.get('stop'))
+         resp = {"status": "ok", "data": items, "length": length}
 
-db = DBManager()
+    elif action == 'LOCK':
+         acquired = db.acquire_lease(req.get('key'), req.get('owner'), float(req.get('ttl') or 10))
+         resp = {"status": "ok", "acquired": acquired}
 
-def handle_client(sock, addr):
-    while True:
+    elif action == 'UNLOCK':
+         db.release_lease(req.get('key'), req.get('owner'))
+         resp = {"status": "ok"}
+
+    elif action == 'PUBLISH':
+         resp = {"status": "ok", "receivers": server.pubsub.publish(req.get('channel'), req.get('message'))}
+
+    elif action == 'SNAPSHOT':
+         # Replied to once the backup is written (see DBServer.backup)
+         return server.backup(conn, req.get('path'))
+
+    elif action == 'WATCH':
+         # The connection now only carries change records (see DBServer.watch)
+         return server.watch(conn, collection, req.get('key'), req.get('since'))
+
+    elif action == 'SUBSCRIBE':
+         # The connection now only carries pushes. Ack first: anything published
+         # later is queued behind it on the same buffer
+         channels = req.get('channels') or []
+         server.pubsub.subscribe(conn, channels)
+         resp = {"status": "ok", "channels": channels}
+    
+    return resp
+
+class DBServer:
+    """
+    One thread, one selector: every command runs to completion before the next, so the
+    data needs no locks and idle connections cost a buffer rather than a thread.
+    Requests and replies are newline-delimited JSON; disk writes go to the AppendLog
+    and the Persister threads.
+    """
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        self.pubsub = PubSub(self)
+        self.persister = Persister()
+        self.log = AppendLog(FSYNC, db.seq + 1, self.wake)
+        self.waiting = set() # Connections with held replies
+        self.backups = {} # {pid: (path, seq, started, held entry)}
+        self.watchers = {} # {collection: {conn: key or None}}
+        self.next_save = 0
+        self.stopping = False
+        self.waker, self.wake_sock = socket.socketpair()
+        self.wake_sock.setblocking(False)
+
+    def wake(self):
+        # Any thread: get the loop out of select()
         try:
-            data = sock.recv(4096).decode()
-            if not data: break
-            
-            # Expecting separate JSONs per line or huge buffer? 
-            # For simplicity, assuming request fits in buffer or line delimited
-            # Using simple JSON per connection request for internal services
-            
-            req = json.loads(data)
-            action = req.get('action')
-            collection = req.get('collection')
-            
-            # --- LOGGING ADDED ---
-            key_info = f" key={req.get('key')}" if req.get('key') else ""
-            print(f"[DB] {action} {collection}{key_info}")
-            # ---------------------
-            
-            resp = {"status": "error"}
-            
-            if action == 'GET':
-                 res = db.get(collection, req.get('key'))
-                 resp = {"status": "ok", "data": res}
-                 
-            elif action == 'SET':
-                 db.set(collection, req.get('key'), req.get('value'))
-                 resp = {"status": "ok"}
-                 
-            elif action == 'UPDATE_ALL':
-                 db.update_all(collection, req.get('data'))
-                 resp = {"status": "ok"}
-                 
-            elif action == 'DELETE':
-                 db.delete(collection, req.get('key'))
-                 resp = {"status": "ok"}
-            
-            sock.sendall(json.dumps(resp).encode())
-            
-        except Exception as e:
-            # print(f"DB Error: {e}")
-            break
-    sock.close()
+            self.wake_sock.send(b'x')
+        except BlockingIOError:
+            pass # Already pending
+
+    def send(self, conn, data):
+        if conn.closed: return False
+        conn.outbuf += data
+        self.flush(conn)
+        if conn.subscriber and len(conn.outbuf) > MAX_SUBSCRIBER_BACKLOG:
+            print("[DB] Dropping a subscriber that stopped reading")
+            self.close(conn)
+        return not conn.closed
+
+    def flush(self, conn):
+        try:
+            if conn.outbuf:
+                sent = conn.sock.send(conn.outbuf)
+                del conn.outbuf[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.close(conn)
+            return
+        # Only watch for writability while something is queued
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.outbuf else 0)
+        if self.sel.get_key(conn.sock).events != events:
+            self.sel.modify(conn.sock, events, conn)
+
+    def close(self, conn):
+        if conn.closed: return
+        conn.closed = True
+        if conn.subscriber: self.pubsub.unsubscribe(conn)
+        if conn.watching: self.watchers[conn.watching].pop(conn, None)
+        self.sel.unregister(conn.sock)
+        conn.sock.close()
+
+    def accept(self, listener):
+        try:
+            sock, _ = listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sel.register(sock, selectors.EVENT_READ, Connection(sock))
+
+    def read(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close(conn)
+            return
+        if conn.subscriber: return # Subscribers only listen
+        conn.inbuf += data
+        if b'\n' not in data: return
+        *lines, conn.inbuf = conn.inbuf.split(b'\n')
+        replies = []
+        for line in lines:
+            if not line.strip(): continue
+            seq = db.seq
+            try:
+                resp = handle_request(json.loads(line), conn)
+            except Exception as e:
+                resp = {"status": "error", "message": str(e)}
+            if resp is None: continue # Deferred, queued in conn.held
+            reply = json.dumps(resp) + '\n'
+            # With FSYNC 'always' a write is acknowledged once it is on disk; later
+            # replies on the connection queue behind it to stay in order
+            if (self.log.policy == 'always' and db.seq != seq) or conn.held:
+                conn.held.append([db.seq, reply])
+                self.waiting.add(conn)
+            else:
+                replies.append(reply)
+        # Pipelined requests share one send
+        if replies: self.send(conn, ''.join(replies).encode())
+        if conn.held: self.release()
+
+    def release(self):
+        synced = self.log.synced
+        for conn in list(self.waiting):
+            ready = []
+            while conn.held and conn.held[0][1] is not None and conn.held[0][0] <= synced:
+                ready.append(conn.held.popleft()[1])
+            if ready: self.send(conn, ''.join(ready).encode())
+            if conn.closed or not conn.held: self.waiting.discard(conn)
+
+    def watch(self, conn, collection, key, since):
+        # Ack with the current seq, then every later change to the collection (or just
+        # that key) in order. With `since`, first the records after it; "reset": true
+        # means they are no longer kept and the watcher has to reload instead.
+        if collection not in db.data:
+            return {"status": "error", "message": f"Unknown collection {collection}"}
+        lines, reset = [], False
+        if since is not None:
+            since = int(since)
+            recent = list(db.history) + db.log # db.log: this round's, not yet in history
+            oldest = recent[0][0] if recent else db.seq + 1
+            if since > db.seq or since + 1 < oldest:
+                reset = True
+            else:
+                lines = [line for seq, c, keys, line in recent
+                         if seq > since and c == collection and (key is None or keys is None or key in keys)]
+        conn.subscriber = True
+        conn.watching = collection
+        conn.watch_seq = db.seq # Later records only; the ack covers the rest
+        self.watchers.setdefault(collection, {})[conn] = key
+        ack = json.dumps({"status": "ok", "seq": db.seq, "reset": reset}) + '\n'
+        # Queued like a held reply, so it can't overtake replies still waiting. With
+        # 'always', watchers only learn of writes once they are on disk, as writers do
+        durable = db.seq if self.log.policy == 'always' else 0
+        conn.held.append([durable, ack + ''.join(lines)])
+        self.waiting.add(conn)
+        return None
+
+    def notify_watchers(self, changes):
+        for seq, collection, keys, line in changes:
+            watchers = self.watchers.get(collection)
+            if not watchers: continue
+            data = line.encode()
+            for conn, key in list(watchers.items()):
+                if seq <= conn.watch_seq: continue
+                if key is not None and keys is not None and key not in keys: continue
+                if self.log.policy == 'always':
+                    conn.held.append([seq, line]) # Sent by release() once fsynced
+                    self.waiting.add(conn)
+                elif conn.held:
+                    conn.held.append([0, line])
+                else:
+                    self.send(conn, data)
+
+    def backup(self, conn, path):
+        # A forked child writes the backup from its copy-on-write view of the data as
+        # of now; the loop carries on. The reply waits in conn.held until it exits.
+        seq = db.seq
+        path = os.path.abspath(path or os.path.join(DATA_DIR, 'backups', f"backup-{seq}-{time.strftime('%Y%m%d-%H%M%S')}.gsb"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        entry = [0, None]
+        conn.held.append(entry)
+        self.waiting.add(conn)
+        started = time.monotonic()
+        pid = os.fork() if hasattr(os, 'fork') else None
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            gc.disable() # Collector passes would copy pages the parent still shares
+            code = 0
+            try:
+                write_backup_file(path, seq)
+            except BaseException as e:
+                print(f"[DB] Backup to {path} failed: {e}", file=sys.stderr)
+                code = 1
+            os._exit(code)
+        if pid is None:
+            # No fork (not POSIX): write it inline, blocking the loop meanwhile
+            try:
+                write_backup_file(path, seq)
+                entry[1] = backup_reply(path, seq, started)
+            except OSError as e:
+                entry[1] = json.dumps({"status": "error", "message": str(e)}) + '\n'
+            self.release()
+            return None
+        print(f"[DB] Backup to {path} started (seq {seq}, pid {pid})")
+        self.backups[pid] = (path, seq, started, entry)
+        return None
+
+    def reap_backups(self):
+        for pid, (path, seq, started, entry) in list(self.backups.items()):
+            done, status = os.waitpid(pid, os.WNOHANG)
+            if not done: continue
+            del self.backups[pid]
+            if os.waitstatus_to_exitcode(status) == 0:
+                entry[1] = backup_reply(path, seq, started)
+                print(f"[DB] Backup to {path} done")
+            else:
+                entry[1] = json.dumps({"status": "error", "message": "Backup failed, see the DB log"}) + '\n'
+        self.release()
+
+    def checkpoint(self):
+        # Snapshot what changed; once it is on disk the older log segments go
+        cut = db.seq + 1
+        self.log.rotate(cut)
+        self.persister.submit(db.snapshot_dirty(), then=lambda: self.log.drop_before(cut))
+        self.next_save = time.monotonic() + SAVE_INTERVAL
+
+    def shutdown(self, signum, frame):
+        # Just wake the loop; it saves between commands, never halfway through one
+        self.stopping = True
+        self.wake()
+
+    def serve_forever(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((HOST, PORT))
+        listener.listen(LISTEN_BACKLOG)
+        listener.setblocking(False)
+        self.sel.register(listener, selectors.EVENT_READ, None)
+        self.waker.setblocking(False)
+        self.sel.register(self.waker, selectors.EVENT_READ, self.waker)
+        self.persister.start()
+        self.log.start()
+        print(f"[DB] Listening on {HOST}:{PORT} (fsync: {FSYNC})")
+
+        while True:
+            timeout = max(0, self.next_save - time.monotonic()) if db.dirty else None
+            for key, events in self.sel.select(timeout):
+                if key.data is None:
+                    self.accept(key.fileobj)
+                    continue
+                if key.data is self.waker:
+                    self.waker.recv(4096)
+                    if self.backups: self.reap_backups()
+                    self.release()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_READ:
+                    self.read(conn)
+                if events & selectors.EVENT_WRITE and not conn.closed:
+                    self.flush(conn)
+            # Everything this round wrote goes to the log as one batch
+            if db.log:
+                data, changes = db.take_log()
+                self.log.submit(data, db.seq)
+                if self.watchers: self.notify_watchers(changes)
+            if db.dirty and time.monotonic() >= self.next_save:
+                self.checkpoint()
+            if self.stopping:
+                self.log.drain()
+                if db.dirty: self.checkpoint()
+                self.persister.drain()
+                self.log.drain()
+                print("[DB] Saved, exiting")
+                os._exit(0)
+
+def write_backup_file(path, seq):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        snapshot.write_backup(f, {c: db.data[c] for c in COLLECTIONS}, seq)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    fsync_dir(os.path.dirname(path))
+
+def backup_reply(path, seq, started):
+    return json.dumps({"status": "ok", "path": path, "seq": seq, "bytes": os.path.getsize(path),
+                       "seconds": round(time.monotonic() - started, 3)}) + '\n'
 
 def start_server():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((HOST, PORT))
-    server.listen(5)
-    print(f"[DB] Listening on {HOST}:{PORT}")
-    
-    while True:
-        client, addr = server.accept()
-        t = threading.Thread(target=handle_client, args=(client, addr))
-        t.start()
+    raise_open_file_limit() # One descriptor per connection, no thread each
+    # Finish pending writes on a clean stop
+    signal.signal(signal.SIGTERM, server.shutdown)
+    signal.signal(signal.SIGINT, server.shutdown)
+    if hasattr(signal, 'SIGCHLD'):
+        signal.signal(signal.SIGCHLD, lambda signum, frame: server.wake()) # A backup finished
+    server.serve_forever()
+
+def parse_fsync(value):
+    if value in ('always', 'none'): return value
+    return max(1, int(value))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DB Server')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--data_dir', default=DATA_DIR)
+    parser.add_argument('--fsync', type=parse_fsync, default=FSYNC,
+                        help="'always' (group commit before replying), N (ms between fsyncs) or 'none'")
+    args = parser.parse_args()
+
+    PORT, DATA_DIR, FSYNC = args.port, os.path.abspath(args.data_dir), args.fsync
+    db = DBManager()
+    server = DBServer()
     start_server()
@@ -3,11 +3,14 @@ import threading
 import json
 import os
 import shutil
+import signal
 import sys
 
 # Ensure we can import utils
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from utils import send_json, recv_json, DBClient
+from utils import send_json, recv_json, DBClient, describe_launch, precompile_game, measure_cold_start
+from utils import parse_cpu_list, resource_profile
+from auth import SessionCache, Authenticator, PasswordHasher
 
 # Developer Server (Port 8881)
 HOST = '0.0.0.0'
@@ -17,7 +20,12 @@ DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../server_da
 GAMES_DIR = os.path.join(DATA_DIR, 'game_files')
 os.makedirs(GAMES_DIR, exist_ok=True)
 
+COLD_START_TIMEOUT = 10.0 # Seconds a test launch gets to open its port
+GAME_CPUS = parse_cpu_list(os.environ.get('GAME_CPUS', '')) # Test launches run where games do
+
 db = DBClient()
+sessions = SessionCache()
+auth = Authenticator(db, 'dev', 'devs', sessions, PasswordHasher())
 
 def handle_client(sock, addr):
     print(f"[Dev] New connection from {addr}")
@@ -34,12 +42,21 @@ def handle_client(sock, addr):
         
         try:
             if action == 'register':
-                response = handle_register(req)
+                response = handle_register(req, addr[0])
             elif action == 'login':
-                resp, user_data = handle_login(req)
+                resp, user_data = handle_login(req, addr[0])
+                response = resp
+                if response['status'] == 'ok':
+                    user_session = user_data
+            elif action == 'reconnect':
+                resp, user_data = auth.resume(req.get('token'))
                 response = resp
                 if response['status'] == 'ok':
                     user_session = user_data
+            elif action == 'logout':
+                auth.logout(user_session.get('token'))
+                user_session = {"type": None, "id": None}
+                response = {"status": "ok"}
             
             # Authenticated Actions
             elif action == 'upload_game':
@@ -73,33 +90,11 @@ def handle_client(sock, addr):
 
 # --- Logic ---
 
-def handle_register(req):
-    username = req.get('username')
-    password = req.get('password')
-    
-    users = db.get('users') or {}
-    devs = users.get('devs', {})
-    
-    if username in devs:
-        return {"status": "error", "message": "User exists"}
-    
-    devs[username] = {"pwd": password, "data": {}}
-    users['devs'] = devs
-    db.update_all('users', users)
-    
-    return {"status": "ok", "message": "Registered successfully"}
+def handle_register(req, ip):
+    return auth.register(req.get('username'), req.get('password'), ip)
 
-def handle_login(req):
-    username = req.get('username')
-    password = req.get('password')
-    
-    users = db.get('users') or {}
-    devs = users.get('devs', {})
-    
-    if username not in devs or devs[username]['pwd'] != password:
-        return {"status": "error", "message": "Invalid credentials"}, None
-        
-    return {"status": "ok", "token": "dummy"}, {"type": "dev", "id": username}
+def handle_login(req, ip):
+    return auth.login(req.get('username'), req.get('password'), ip)
 
 def handle_upload_game(req, dev_id):
     meta = req.get('metadata')
@@ -120,18 +115,24 @@ def handle_upload_game(req, dev_id):
         with open(os.path.join(game_dir, fname), 'w') as f:
             f.write(content)
             
+    entry_point = meta.get('entry_point', 'game_server.py')
+    launch = describe_launch(game_dir, entry_point)
     db.set('games', game_id, {
         "name": game_name,
         "author": dev_id,
         "version": meta.get('version', '1.0'),
         "description": meta.get('description', ''),
         "path": game_dir,
-        "entry_point": meta.get('entry_point', 'game_server.py'),
+        "entry_point": entry_point,
+        "launch": launch, # Read by the lobby at start time
+        "bytecode": precompile_game(game_dir), # Interpreter tag of the __pycache__, None if it failed
         # Add metadata fields that were previously dropped
         "type": meta.get('type', 'GUI'),
         "max_players": meta.get('max_players', 2),
-        "min_players": meta.get('min_players', 2)
+        "min_players": meta.get('min_players', 2),
+        "resources": meta.get('resources') # Optional limits, see utils.resource_profile
     })
+    threading.Thread(target=probe_cold_start, args=(game_id, game_dir, launch, meta.get('resources')), daemon=True).start()
     
     return {"status": "ok", "message": f"Game {game_id} uploaded"}
 
@@ -160,10 +161,25 @@ def handle_update_game(req, dev_id):
     if 'type' in meta: game['type'] = meta['type']
     if 'max_players' in meta: game['max_players'] = meta['max_players']
     if 'min_players' in meta: game['min_players'] = meta['min_players']
+    if 'resources' in meta: game['resources'] = meta['resources']
+    game['launch'] = describe_launch(game['path'], game.get('entry_point', 'game_server.py'))
+    if file_data:
+        game['bytecode'] = precompile_game(game['path'])
     
     db.set('games', game_id, game)
+    if file_data:
+        threading.Thread(target=probe_cold_start, args=(game_id, game['path'], game['launch'], game.get('resources')), daemon=True).start()
     return {"status": "ok", "message": "Game updated"}
 
+def probe_cold_start(game_id, game_dir, launch, resources):
+    # One test launch off the request thread, under the game's own limits; the lobby
+    # reports games that start slowly
+    profile = resource_profile(resources, GAME_CPUS)
+    elapsed = measure_cold_start(launch, game_dir, COLD_START_TIMEOUT, profile=profile)
+    if not db.get('games', game_id): return # Deleted meanwhile
+    db.hset('games', game_id, 'cold_start_ms', round(elapsed * 1000) if elapsed is not None else None)
+    print(f"[Dev] {game_id} cold start: {f'{elapsed * 1000:.0f}ms' if elapsed is not None else 'did not open its port'}")
+
 def handle_delete_game(req, dev_id):
     game_id = req.get('game_id')
     games = db.get('games') or {}
@@ -178,7 +194,14 @@ def handle_delete_game(req, dev_id):
     db.delete('games', game_id)
     return {"status": "ok", "message": "Game deleted"}
 
+def shutdown(signum, frame):
+    auth.hasher.close() # Its hashing processes would outlive us
+    print("[Dev] Stopping")
+    os._exit(0)
+
 def start_server():
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server.bind((HOST, PORT))
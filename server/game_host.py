@@ -0,0 +1,294 @@
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+# Game Host Agent
+# Runs game servers for the lobby on this machine:
+# - Registers with the Lobby Server over an ordinary lobby connection and
+#   reports its load (running games, CPU, free ports) every STATUS_INTERVAL.
+# - Starts games when the lobby places a match here, fetching the game files
+#   through the lobby's download_game on first use.
+# - Game servers hold their control channel (ready / heartbeat / result) with a
+#   local relay port instead of the lobby; the agent forwards each message over
+#   its own lobby connection. Legacy one-shot reports on --lobby_port work too.
+# - Applies each game's resource limits and reports per-room CPU / memory usage.
+# Usage: python3 server/game_host.py --lobby_host <ip> [--capacity 8] [--ports 20000-20099] [--cpus 2-7]
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from utils import send_json, recv_json, describe_launch, launch_command, precompile_game
+from utils import parse_cpu_list, resource_profile, apply_resource_profile, sample_process
+
+STATUS_INTERVAL = 2.0 # Seconds between load reports
+READY_DELAY = 1.0     # Seconds a new game server gets to bind before we report it started
+RECONNECT_DELAY = 2.0
+LOBBY_TIMEOUT = 15.0  # The lobby acks every status report; this long without a word means it's gone
+DOWNLOAD_TIMEOUT = 30.0
+DATA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../host_data'))
+
+class GameHostAgent:
+    def __init__(self, args):
+        self.lobby = (args.lobby_host, args.lobby_port)
+        self.host_id = args.name
+        self.address = args.address
+        self.capacity = args.capacity
+        self.secret = args.secret
+        self.cpus = parse_cpu_list(args.cpus) # Cores game servers may use (None: all)
+        self.games_dir = os.path.join(DATA_DIR, self.host_id)
+        os.makedirs(self.games_dir, exist_ok=True)
+
+        # Optional fixed port range for game servers (e.g. what the firewall allows)
+        self.free_ports = None
+        if args.ports:
+            lo, hi = (int(x) for x in args.ports.split('-'))
+            self.free_ports = set(range(lo, hi + 1))
+
+        self.games = {} # {room_id: (Popen, port)}
+        self.lock = threading.Lock()
+        self.install_lock = threading.Lock()
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.pending = {} # {req_id: [Event, response]}
+        self.relay_port = None
+
+    # --- Lobby connection ---
+
+    def send(self, msg):
+        with self.send_lock:
+            send_json(self.sock, msg)
+
+    def request(self, timeout, **payload):
+        # Pipelined request on the shared connection, answered by req_id
+        req_id = uuid.uuid4().hex
+        entry = [threading.Event(), None]
+        self.pending[req_id] = entry
+        try:
+            self.send(dict(payload, req_id=req_id))
+            entry[0].wait(timeout)
+            return entry[1]
+        finally:
+            self.pending.pop(req_id, None)
+
+    def run(self):
+        self.start_relay()
+        threading.Thread(target=self.report_status, daemon=True).start()
+        threading.Thread(target=self.reap_games, daemon=True).start()
+        while True:
+            try:
+                self.sock = socket.create_connection(self.lobby)
+                self.sock.settimeout(LOBBY_TIMEOUT)
+                f = self.sock.makefile('r', encoding='utf-8')
+                self.send({"action": "register_host", "host_id": self.host_id, "address": self.address,
+                           "capacity": self.capacity, "free_ports": self.free_port_count(), "secret": self.secret})
+                resp = recv_json(f)
+                if not resp or resp.get('status') != 'ok':
+                    print(f"[Host] Registration refused: {(resp or {}).get('message')}")
+                    return
+                print(f"[Host] Registered as {self.host_id} with {self.lobby[0]}:{self.lobby[1]}")
+                self.read_loop(f)
+                self.sock.close()
+            except OSError as e:
+                print(f"[Host] Lobby connection failed: {e}")
+            time.sleep(RECONNECT_DELAY)
+
+    def read_loop(self, f):
+        while True:
+            msg = recv_json(f)
+            if msg is None:
+                print("[Host] Lobby connection closed or silent")
+                return
+            if msg.get('type') == 'command':
+                threading.Thread(target=self.handle_command, args=(msg,), daemon=True).start()
+            elif msg.get('req_id') in self.pending:
+                entry = self.pending[msg['req_id']]
+                entry[1] = msg
+                entry[0].set()
+            # Anything else is an ack for a status/relay message
+
+    def report_status(self):
+        cores = os.cpu_count() or 1
+        while True:
+            time.sleep(STATUS_INTERVAL)
+            with self.lock:
+                running = len(self.games)
+                pids = {rid: proc.pid for rid, (proc, _) in self.games.items()}
+            usage = {rid: sample_process(pid) for rid, pid in pids.items()} # Per room, for the lobby
+            try:
+                self.send({"action": "host_status", "running": running,
+                           "cpu": round(os.getloadavg()[0] / cores, 3), "free_ports": self.free_port_count(),
+                           "games": {rid: u for rid, u in usage.items() if u}})
+            except (OSError, AttributeError):
+                pass # Reconnecting
+
+    # --- Games ---
+
+    def handle_command(self, msg):
+        reply = {"status": "error", "message": f"Unknown command {msg.get('cmd')}"}
+        if msg.get('cmd') == 'start':
+            reply = self.start_game(msg['room_id'], msg['game_id'], msg.get('version'),
+                                    msg.get('entry_point') or 'game_server.py', msg.get('control_token', ''),
+                                    msg.get('resources'), msg.get('launch'))
+        elif msg.get('cmd') == 'stop':
+            reply = self.stop_game(msg['room_id'])
+        try:
+            self.send(dict(reply, action="host_reply", cmd_id=msg.get('cmd_id')))
+        except OSError:
+            pass
+
+    def start_game(self, rid, gid, version, entry_point, token, resources=None, launch=None):
+        port = None
+        try:
+            game_dir = self.install(gid, version)
+            port = self.take_port()
+            launch = launch or describe_launch(game_dir, entry_point) # Older lobbies don't send one
+            cmd = launch_command(launch, game_dir, port=port, lobby_port=self.relay_port, room_id=rid)
+            env = dict(os.environ, GAMESTORE_CONTROL=f"127.0.0.1:{self.relay_port}", GAMESTORE_CONTROL_TOKEN=token)
+            proc = subprocess.Popen(cmd, cwd=game_dir, env=env)
+            apply_resource_profile(proc.pid, resource_profile(resources, self.cpus))
+            with self.lock:
+                self.games[rid] = (proc, port)
+
+            time.sleep(READY_DELAY)
+            if proc.poll() is not None:
+                return {"status": "error", "message": f"Game server exited with code {proc.returncode}"}
+            print(f"[Host] Room {rid}: {gid} running on port {port}")
+            return {"status": "ok", "port": port}
+        except Exception as e:
+            if port is not None and rid not in self.games:
+                self.give_back_port(port)
+            return {"status": "error", "message": str(e)}
+
+    def stop_game(self, rid):
+        # The lobby gave up on a hung game; reap_games reports the exit
+        with self.lock:
+            entry = self.games.get(rid)
+        if not entry:
+            return {"status": "error", "message": "No such game"}
+        entry[0].kill()
+        print(f"[Host] Room {rid}: killed on lobby request")
+        return {"status": "ok"}
+
+    def install(self, gid, version):
+        # Local copy of the game's files, refreshed when the lobby has a newer version
+        game_dir = os.path.join(self.games_dir, gid)
+        marker = os.path.join(game_dir, '.version')
+        with self.install_lock:
+            if os.path.exists(marker):
+                with open(marker) as f:
+                    if f.read() == str(version): return game_dir
+
+            resp = self.request(DOWNLOAD_TIMEOUT, action='download_game', game_id=gid)
+            if not resp or resp.get('status') != 'ok':
+                raise RuntimeError(f"Download of {gid} failed")
+            shutil.rmtree(game_dir, ignore_errors=True)
+            os.makedirs(game_dir)
+            for fname, content in resp['files'].items():
+                with open(os.path.join(game_dir, os.path.basename(fname)), 'w') as f:
+                    f.write(content)
+            with open(marker, 'w') as f:
+                f.write(str(version))
+            precompile_game(game_dir) # Every start of this version reuses the bytecode
+            print(f"[Host] Installed {gid} v{version}")
+            return game_dir
+
+    def reap_games(self):
+        while True:
+            time.sleep(1.0)
+            with self.lock:
+                ended = [(rid, proc, port) for rid, (proc, port) in self.games.items() if proc.poll() is not None]
+                for rid, _, _ in ended:
+                    del self.games[rid]
+            for rid, proc, port in ended:
+                self.give_back_port(port)
+                print(f"[Host] Room {rid}: game server exited with code {proc.returncode}")
+                try:
+                    self.send({"action": "host_game_exit", "room_id": rid, "code": proc.returncode})
+                except OSError:
+                    pass
+
+    # --- Ports ---
+
+    def take_port(self):
+        if self.free_ports is None:
+            s = socket.socket()
+            s.bind(('', 0))
+            port = s.getsockname()[1]
+            s.close()
+            return port
+        with self.lock:
+            if not self.free_ports: raise RuntimeError("No free ports")
+            return self.free_ports.pop()
+
+    def give_back_port(self, port):
+        if self.free_ports is not None:
+            with self.lock:
+                self.free_ports.add(port)
+
+    def free_port_count(self):
+        with self.lock:
+            if self.free_ports is None:
+                return max(0, self.capacity - len(self.games))
+            return len(self.free_ports)
+
+    # --- Result relay ---
+
+    def start_relay(self):
+        # Game servers report to 127.0.0.1:<--lobby_port>; that's us
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(16)
+        self.relay_port = server.getsockname()[1]
+        print(f"[Host] Result relay on 127.0.0.1:{self.relay_port}")
+        threading.Thread(target=self.accept_reports, args=(server,), daemon=True).start()
+
+    def accept_reports(self, server):
+        while True:
+            client, _ = server.accept()
+            threading.Thread(target=self.relay_report, args=(client,), daemon=True).start()
+
+    def relay_report(self, client):
+        # Control channel: newline-framed messages, each forwarded as host_control.
+        # Legacy report: one unframed JSON ended by the sender closing the connection.
+        buf, rid = b'', None
+        try:
+            while True:
+                data = client.recv(4096)
+                if not data: break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    if not line.strip(): continue
+                    msg = json.loads(line)
+                    rid = msg.setdefault('room_id', rid) # Lobby needs it on every relayed message
+                    self.send({"action": "host_control", "message": msg})
+                    if msg.get('action') == 'game_result':
+                        client.sendall(b'{"status": "ok"}\n') # Handed to the lobby
+                        print(f"[Host] Relayed result for room {msg.get('room_id')}")
+            if buf.strip():
+                payload = json.loads(buf)
+                self.send(payload)
+                print(f"[Host] Relayed legacy {payload.get('action')} for room {payload.get('room_id')}")
+        except (OSError, ValueError) as e:
+            print(f"[Host] Control relay error: {e}")
+        finally:
+            client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Game Host Agent')
+    parser.add_argument('--lobby_host', default='127.0.0.1')
+    parser.add_argument('--lobby_port', type=int, default=10192)
+    parser.add_argument('--name', default=f"{socket.gethostname()}-{os.getpid()}", help='Host id shown to the lobby')
+    parser.add_argument('--address', default=None, help='IP clients use to reach this host (default: as seen by the lobby)')
+    parser.add_argument('--capacity', type=int, default=8, help='Max concurrent games')
+    parser.add_argument('--ports', default=None, help='Port range for game servers, e.g. 20000-20099')
+    parser.add_argument('--secret', default=os.environ.get('GAME_HOST_SECRET', ''))
+    parser.add_argument('--cpus', default=os.environ.get('GAME_CPUS', ''), help='Cores for game servers, e.g. 2-7')
+    args = parser.parse_args()
+
+    GameHostAgent(args).run()
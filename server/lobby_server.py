@@ -6,25 +6,71 @@ import shutil
 import sys
 import uuid
 import subprocess
+import argparse
+import copy
+import zlib
+import hmac
+import queue
+import selectors
+import signal
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 # Ensure we can import utils
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-from utils import send_json, recv_json, DBClient
+from utils import send_json, recv_json, scan_page, DBClient, CollectionMirror, TimerWheel, LockStripes, describe_launch, launch_command, precompile_game
+from utils import parse_cpu_list, resource_profile, apply_resource_profile, sample_process
+from auth import SharedSessionCache, Authenticator, PasswordHasher
 
 # Lobby Server (Port 8888)
 HOST = '0.0.0.0'
 # PORT = 8888
 PORT = 10192
 db = DBClient()
+sessions = SharedSessionCache(db) # Tokens are valid on every worker
 
-# Global Lock for DB Transactions
-# Global Lock for DB Transactions
-lock = threading.RLock()
+# Workers: the lobby may run as several processes behind one port (SO_REUSEPORT),
+# on one or several nodes. Set from the command line, see __main__.
+WORKER = 0 # This process's index
+SHARDS = 1 # Lobby workers across all nodes
+SESSION_PURGE_INTERVAL = 600 # Seconds between sweeps of expired sessions (worker 0)
+
+# Locks, in the order they may be taken (never take one while holding a later one):
+#   room_locks   striped by room id: read-modify-write of rooms/<room_id>. Taken through
+#                hold_rooms(), which sends pushes only after letting go
+#   user_locks   striped by username: read-modify-write of player records (ratings).
+#                Several keys at once only through one hold(k1, k2, ...) call.
+#   users_lock, match_lock, running_games_lock, room_table.lock, ...   leaf locks around in-memory
+#                maps, held briefly and never while taking a stripe
+# Each room is its own key in the rooms table, so unrelated rooms proceed in parallel.
+# With several workers every stripe also holds a lease in the DB server (SharedLock),
+# renewed while held.
+ROOM_LOCK_STRIPES = 64
+USER_LOCK_STRIPES = 32
+room_locks = LockStripes(db, 'lobby.room', ROOM_LOCK_STRIPES)
+user_locks = LockStripes(db, 'lobby.user', USER_LOCK_STRIPES)
+auth = Authenticator(db, 'player', 'players', sessions, PasswordHasher(), record_locks=user_locks)
 
 # Process Registry: {room_id: subprocess.Popen}
 running_games = {}
 running_games_lock = threading.RLock()
+# Games on their way out: reported their result over the control channel (exiting after our
+# ack), or still listed when their room started again. [(rid, proc, deadline)], guarded by
+# running_games_lock. The monitor reaps them and kills any past its deadline.
+exiting_games = []
+REPORTED_EXIT_TIMEOUT = 5.0 # Seconds a game gets to exit after reporting its result
 pending_crashes = {} # {rid: timestamp} to track potential crashes with grace period
+
+# Game isolation: limits from the game's metadata "resources" (see utils.resource_profile),
+# optionally pinned to GAME_CPUS (e.g. "2-7") so the lobby keeps its own cores.
+GAME_CPUS = parse_cpu_list(os.environ.get('GAME_CPUS', ''))
+RESOURCE_SAMPLE_INTERVAL = 5.0 # Seconds between /proc samples of each running game
+game_usage = {} # {rid: latest usage sample} for games this worker runs, local or on a host
+
+ROOMS_PAGE_SIZE = 50
+MAX_ROOMS_PAGE_SIZE = 200
+REVIEWS_PAGE_SIZE = 10
+MAX_REVIEWS_PAGE_SIZE = 50
 import time
 
 def monitor_game_processes():
@@ -33,25 +79,45 @@ def monitor_game_processes():
     1. Reaps zombies (proc.poll())
     2. Detects crashes (process ended but room status is 'playing')
     3. Resets room status if crashed
+    4. Samples CPU / memory / fds of local games every RESOURCE_SAMPLE_INTERVAL
     """
+    next_sample = 0
     while True:
         time.sleep(1.0)
         with running_games_lock:
             # Create a list of (rid, proc) to iterate safely
             current_games = list(running_games.items())
+        sampling = time.time() >= next_sample and current_games
+        if sampling:
+            next_sample = time.time() + RESOURCE_SAMPLE_INTERVAL
+            rooms_now = room_table.all()
             
+        reap_exiting_games()
         for rid, proc in current_games:
+            with running_games_lock:
+                if running_games.get(rid) is not proc: continue # Reported or replaced since the snapshot
             ret = proc.poll()
-            if ret is not None:
+            if ret is None:
+                check_game_heartbeat(rid, proc)
+                check_game_startup(rid, proc)
+                if sampling and rid not in rooms_now:
+                    # Room deleted under a running game (everyone left, or it never got placed)
+                    print(f"[Lobby Monitor] Room {rid} is gone, stopping its game server")
+                    proc.kill()
+                elif sampling and isinstance(proc, subprocess.Popen):
+                    usage = sample_process(proc.pid)
+                    if usage: record_usage(rid, usage)
+            else:
                 # Process has ended
                 print(f"[Lobby Monitor] Game Process for Room {rid} ended with code {ret}")
                 
                 # Check room status
-                with lock:
-                    rooms = db.get('rooms') or {}
-                    if rid in rooms:
-                        room = rooms[rid]
-                        if room['status'] == 'playing':
+                with hold_rooms(rid):
+                    room = room_table.get(rid)
+                    if room:
+                        if room['status'] == 'starting':
+                            fail_start(rid, f"Game server exited with code {ret}")
+                        elif room['status'] == 'playing':
                              # Check Grace Period
                              now = time.time()
                              if rid not in pending_crashes:
@@ -67,181 +133,442 @@ def monitor_game_processes():
                              # Game crashed without reporting result.
                              # Reset room, remove players? or state migration?
                              # For now: Reset to idle so it's not stuck.
-                             room['status'] = 'idle'
-                             room.pop('port', None)
-                             
-                             # Notify players of crash?
-                             msg = {"type": "event", "event": "game_over", "winner": "None", "reason": "Server Crashed"}
-                             for p in room['players']:
-                                 broadcast_to_user(p, msg)
-                                 
-                             db.update_all('rooms', rooms)
+                             abort_game(room, "CPU Limit Exceeded" if ret == -signal.SIGXCPU else "Server Crashed")
                              
                              if rid in pending_crashes: del pending_crashes[rid]
                 
                 # Cleanup registry
                 with running_games_lock:
-                    if rid in running_games:
+                    if running_games.get(rid) is proc:
                         del running_games[rid]
+                        forget_game(rid)
                         print(f"[{time.time():.4f}] [Lobby Monitor] Cleaned up Process {rid}")
 
+def reap_exiting_games():
+    now = time.time()
+    with running_games_lock:
+        games = list(exiting_games)
+    for entry in games:
+        rid, proc, deadline = entry
+        if proc.poll() is not None:
+            with running_games_lock:
+                exiting_games.remove(entry)
+            print(f"[Lobby Monitor] Process for Room {rid} reclaimed.")
+        elif now >= deadline:
+            print(f"[Lobby Monitor] Warning: Game {rid} process slow to exit after report, killing it.")
+            proc.kill() # Reaped by a later pass once it is gone
+            with running_games_lock:
+                exiting_games[exiting_games.index(entry)] = (rid, proc, float('inf'))
+
+def retire_game(rid):
+    # A new start of the room is about to register its process (and set its token): any game
+    # still listed from an earlier start moves to exiting_games instead of being overwritten
+    with running_games_lock:
+        old = running_games.pop(rid, None)
+        if old: exiting_games.append((rid, old, time.time() + REPORTED_EXIT_TIMEOUT))
+    if old: forget_game(rid)
+
+GAME_HEARTBEAT_TIMEOUT = 10.0 # Seconds without a control message before a game counts as hung
+
+def check_game_heartbeat(rid, proc):
+    # Still running, but is it alive? Only games holding a control channel heartbeat;
+    # legacy games are judged by process exit alone.
+    ch = game_channels.get(rid)
+    if not ch or ch.done or time.time() - ch.last_seen < GAME_HEARTBEAT_TIMEOUT:
+        return
+    ch.done = True # Once
+    print(f"[{time.time():.4f}] [Lobby Monitor] Room {rid}: no heartbeat for {GAME_HEARTBEAT_TIMEOUT:.0f}s, killing game server")
+    proc.kill()
+    with hold_rooms(rid):
+        room = room_table.get(rid)
+        if room and room['status'] == 'playing':
+            abort_game(room, "Server Unresponsive")
+        elif room and room['status'] == 'starting':
+            fail_start(rid, "Server Unresponsive")
+    pending_crashes.pop(rid, None)
+
+def check_game_startup(rid, proc):
+    deadline = starting_games.get(rid)
+    if deadline is None or time.time() < deadline: return
+    starting_games.pop(rid, None)
+    print(f"[Lobby Monitor] Room {rid}: no game_ready within {STARTUP_TIMEOUT:.0f}s, killing game server")
+    proc.kill()
+    fail_start(rid, "Game server did not start")
+
+# --- Game Accounting ---
+# Every finished match leaves a record in match_log/<game_id> and adds to the
+# game's counters in game_stats/<game_id>; handle_game_stats shows them to admins.
+# Process figures come from our usage samples, play figures (ticks, messages,
+# bytes) from the game itself via "stats" on its heartbeats and result.
+LOBBY_ADMINS = set(filter(None, os.environ.get('LOBBY_ADMINS', '').split(','))) # Usernames
+MATCH_STAT_FIELDS = ('ticks', 'messages', 'bytes')
+RECENT_MATCHES = 5 # Per game in the stats view
+SLOW_START_MS = 2000 # Games whose test launch or average start takes longer are reported
+
+def record_match(room, outcome, stats=None, aborted=False):
+    rid = room['id']
+    with running_games_lock:
+        proc = running_games.get(rid)
+    usage = None
+    if isinstance(proc, subprocess.Popen) and proc.poll() is None:
+        usage = sample_process(proc.pid) # Still up (result via control channel): fresh figures
+    usage = usage or game_usage.get(rid) or db.hget('presence', 'usage', rid) or {}
+    stats = stats if isinstance(stats, dict) else {}
+
+    entry = {
+        "room_id": rid, "outcome": outcome, "ended": time.time(),
+        "duration": round(time.time() - room['started'], 1) if room.get('started') else 0,
+        "cpu_seconds": usage.get('cpu_seconds', 0), "peak_rss_mb": usage.get('peak_rss_mb', 0),
+        "sockets": usage.get('sockets', 0), "host": room.get('game_host') or "lobby"
+    }
+    for field in MATCH_STAT_FIELDS:
+        value = stats.get(field)
+        entry[field] = value if isinstance(value, (int, float)) else 0
+    db.rpush('match_log', room['game_id'], entry)
+    db.hincrby('game_stats', room['game_id'], {
+        "matches": 1, "aborted": 1 if aborted else 0, "duration": entry['duration'],
+        "cpu_seconds": entry['cpu_seconds'], "peak_rss_mb": entry['peak_rss_mb'],
+        **{field: entry[field] for field in MATCH_STAT_FIELDS}
+    })
+
+def handle_game_stats():
+    # Per-game averages, most CPU-hungry first, plus every game running right now
+    games = all_games()
+    rooms = room_table.all()
+    usage = db.get('presence', 'usage') or {}
+    live = []
+    for rid, u in usage.items():
+        room = rooms.get(rid)
+        if not room or room['status'] != 'playing': continue
+        live.append(dict(u, room_id=rid, game_id=room['game_id'], host=room.get('game_host') or "lobby"))
+
+    counters = db.get('game_stats') or {}
+    summary = []
+    for gid, c in counters.items():
+        n = max(1, c.get('matches', 0))
+        recent, _ = db.lrange('match_log', gid, -RECENT_MATCHES)
+        summary.append({
+            "game_id": gid, "name": games.get(gid, {}).get('name', gid),
+            "matches": c.get('matches', 0), "aborted": c.get('aborted', 0),
+            "avg_duration": round(c.get('duration', 0) / n, 1),
+            "avg_cpu_seconds": round(c.get('cpu_seconds', 0) / n, 2),
+            "cpu_per_minute": round(60 * c.get('cpu_seconds', 0) / max(1.0, c.get('duration', 0)), 2),
+            "avg_peak_rss_mb": round(c.get('peak_rss_mb', 0) / n, 1),
+            **{f"avg_{field}": round(c.get(field, 0) / n) for field in MATCH_STAT_FIELDS},
+            "avg_start_ms": round(1000 * c['start_seconds'] / c['starts']) if c.get('starts') else None,
+            "live": sum(1 for g in live if g['game_id'] == gid),
+            "recent": recent[::-1]
+        })
+    summary.sort(key=lambda g: g['avg_cpu_seconds'] * g['matches'], reverse=True)
+
+    # Cold start = the dev server's test launch at upload; average = spawn to ready in real starts
+    slow = []
+    for gid, game in games.items():
+        c = counters.get(gid, {})
+        avg = round(1000 * c['start_seconds'] / c['starts']) if c.get('starts') else None
+        cold = game.get('cold_start_ms')
+        if max(avg or 0, cold or 0) > SLOW_START_MS:
+            slow.append({"game_id": gid, "name": game.get('name', gid), "cold_start_ms": cold,
+                         "avg_start_ms": avg, "bytecode": game.get('bytecode')})
+    slow.sort(key=lambda g: max(g['avg_start_ms'] or 0, g['cold_start_ms'] or 0), reverse=True)
+    return {"status": "ok", "games": summary, "live": live, "slow_starts": slow}
+
+def record_usage(rid, usage):
+    prev = game_usage.get(rid)
+    now = time.time()
+    if prev and now > prev['at']:
+        usage['cpu_percent'] = round(100 * (usage['cpu_seconds'] - prev['cpu_seconds']) / (now - prev['at']), 1)
+    usage['at'] = now
+    game_usage[rid] = usage
+    db.hset('presence', 'usage', rid, usage) # get_room_info on any worker shows it
+
+def abort_game(room, reason):
+    # The game ended without a result: back to idle, no rating change. Caller holds the room's lock.
+    ch = game_channels.get(room['id'])
+    record_match(room, reason, ch.stats if ch else None, aborted=True)
+    room['status'] = 'idle'
+    clear_game_address(room)
+    touch_room(room)
+    msg = {"type": "event", "event": "game_over", "room_id": room['id'], "winner": "None", "reason": reason}
+    for p in room['players']:
+        broadcast_to_user(p, msg)
+    room_table.put(room)
+
+# Pipelining: requests carrying a "req_id" are answered out of order (echoing the id),
+# so one slow download_game doesn't hold up list_rooms on the same connection.
+# Session actions always run inline since later requests depend on their outcome.
+SESSION_ACTIONS = ('register', 'login', 'reconnect', 'logout', 'register_host')
+MAX_PIPELINED = 8 # In-flight pipelined requests per connection
+# Liveness: clients ping at least every 10s (game hosts report every 2s). A connection
+# silent for CLIENT_TIMEOUT, or whose pushes stall that long, is dropped and its user
+# goes offline like on any disconnect.
+CLIENT_TIMEOUT = 30.0
+
+class ClientConnection:
+    """A lobby client socket shared by the request loop, pipelined workers and pushes."""
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.send_lock = threading.Lock()
+        self.inflight = threading.BoundedSemaphore(MAX_PIPELINED)
+
+    def send(self, msg):
+        with self.send_lock:
+            send_json(self.sock, msg)
+
+    def close(self):
+        # Wakes the request loop, which then runs the normal disconnect cleanup
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
 def handle_client(sock, addr):
     print(f"[Lobby] New connection from {addr}")
+    conn = ClientConnection(sock, addr)
     user_session = {"type": None, "id": None} 
     
+    sock.settimeout(CLIENT_TIMEOUT) # Bounds both the wait for the next message and stalled sends
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # A push and a reply back to back don't wait on a delayed ACK
     f = sock.makefile('r', encoding='utf-8')
 
     while True:
+        last = time.time()
         req = recv_json(f)
         if not req: 
+            if time.time() - last >= CLIENT_TIMEOUT:
+                print(f"[Lobby] Connection from {addr} timed out")
             # Cleanup on disconnect
-            if user_session['id']:
-                handle_disconnect(user_session['id'])
+            if user_session['type'] == 'host':
+                drop_game_host(user_session['id'], conn)
+            elif user_session['id']:
+                handle_disconnect(user_session['id'], conn)
             break
-        
-        action = req.get('action')
-        response = {"status": "error", "message": "Unknown action"}
-        
-        try:
-            if action == 'register':
-                response = handle_register(req)
-            elif action == 'login':
-                resp, user_data = handle_login(req)
-                response = resp
-                if response['status'] == 'ok':
-                    user_session = user_data
-                    register_online_user(user_session['id'], sock)
-            
-            elif action == 'reconnect':
-                 resp, user_data = handle_reconnect(req)
-                 response = resp
-                 if response['status'] == 'ok':
-                     user_session = user_data
-                     register_online_user(user_session['id'], sock)
-            
-            elif action == 'logout':
-                if user_session['id']:
-                    handle_disconnect(user_session['id'])
-                    user_session = {"type": None, "id": None}
-                response = {"status": "ok"}
-            
-            # Lobby Actions
-            
-            elif action == 'list_games':
-                 games = db.get('games') or {}
-                 response = {"status": "ok", "games": games}
-                 
-            elif action == 'get_game_info':
-                 games = db.get('games') or {}
-                 gid = req.get('game_id')
-                 if gid in games:
-                     response = {"status": "ok", "data": games[gid]}
-                 else:
-                     response = {"status": "error", "message": "Not found"}
-
-            elif action == 'download_game':
-                 response = handle_download_game(req)
-
-            elif action == 'create_room':
-                if not user_session['id']:
-                    response = {"status": "error", "message": "Login required"}
-                else:
-                    response = handle_create_room(req, user_session['id'])
-
-            elif action == 'list_rooms':
-                 rooms = db.get('rooms') or {}
-                 response = {"status": "ok", "rooms": rooms}
-                 
-            elif action == 'join_room':
-                if not user_session['id']:
-                    response = {"status": "error", "message": "Login required"}
-                else:
-                    response = handle_join_room(req, user_session['id'])
-                    
-            elif action == 'get_room_info':
-                 rooms = db.get('rooms') or {}
-                 rid = req.get('room_id')
-                 if rid in rooms:
-                     response = {"status": "ok", "room": rooms[rid]}
-                 else:
-                     response = {"status": "error", "message": "Room not found"}
-            
-            elif action == 'get_reviews':
-                 reviews = db.get('reviews') or {}
-                 gid = req.get('game_id')
-                 response = {"status": "ok", "reviews": reviews.get(gid, [])}
-            
-            elif action == 'add_review':
-                 if user_session['type'] != 'player':
-                      response = {"status": "error", "message": "Access denied"}
-                 else:
-                       response = handle_add_review(req, user_session['id'])
-
-            elif action == 'leave_room':
-                 if not user_session['id']:
-                      response = {"status": "error", "message": "Login required"}
-                 else:
-                      response = handle_leave_room(req, user_session['id'])
-
-            elif action == 'start_game':
-                 if not user_session['id']:
-                      response = {"status": "error", "message": "Login required"}
-                 else:
-                      response = handle_start_game(req, user_session['id'])
-
-            elif action == 'game_result':
-                 # Internal action from Game Server
-                 response = handle_game_result(req)
 
-        except Exception as e:
-            print(f"[Lobby] Error {action}: {e}")
-            response = {"status": "error", "message": str(e)}
+        if req.get('req_id') is not None and req.get('action') not in SESSION_ACTIONS:
+            # Blocks the reader once MAX_PIPELINED are in flight (backpressure)
+            conn.inflight.acquire()
+            t = threading.Thread(target=serve_pipelined, args=(conn, req, dict(user_session)), daemon=True)
+            t.start()
+            continue
 
-        send_json(sock, response)
+        response, user_session = dispatch(req, user_session, conn)
+        try:
+            conn.send(response)
+        except OSError:
+            pass # Socket dead, next recv ends the loop
 
     f.close()
     sock.close()
 
+def serve_pipelined(conn, req, user_session):
+    try:
+        response, _ = dispatch(req, user_session, conn)
+        conn.send(response)
+    except OSError:
+        pass
+    finally:
+        conn.inflight.release()
+
+def dispatch(req, user_session, conn):
+    action = req.get('action')
+    response = {"status": "error", "message": "Unknown action"}
+    
+    try:
+        if action == 'register':
+            response = handle_register(req, conn.addr[0])
+        elif action == 'login':
+            resp, user_data = handle_login(req, conn.addr[0])
+            response = resp
+            if response['status'] == 'ok':
+                user_session = user_data
+                register_online_user(user_session['id'], conn)
+        
+        elif action == 'reconnect':
+             resp, user_data = handle_reconnect(req)
+             response = resp
+             if response['status'] == 'ok':
+                 user_session = user_data
+                 register_online_user(user_session['id'], conn)
+        
+        elif action == 'logout':
+            if user_session['id']:
+                auth.logout(user_session.get('token'))
+                handle_disconnect(user_session['id'], conn)
+                user_session = {"type": None, "id": None}
+            response = {"status": "ok"}
+        
+        # Lobby Actions
+        
+        elif action == 'list_games':
+             response = {"status": "ok", "games": with_ratings(all_games())}
+             
+        elif action == 'get_game_info':
+             gid = req.get('game_id')
+             game = cached_game(gid)
+             if game:
+                 game = dict(game, rating=rating_summary(db.get('review_stats', gid)))
+                 response = {"status": "ok", "data": game}
+             else:
+                 response = {"status": "error", "message": "Not found"}
+
+        elif action == 'check_versions':
+             response = handle_check_versions(req)
+
+        elif action == 'download_game':
+             response = handle_download_game(req)
+
+        elif action == 'create_room':
+            if not user_session['id']:
+                response = {"status": "error", "message": "Login required"}
+            else:
+                response = handle_create_room(req, user_session['id'])
+
+        elif action == 'list_rooms':
+             response = handle_list_rooms(req)
+             
+        elif action == 'join_room':
+            if not user_session['id']:
+                response = {"status": "error", "message": "Login required"}
+            else:
+                response = handle_join_room(req, user_session['id'])
+                
+        elif action == 'get_room_info':
+             rid = req.get('room_id')
+             room = room_table.get(rid)
+             if room:
+                 response = {"status": "ok", "room": room}
+                 if room['status'] == 'playing':
+                     response['usage'] = db.hget('presence', 'usage', rid)
+             else:
+                 response = {"status": "error", "message": "Room not found"}
+        
+        elif action == 'get_reviews':
+             response = handle_get_reviews(req)
+        
+        elif action == 'add_review':
+             if user_session['type'] != 'player':
+                  response = {"status": "error", "message": "Access denied"}
+             else:
+                   response = handle_add_review(req, user_session['id'])
+
+        elif action == 'leave_room':
+             if not user_session['id']:
+                  response = {"status": "error", "message": "Login required"}
+             else:
+                  response = handle_leave_room(req, user_session['id'])
+
+        elif action == 'start_game':
+             if not user_session['id']:
+                  response = {"status": "error", "message": "Login required"}
+             else:
+                  response = handle_start_game(req, user_session['id'])
+
+        elif action == 'queue_for_game':
+             if user_session['type'] != 'player':
+                  response = {"status": "error", "message": "Login required"}
+             else:
+                  response = handle_queue_for_game(req, user_session['id'])
+
+        elif action == 'leave_queue':
+             if not user_session['id']:
+                  response = {"status": "error", "message": "Login required"}
+             else:
+                  response = handle_leave_queue(user_session['id'])
+
+        elif action == 'ping':
+             response = {"status": "ok"}
+
+        elif action == 'game_result':
+             # Legacy one-shot report from a game server (see Game Control Channel)
+             if not legacy_result_allowed(req, conn.addr):
+                  response = {"status": "error", "message": "Unauthorized"}
+             else:
+                  response = handle_game_result(req)
+
+        elif action == 'game_stats':
+             if user_session['type'] != 'player' or user_session['id'] not in LOBBY_ADMINS:
+                  response = {"status": "error", "message": "Admins only"}
+             else:
+                  response = handle_game_stats()
+
+        # Game host agents (server/game_host.py)
+        elif action == 'register_host':
+             response, user_session = handle_register_host(req, user_session, conn)
+        elif action in ('host_status', 'host_reply', 'host_game_exit', 'host_control'):
+             if user_session['type'] != 'host':
+                 response = {"status": "error", "message": "Unauthorized"}
+             else:
+                 response = handle_host_message(req, user_session['id'])
+
+    except Exception as e:
+        print(f"[Lobby] Error {action}: {e}")
+        response = {"status": "error", "message": str(e)}
+
+
+    if req.get('req_id') is not None:
+        response['req_id'] = req['req_id']
+    return response, user_session
+
 # --- Online Users & Broadcast ---
-online_users = {} # {user_id: socket}
-active_tokens = {} # {token: user_session}
-
-def register_online_user(uid, sock):
-    with lock:
-        online_users[uid] = sock
-        print(f"[Lobby] User {uid} online")
-
-def handle_disconnect(uid):
-    with lock:
-        if uid in online_users:
-            del online_users[uid]
-            print(f"[Lobby] User {uid} offline")
-            
-        # Potentially clean up rooms if host disconnects?
-        # For HW simplicity, we keep room but maybe mark user as away?
-        # Or if in 'waiting' room, leave it.
-        rooms = db.get('rooms') or {}
-        dirty = False
-        # Use list(rooms.items()) to safely modify dict while iterating
-        for rid, r in list(rooms.items()):
-            if uid in r['players'] and r['status'] == 'waiting':
+online_users = {} # {user_id: ClientConnection} connected to this worker
+presence = {} # {user_id: worker} for all workers, kept in sync over the bus
+users_lock = threading.Lock()
+
+def register_online_user(uid, conn):
+    with users_lock:
+        online_users[uid] = conn
+        presence[uid] = WORKER
+    print(f"[Lobby] User {uid} online")
+    if SHARDS > 1:
+        db.hset('presence', 'players', uid, WORKER)
+        db.publish(PRESENCE_CHANNEL, {"user": uid, "worker": WORKER, "online": True})
+
+def handle_disconnect(uid, conn):
+    with users_lock:
+        if online_users.get(uid) is not conn:
+            return # Already evicted, or superseded by a newer login
+        online_users.pop(uid, None)
+        print(f"[Lobby] User {uid} offline")
+        if presence.get(uid) not in (WORKER, None):
+            return # Reconnected to another worker meanwhile; that one owns the user now
+        presence.pop(uid, None)
+
+    leave_queues(uid)
+    if SHARDS > 1:
+        if db.hget('presence', 'players', uid) == WORKER:
+            db.hdel('presence', 'players', uid)
+        db.publish(PRESENCE_CHANNEL, {"user": uid, "worker": WORKER, "online": False})
+
+    # Potentially clean up rooms if host disconnects?
+    # For HW simplicity, we keep room but maybe mark user as away?
+    # Or if in 'waiting' room, leave it.
+    # Find the user's rooms unlocked, then re-check each under its own lock
+    rids = [rid for rid, r in room_table.all().items() if uid in r['players']]
+    for rid in rids:
+        with hold_rooms(rid):
+            r = room_table.get(rid)
+            if not r or uid not in r['players']: continue
+            if r['status'] in ('idle', 'failed'):
+                touch_room(r) # May now be abandoned
+                room_table.put(r)
+            elif r['status'] == 'waiting':
                 r['players'].remove(uid)
-                dirty = True
                 
                 if len(r['players']) == 0:
-                    del rooms[rid]
+                    room_table.delete(rid)
+                    forget_room(rid)
                     continue
+                touch_room(r)
                 
                 # Host Migration
                 if r['host'] == uid:
                     r['host'] = r['players'][0]
                     print(f"[Lobby] Room {rid} Host migrated to {r['host']}")
-                    
+                
+                room_table.put(r)
                 # Broadcast update
                 broadcast_room_update(r)
-                
-        if dirty: 
-            db.update_all('rooms', rooms)
 
 def broadcast_room_update(room):
     # Sends "room_update" event to all players in the room
@@ -255,59 +582,389 @@ def broadcast_room_update(room):
 
 def broadcast_to_user(uid, msg):
     # Sends an async message to a connected user (Push Notification)
-    with lock:
-        if uid in online_users:
+    pushes = getattr(deferred, 'pushes', None)
+    if pushes is not None:
+        pushes.append((uid, msg)) # Sent when hold_rooms() lets go
+        return
+    with users_lock:
+        conn = online_users.get(uid)
+        owner = presence.get(uid)
+    if conn:
+        try:
+            conn.send(msg)
+        except OSError as e:
+            # Dead or stalled past CLIENT_TIMEOUT: evict instead of pushing into the void
+            print(f"[Lobby] Push to {uid} failed ({e}), dropping connection")
+            conn.close()
+    elif owner is not None and owner != WORKER:
+        # Connected to another worker: relay through the DB server's pub/sub
+        db.publish(worker_channel(owner), {"op": "deliver", "user": uid, "msg": msg})
+
+deferred = threading.local() # .pushes: [(uid, msg)] made while this thread holds rooms
+
+@contextlib.contextmanager
+def hold_rooms(*rids):
+    # room_locks.hold(), but pushes made inside are sent after the stripes are released:
+    # a client stalled on its socket (up to CLIENT_TIMEOUT) must not keep rooms locked
+    if getattr(deferred, 'pushes', None) is not None:
+        with room_locks.hold(*rids): # Nested: the outermost hold sends them
+            yield
+        return
+    deferred.pushes = []
+    try:
+        with room_locks.hold(*rids):
+            yield
+    finally:
+        pushes, deferred.pushes = deferred.pushes, None
+        for uid, msg in pushes:
+            broadcast_to_user(uid, msg)
+
+# --- Worker Bus ---
+# Pub/sub channels in the DB server:
+#   lobby.presence     user online/offline, every worker mirrors it into `presence`
+#   lobby.worker.<n>   pushes for users connected to worker n, and ops on the
+#                      matchmaking queues it owns
+PRESENCE_CHANNEL = 'lobby.presence'
+
+def worker_channel(worker):
+    return f"lobby.worker.{worker}"
+
+def on_bus_message(channel, message):
+    if channel == PRESENCE_CHANNEL:
+        uid, worker = message['user'], message['worker']
+        if worker == WORKER: return
+        with users_lock:
+            if message['online']:
+                presence[uid] = worker
+            elif presence.get(uid) == worker:
+                del presence[uid]
+        return
+
+    op = message.get('op')
+    if op == 'deliver':
+        uid = message['user']
+        if message['msg'].get('event') == 'match_found':
+            with match_lock:
+                forwarded_queues.pop(uid, None)
+        with users_lock:
+            conn = online_users.get(uid)
+        if conn:
             try:
-                send_json(online_users[uid], msg)
-            except:
-                pass # Socket dead, will be cleaned up by receive loop
+                conn.send(message['msg'])
+            except OSError:
+                pass
+    elif op == 'queue':
+        enqueue(message['game_id'], message['entry'])
+    elif op == 'leave_queue':
+        with match_lock:
+            remove_from_queue(message['user'])
+    elif op == 'host_start':
+        threading.Thread(target=serve_host_start, args=(message,), daemon=True).start()
+    elif op == 'reply':
+        with bus_calls_lock:
+            entry = bus_calls.get(message['call_id'])
+        if entry:
+            entry[1] = message.get('result')
+            entry[0].set()
+
+bus_calls = {} # {call_id: [Event, result]} awaiting a reply from another worker
+bus_calls_lock = threading.Lock()
+
+def bus_call(worker, op, payload, timeout):
+    # Request/reply over the bus; None on timeout
+    call_id = uuid.uuid4().hex
+    entry = [threading.Event(), None]
+    with bus_calls_lock:
+        bus_calls[call_id] = entry
+    try:
+        db.publish(worker_channel(worker), dict(payload, op=op, call_id=call_id, reply_to=WORKER))
+        entry[0].wait(timeout)
+        return entry[1]
+    finally:
+        with bus_calls_lock:
+            bus_calls.pop(call_id, None)
+
+def bus_reply(message, result):
+    db.publish(worker_channel(message['reply_to']), {"op": "reply", "call_id": message['call_id'], "result": result})
+
+def join_bus():
+    with users_lock:
+        for uid, worker in (db.get('presence', 'players') or {}).items():
+            presence.setdefault(uid, worker)
+    db.subscribe([PRESENCE_CHANNEL, worker_channel(WORKER)], on_bus_message)
+
+# --- Game Catalog ---
+# Game records change only through the dev server. Every worker mirrors the games
+# collection from the DB's WATCH feed, so catalog requests, starts and matchmaking
+# ticks read it from memory, and each change is pushed to the players connected here
+# as a "game_update" event (game None once deleted, game_id None: refetch them all).
+
+def on_games_change(keys, change):
+    if keys is None:
+        push_to_online({"type": "event", "event": "game_update", "game_id": None})
+        return
+    for gid in keys:
+        game = game_catalog.get(gid)
+        if game:
+            summary = rating_summary(db.get('review_stats', gid))
+            game['rating'] = {"average": summary['average'], "count": summary['count']}
+        push_to_online({"type": "event", "event": "game_update", "game_id": gid, "game": game})
+
+def push_to_online(msg):
+    with users_lock:
+        conns = list(online_users.values())
+    for conn in conns:
+        try:
+            conn.send(msg)
+        except OSError:
+            conn.close()
+
+game_catalog = CollectionMirror(db, 'games', on_change=on_games_change)
+
+def cached_game(gid):
+    # The game's record (treat as read-only) or None
+    if not gid: return None
+    if game_catalog.ready.is_set():
+        game = game_catalog.peek(gid)
+    else:
+        game = db.get('games', gid) # The DB was down when the mirror started
+    if game and 'launch' not in game:
+        launch = describe_launch(game['path'], game.get('entry_point', 'game_server.py'))
+        with game_catalog.lock:
+            game['launch'] = launch # Kept on the mirrored record, so it's worked out once
+    return game
+
+def all_games():
+    # {game_id: record}, a private copy
+    if game_catalog.ready.is_set(): return game_catalog.all()
+    return db.get('games') or {}
+
+def backfill_launch_descriptors():
+    # One-time migration for games uploaded before launch descriptors / bytecode were stored,
+    # and for bytecode tags stored for a game directory that isn't there
+    games = db.get('games') or {}
+    missing = {gid: g for gid, g in games.items() if 'launch' not in g or 'bytecode' not in g
+               or (g['bytecode'] and not os.path.isdir(g['path']))}
+    for gid, game in missing.items():
+        game['launch'] = describe_launch(game['path'], game.get('entry_point', 'game_server.py'))
+        game['bytecode'] = precompile_game(game['path'])
+        db.set('games', gid, game)
+    if missing:
+        print(f"[Lobby] Stored launch descriptors for {len(missing)} games")
+
+# --- Room Table ---
+# Rooms live in this process's memory and are written behind to the DB: put()/delete()
+# only mark the room dirty, and a flusher thread sends every ROOM_FLUSH_INTERVAL one
+# MSET per batch holding each dirty room's latest state. A crash loses at most that
+# interval; SIGTERM/SIGINT flush before exiting. Other processes (a restarted lobby,
+# tools) read the DB copy. With several workers the rooms are shared, so the DB stays
+# the only copy and every call goes straight to it.
+ROOM_FLUSH_INTERVAL = 0.25 # Seconds of room changes a crash may lose
+
+class RoomTable:
+    def __init__(self, db, collection='rooms'):
+        self.db = db
+        self.collection = collection
+        self.write_behind = False
+        self.rooms = {}
+        self.dirty = {} # {room_id: room, or None once deleted}
+        self.lock = threading.Lock()       # Guards rooms/dirty; values are replaced, never mutated
+        self.flush_lock = threading.Lock() # One flush at a time, so batches land in order
+
+    def start(self, write_behind):
+        self.write_behind = write_behind
+        if not write_behind: return
+        self.rooms = self.db.get(self.collection) or {}
+        threading.Thread(target=self.run_flusher, daemon=True).start()
+
+    def get(self, rid):
+        # A private copy: change it, then put() it back under the room's lock
+        if not rid: return None
+        if not self.write_behind: return self.db.get(self.collection, rid)
+        with self.lock:
+            room = self.rooms.get(rid)
+        return copy.deepcopy(room)
+
+    def put(self, room):
+        if not self.write_behind:
+            self.db.set(self.collection, room['id'], room)
+            return
+        room = copy.deepcopy(room)
+        with self.lock:
+            self.rooms[room['id']] = room
+            self.dirty[room['id']] = room
+
+    def delete(self, rid):
+        if not self.write_behind:
+            self.db.delete(self.collection, rid)
+            return
+        with self.lock:
+            self.rooms.pop(rid, None)
+            self.dirty[rid] = None
+
+    def all(self):
+        # {room_id: room} snapshot; read-only
+        if not self.write_behind: return self.db.get(self.collection) or {}
+        with self.lock:
+            return dict(self.rooms)
+
+    def count(self):
+        if not self.write_behind: return self.db.count(self.collection)
+        return len(self.rooms)
+
+    def scan(self, cursor=None, count=50, where=None):
+        if not self.write_behind: return self.db.scan(self.collection, cursor, count, where)
+        return scan_page(self.all(), cursor, count, where)
+
+    def flush(self):
+        # Returns how many rooms were written
+        with self.flush_lock:
+            with self.lock:
+                batch, self.dirty = self.dirty, {}
+            ok = not batch or self.db.mset(self.collection, batch)
+            if not ok:
+                # DB unreachable: retry the whole batch next time, newer changes win
+                with self.lock:
+                    for rid, room in batch.items():
+                        self.dirty.setdefault(rid, room)
+                return 0
+            return len(batch)
+
+    def run_flusher(self):
+        while True:
+            time.sleep(ROOM_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[Lobby] Room flush error: {e}")
+
+room_table = RoomTable(db)
+
+# --- Room Lifecycle ---
+# Every room that isn't playing has one expiry timer on a hashed timer wheel.
+# Any change to the room re-arms it in O(1), and the reaper only ever looks at
+# rooms whose timer fired instead of sweeping the whole rooms table.
+WAITING_ROOM_TTL = 1800   # Seconds a waiting room may sit untouched
+IDLE_ROOM_TTL = 600       # Seconds a room may stay idle after a game
+ABANDONED_ROOM_TTL = 60   # Seconds once none of its players is online
+MAX_ROOMS = 1000          # create_room / matchmaking refuse new rooms beyond this
+REAPER_TICK = 1.0
+
+room_timers = TimerWheel(tick=REAPER_TICK)
+
+def room_ttl(room):
+    # None = never expires (a game is starting or running)
+    if room['status'] in ('starting', 'playing'): return None
+    if not any(p in presence for p in room['players']):
+        return ABANDONED_ROOM_TTL
+    return IDLE_ROOM_TTL if room['status'] in ('idle', 'failed') else WAITING_ROOM_TTL
+
+def touch_room(room):
+    # Call before saving a changed room: stamps it and (re)arms its expiry.
+    # The stamp is what counts, so a timer armed by another worker can't expire it early.
+    room['touched'] = time.time()
+    ttl = room_ttl(room)
+    if ttl is None:
+        forget_room(room['id'])
+    else:
+        room_timers.schedule(room['id'], ttl)
+
+def forget_room(rid):
+    room_timers.cancel(rid)
+
+def expire_rooms(rids):
+    expired = []
+    for rid in rids:
+        with hold_rooms(rid):
+            room = room_table.get(rid)
+            if not room: continue
+            ttl = room_ttl(room)
+            if ttl is None: continue # Game started meanwhile
+            remaining = room.get('touched', 0) + ttl - time.time()
+            if remaining > 0:
+                # Touched since, or a player came back online: not due yet
+                room_timers.schedule(rid, remaining)
+                continue
+            room_table.delete(rid)
+            expired.append(room)
+
+    for room in expired:
+        print(f"[Lobby] Room {room['id']} expired ({room['status']}, {len(room['players'])} players)")
+        for p in room['players']:
+            broadcast_to_user(p, {"type": "event", "event": "room_closed", "room_id": room['id'], "reason": "expired"})
+
+def run_room_reaper():
+    last_purge = time.time()
+    while True:
+        time.sleep(REAPER_TICK)
+        try:
+            rids = room_timers.advance()
+            if rids: expire_rooms(rids)
+            if WORKER == 0 and time.time() - last_purge > SESSION_PURGE_INTERVAL:
+                last_purge = time.time()
+                print(f"[Lobby] Purged {sessions.purge_expired()} expired sessions")
+        except Exception as e:
+            print(f"[Lobby] Reaper error: {e}")
+
+def recover_rooms():
+    # Startup. Rooms this worker left starting/playing lost their game process with it: reset them.
+    # Worker 0 also arms expiry for every room, since no timer survived the restart.
+    armed = 0
+    for rid in list(room_table.all()):
+        with hold_rooms(rid):
+            room = room_table.get(rid)
+            if not room: continue
+            if room['status'] in ('starting', 'playing') and room.get('worker', 0) == WORKER:
+                room['status'] = 'idle'
+                clear_game_address(room)
+                room.pop('ready', None)
+                room['last_reason'] = "Lobby restarted"
+            elif WORKER != 0 and room.get('worker') != WORKER:
+                continue
+            touch_room(room)
+            room_table.put(room)
+            armed += 1
+    print(f"[Lobby] Worker {WORKER}: armed expiry for {armed} rooms")
 
 # --- Logic ---
 
-def handle_register(req):
-    username = req.get('username')
-    password = req.get('password')
-    users = db.get('users') or {}
-    players = users.get('players', {})
-    
-    if username in players:
-        return {"status": "error", "message": "User exists"}
-    
-    players[username] = {"pwd": password, "data": {}}
-    users['players'] = players
-    db.update_all('users', users)
-    return {"status": "ok", "message": "Registered successfully"}
-
-def handle_login(req):
-    username = req.get('username')
-    password = req.get('password')
-    users = db.get('users') or {}
-    players = users.get('players', {})
-    
-    if username not in players or players[username]['pwd'] != password:
-        return {"status": "error", "message": "Invalid"}, None
-        
-    token = str(uuid.uuid4())
-    user_data = {"type": "player", "id": username}
-    
-    with lock:
-        active_tokens[token] = user_data
-        
-    return {"status": "ok", "token": token}, user_data
+def handle_register(req, ip):
+    return auth.register(req.get('username'), req.get('password'), ip)
+
+def handle_login(req, ip):
+    return auth.login(req.get('username'), req.get('password'), ip)
 
 def handle_reconnect(req):
-    token = req.get('token')
-    with lock:
-        if token in active_tokens:
-            return {"status": "ok", "message": "Session restored"}, active_tokens[token]
-    return {"status": "error", "message": "Invalid token"}, None
+    return auth.resume(req.get('token'))
+
+def handle_check_versions(req):
+    # Library sync: classify every installed {game_id: version} in one round-trip
+    installed = req.get('versions') or {}
+    # The client removes what is reported deleted, so only a catalog that was actually
+    # read may report it; a failed lookup must not look like an empty catalog
+    if game_catalog.ready.is_set():
+        lookup = game_catalog.peek
+    else:
+        games = db.get('games') # The mirror isn't loaded yet
+        if games is None: return {"status": "error", "message": "Game catalog unavailable"}
+        lookup = games.get
+    stale, deleted, current = [], [], []
+    for gid, version in installed.items():
+        game = lookup(gid)
+        if not game:
+            deleted.append(gid)
+        elif game.get('version') != version:
+            stale.append(gid)
+        else:
+            current.append(gid)
+    return {"status": "ok", "stale": stale, "deleted": deleted, "current": current}
 
 def handle_download_game(req):
     gid = req.get('game_id')
-    games = db.get('games') or {}
-    if gid not in games: return {"status": "error", "message": "Game not found"}
+    game = cached_game(gid)
+    if not game: return {"status": "error", "message": "Game not found"}
     
-    game_path = games[gid]['path']
+    game_path = game['path']
     files = {}
     if os.path.exists(game_path):
         for fname in os.listdir(game_path):
@@ -317,102 +974,132 @@ def handle_download_game(req):
                     files[fname] = f.read()
     return {"status": "ok", "files": files}
 
+def new_room(gid, name, players):
+    rid = str(uuid.uuid4())[:8]
+    return {
+        "id": rid, "name": name, "game_id": gid, 
+        "host": players[0], "players": list(players), 
+        "status": "waiting"
+    }
+
 def handle_create_room(req, user_id):
-    with lock:
-        gid = req.get('game_id')
-        name = req.get('room_name')
-        rid = str(uuid.uuid4())[:8]
-        
-        rooms = db.get('rooms') or {}
-        rooms[rid] = {
-            "id": rid, "name": name, "game_id": gid, 
-            "host": user_id, "players": [user_id], 
-            "status": "waiting"
-        }
+    # Soft cap: creates racing on other rooms' locks may overshoot MAX_ROOMS by a few
+    if room_table.count() >= MAX_ROOMS:
+        return {"status": "error", "message": "Too many rooms, try again later"}
+    room = new_room(req.get('game_id'), req.get('room_name'), [user_id])
+    with hold_rooms(room['id']):
+        touch_room(room)
+        room_table.put(room)
+    return {"status": "ok", "room_id": room['id'], "message": "Created"}
+
+def room_summary(room, max_players):
+    # Compact projection for browsing: counts instead of player lists
+    return {
+        "id": room['id'], "name": room.get('name'), "game_id": room.get('game_id'),
+        "host": room.get('host'), "status": room['status'],
+        "player_count": len(room['players']), "max_players": max_players,
+        "joinable": room['status'] == 'waiting' and len(room['players']) < max_players
+    }
+
+def handle_list_rooms(req):
+    # Filters: game_id, status (one value or a list), joinable. Cursor = last room id seen.
+    limit = max(1, min(int(req.get('limit') or ROOMS_PAGE_SIZE), MAX_ROOMS_PAGE_SIZE))
+    where = {}
+    if req.get('game_id'): where['game_id'] = req['game_id']
+    if req.get('status'): where['status'] = req['status']
+    if req.get('joinable'): where['status'] = 'waiting'
 
-        db.update_all('rooms', rooms)
-        return {"status": "ok", "room_id": rid, "message": "Created"}
+    page, next_cursor = room_table.scan(req.get('cursor'), limit, where)
+
+    max_players = {} # Per distinct game on this page
+    summaries = []
+    for rid, room in page:
+        gid = room.get('game_id')
+        if gid not in max_players:
+            max_players[gid] = int((cached_game(gid) or {}).get('max_players', 2))
+        summary = room_summary(room, max_players[gid])
+        # A full waiting room can't be joined; the page may come back short, the cursor still advances
+        if req.get('joinable') and not summary['joinable']: continue
+        summaries.append(summary)
+
+    return {"status": "ok", "rooms": summaries, "next_cursor": next_cursor}
 
 def handle_leave_room(req, user_id):
-    with lock:
-        rid = req.get('room_id')
-        rooms = db.get('rooms') or {}
-        if rid not in rooms: return {"status": "error", "message": "Room not found"}
+    rid = req.get('room_id')
+    with hold_rooms(rid):
+        room = room_table.get(rid)
+        if not room: return {"status": "error", "message": "Room not found"}
         
-        room = rooms[rid]
         if user_id in room['players']:
             room['players'].remove(user_id)
             
             # If empty, delete
             if len(room['players']) == 0:
-                del rooms[rid]
-                db.update_all('rooms', rooms)
+                room_table.delete(rid)
+                forget_room(rid)
                 return {"status": "ok", "message": "Left and deleted"}
             
             # If Host left, migrate
             if room['host'] == user_id:
                 room['host'] = room['players'][0]
                 
-            db.update_all('rooms', rooms)
+            touch_room(room)
+            room_table.put(room)
             broadcast_room_update(room)
             return {"status": "ok", "message": "Left"}
         
         return {"status": "error", "message": "Not in room"}
 
 def handle_start_game(req, user_id):
-    with lock:
-        rid = req.get('room_id')
-        rooms = db.get('rooms') or {}
-        if rid not in rooms: return {"status": "error", "message": "Room not found"}
+    rid = req.get('room_id')
+    with hold_rooms(rid):
+        room = room_table.get(rid)
+        if not room: return {"status": "error", "message": "Room not found"}
         
-        room = rooms[rid]
         if room['host'] != user_id: return {"status": "error", "message": "Not host"}
-        if room['status'] != 'waiting': return {"status": "error", "message": "Already started"}
+        if room['status'] not in ('waiting', 'idle', 'failed'): return {"status": "error", "message": "Already started"}
         
         # Check player count match
         gid = room['game_id']
-        games = db.get('games') or {}
-        game = games.get(gid, {})
+        game = cached_game(gid) or {}
         max_players = int(game.get('max_players', 2)) # Default 2
         
         if len(room['players']) != max_players:
              return {"status": "error", "message": f"Waiting for players ({len(room['players'])}/{max_players})"}
              
-        # Start
+        # Start: the game server comes up off-lock; players see 'starting', then 'playing'
         print(f"Room {rid} Starting...")
-        if start_game_instance(room):
-            room['status'] = 'playing'
-            db.update_all('rooms', rooms)
-            
-            # Broadcast Game Start explicitly
-            # Though lobby client might Poll or we push
-            # Let's push a specific "game_started" event or just "room_update" with status playing
-            broadcast_room_update(room)
-            return {"status": "ok"}
-        
-        return {"status": "error", "message": "Start failed"}
+        room['status'] = 'starting'
+        room['worker'] = WORKER # Recovers the room if we die before it's placed
+        touch_room(room)
+        room_table.put(room)
+        broadcast_room_update(room)
+
+    start_pool.submit(launch_room, rid)
+    return {"status": "ok", "message": "Starting"}
 
 def handle_join_room(req, user_id):
-    with lock:
-        rid = req.get('room_id')
-        rooms = db.get('rooms') or {}
-        if rid not in rooms: return {"status": "error", "message": "Room not found"}
+    rid = req.get('room_id')
+    with hold_rooms(rid):
+        room = room_table.get(rid)
+        if not room: return {"status": "error", "message": "Room not found"}
         
-        room = rooms[rid]
         if user_id in room['players']: return {"status": "error", "message": "Already in room"}
         
         # Check max players from game metadata
         gid = room['game_id']
-        games = db.get('games') or {}
-        game = games.get(gid, {})
+        game = cached_game(gid) or {}
         max_players = int(game.get('max_players', 2)) # Default 2 if not set
 
-        if len(room['players']) > max_players: 
+        if len(room['players']) >= max_players: 
             return {"status": "error", "message": "Full"}
+        if room['status'] in ('starting', 'playing'):
+            return {"status": "error", "message": "Game in progress"}
         
         room['players'].append(user_id)
+        touch_room(room)
         
-        db.update_all('rooms', rooms)
+        room_table.put(room)
         
         # Broadcast update to room
         broadcast_room_update(room)
@@ -420,129 +1107,903 @@ def handle_join_room(req, user_id):
         return {"status": "ok", "message": "Joined"}
 
 def handle_add_review(req, user_id):
-    with lock:
-        gid = req.get('game_id')
-        reviews = db.get('reviews') or {}
-        if gid not in reviews: reviews[gid] = []
-        
-        reviews[gid].append({
-            "reviewer": user_id,
-            "score": req.get('score'), "comment": req.get('comment')
-        })
-        db.update_all('reviews', reviews)
-        return {"status": "ok", "message": "Review added"}
+    # O(1): append one review and bump the game's running aggregates
+    gid = req.get('game_id')
+    try:
+        score = int(req.get('score'))
+    except (TypeError, ValueError):
+        return {"status": "error", "message": "Invalid score"}
+    if not 1 <= score <= 5: return {"status": "error", "message": "Score must be 1-5"}
 
+    db.rpush('reviews', gid, {"reviewer": user_id, "score": score, "comment": req.get('comment')})
+    db.hincrby('review_stats', gid, {"count": 1, "sum": score, str(score): 1})
+    return {"status": "ok", "message": "Review added"}
 
+def rating_summary(stats):
+    # review_stats/<gid> = {"count", "sum", "1".."5"} -> what clients display
+    stats = stats or {}
+    count = stats.get('count', 0)
+    return {
+        "count": count,
+        "average": round(stats.get('sum', 0) / count, 2) if count else None,
+        "histogram": [stats.get(str(star), 0) for star in range(1, 6)]
+    }
 
-def handle_game_result(req):
-    with lock:
-        rid = req.get('room_id')
+def handle_get_reviews(req):
+    # Newest first. cursor = index just past the next review to return (None = start from newest)
+    gid = req.get('game_id')
+    limit = max(1, min(int(req.get('limit') or REVIEWS_PAGE_SIZE), MAX_REVIEWS_PAGE_SIZE))
+    cursor = req.get('cursor')
+
+    if cursor is None:
+        items, length = db.lrange('reviews', gid, -limit)
+        start = max(0, length - limit)
+    else:
+        cursor = int(cursor)
+        start = max(0, cursor - limit)
+        items, _ = db.lrange('reviews', gid, start, cursor)
+
+    items.reverse()
+    return {
+        "status": "ok",
+        "reviews": items,
+        "next_cursor": start if start > 0 else None,
+        "summary": rating_summary(db.get('review_stats', gid))
+    }
+
+def with_ratings(games):
+    # Catalog carries rating averages from the aggregates, never the review bodies
+    stats = db.get('review_stats') or {}
+    for gid, game in games.items():
+        summary = rating_summary(stats.get(gid))
+        game['rating'] = {"average": summary['average'], "count": summary['count']}
+    return games
+
+def backfill_review_stats():
+    # One-time migration for data written before aggregates existed
+    if db.get('review_stats'): return
+    reviews = db.get('reviews') or {}
+    stats = {}
+    for gid, items in reviews.items():
+        s = stats.setdefault(gid, {"count": 0, "sum": 0})
+        for r in items:
+            try:
+                score = int(r.get('score'))
+            except (TypeError, ValueError):
+                continue
+            s['count'] += 1
+            s['sum'] += score
+            s[str(score)] = s.get(str(score), 0) + 1
+    if stats:
+        db.update_all('review_stats', stats)
+        print(f"[Lobby] Backfilled review stats for {len(stats)} games")
+
+# --- Matchmaking ---
+# Players queue per game instead of browsing rooms. Each tick, entries are
+# grouped into (skill, latency) buckets and every full group becomes a room
+# that is started right away. Entries that have waited WIDEN_AFTER seconds
+# may be matched across buckets so nobody waits forever.
+# With several workers each game's queue lives on one of them (queue_owner);
+# the others forward queue/leave ops to it over the bus.
+MATCH_TICK = 0.5           # Seconds between pairing passes
+SKILL_BUCKET_WIDTH = 200   # Rating points per skill bucket
+LATENCY_BUCKET_MS = 50     # Lobby round-trip ms per latency bucket
+WIDEN_AFTER = 10.0         # Seconds before an entry accepts any bucket
+DEFAULT_RATING = 1000
+RATING_STEP = 25
+
+match_queues = {} # {game_id: [entry]} in arrival order; entry = {"user", "bucket", "joined"}
+queued_users = {} # {user_id: game_id}
+forwarded_queues = {} # {user_id: worker} for users queued on another worker's queue
+match_lock = threading.Lock()
+
+def queue_owner(gid):
+    return zlib.crc32(gid.encode()) % SHARDS
+
+def player_rating(uid):
+    record = db.hget('users', 'players', uid) or {}
+    return record.get('data', {}).get('rating', DEFAULT_RATING)
+
+def handle_queue_for_game(req, user_id):
+    gid = req.get('game_id')
+    if not cached_game(gid): return {"status": "error", "message": "Game not found"}
+
+    try:
+        latency = max(0, int(req.get('latency_ms') or 0))
+    except (TypeError, ValueError):
+        latency = 0
+    bucket = [player_rating(user_id) // SKILL_BUCKET_WIDTH, latency // LATENCY_BUCKET_MS]
+    entry = {"user": user_id, "bucket": bucket, "joined": time.time()}
+
+    leave_queues(user_id)
+    owner = queue_owner(gid)
+    if owner == WORKER:
+        return {"status": "ok", "message": "Queued", "queue_size": enqueue(gid, entry)}
+    with match_lock:
+        forwarded_queues[user_id] = owner
+    db.publish(worker_channel(owner), {"op": "queue", "game_id": gid, "entry": entry})
+    return {"status": "ok", "message": "Queued"}
+
+def enqueue(gid, entry):
+    with match_lock:
+        remove_from_queue(entry['user'])
+        entries = match_queues.setdefault(gid, [])
+        entries.append(entry)
+        queued_users[entry['user']] = gid
+        return len(entries)
+
+def handle_leave_queue(user_id):
+    if leave_queues(user_id):
+        return {"status": "ok", "message": "Left queue"}
+    return {"status": "error", "message": "Not queued"}
+
+def leave_queues(user_id):
+    # Drops the user from a local queue and/or the one they were forwarded to
+    with match_lock:
+        left = remove_from_queue(user_id)
+        owner = forwarded_queues.pop(user_id, None)
+    if owner is not None:
+        db.publish(worker_channel(owner), {"op": "leave_queue", "user": user_id})
+    return left or owner is not None
+
+def remove_from_queue(user_id):
+    # Caller holds match_lock
+    gid = queued_users.pop(user_id, None)
+    if gid is None: return False
+    entries = match_queues.get(gid, [])
+    entries[:] = [e for e in entries if e['user'] != user_id]
+    if not entries: match_queues.pop(gid, None)
+    return True
+
+def form_matches(entries, size, now):
+    # Returns (groups, leftovers). Exact buckets first, then long waiters pooled together.
+    buckets = {}
+    for e in entries:
+        buckets.setdefault(tuple(e['bucket']), []).append(e)
+
+    groups, leftovers = [], []
+    for members in buckets.values():
+        while len(members) >= size:
+            groups.append(members[:size])
+            members = members[size:]
+        leftovers += members
+
+    leftovers.sort(key=lambda e: e['joined'])
+    patient = [e for e in leftovers if now - e['joined'] >= WIDEN_AFTER]
+    while len(patient) >= size:
+        groups.append(patient[:size])
+        patient = patient[size:]
+
+    matched = {e['user'] for g in groups for e in g}
+    return groups, [e for e in leftovers if e['user'] not in matched]
+
+def matchmaking_tick():
+    now = time.time()
+    with match_lock:
+        gids = list(match_queues)
+    formed = []
+    for gid in gids:
+        game = cached_game(gid) or {}
+        size = int(game.get('max_players', 2))
+        with match_lock:
+            groups, rest = form_matches(match_queues.get(gid, []), size, now)
+            if not groups: continue
+            for g in groups:
+                for e in g: queued_users.pop(e['user'], None)
+            if rest:
+                match_queues[gid] = sorted(rest, key=lambda e: e['joined'])
+            else:
+                match_queues.pop(gid, None)
+        formed += [(gid, g) for g in groups]
+
+    for gid, group in formed:
+        start_match(gid, group)
+
+def start_match(gid, group):
+    # Players hear match_found once the game is up (promote_room); a failed start requeues them
+    room = new_room(gid, "Quick Match", [e['user'] for e in group])
+    room.update(matchmade=True, announce_match=True, status='starting', worker=WORKER)
+    if room_table.count() >= MAX_ROOMS:
+        requeue(gid, group)
+        return
+    with hold_rooms(room['id']):
+        room_table.put(room)
+    print(f"[Lobby] Matched {room['players']} into room {room['id']} ({gid}), starting")
+    start_pool.submit(launch_room, room['id'], group)
+
+def requeue(gid, group):
+    # Put everyone back at their original place in line
+    print(f"[Lobby] Match for {gid} failed to start, requeueing {[e['user'] for e in group]}")
+    with match_lock:
+        entries = match_queues.setdefault(gid, [])
+        for e in group:
+            entries.append(e)
+            queued_users[e['user']] = gid
+        entries.sort(key=lambda e: e['joined'])
+
+def run_matchmaker():
+    while True:
+        time.sleep(MATCH_TICK)
+        try:
+            matchmaking_tick()
+        except Exception as e:
+            print(f"[Lobby] Matchmaker error: {e}")
+
+def update_ratings(room, winner):
+    # Winner (by username) gains RATING_STEP, everyone else in the room loses it
+    if winner not in room['players']: return
+    with user_locks.hold(*room['players']):
+        for p in room['players']:
+            record = db.hget('users', 'players', p)
+            if not record: continue
+            data = record.setdefault('data', {})
+            delta = RATING_STEP if p == winner else -RATING_STEP
+            data['rating'] = max(0, data.get('rating', DEFAULT_RATING) + delta)
+            db.hset('users', 'players', p, record)
+
+def legacy_result_allowed(req, addr):
+    # A report on the lobby port must carry the start's control token, or (games that
+    # predate it) come from this machine, where local games run
+    token = control_tokens.get(req.get('room_id'))
+    if req.get('token') is not None:
+        return bool(token) and hmac.compare_digest(str(req['token']), token)
+    return addr[0] in ('127.0.0.1', '::1')
+
+def handle_game_result(req, wait_exit=True):
+    # wait_exit=False: the game is still up waiting for our ack (control channel); it moves
+    # to exiting_games for the monitor to reap.
+    # Applied once per start: the first result flips the room to idle, so a repeat (the
+    # game's legacy fallback after a lost ack) or a report from an earlier start is
+    # acknowledged and ignored.
+    rid = req.get('room_id')
+    proc = None
+    with hold_rooms(rid):
         winner = req.get('winner')
         reason = req.get('reason')
         print(f"[{time.time():.4f}] [Lobby] Game Result: Room {rid}, Winner {winner}, Reason {reason}")
         
-        rooms = db.get('rooms') or {}
-        if rid in rooms:
+        room = room_table.get(rid)
+        token = control_tokens.get(rid)
+        if req.get('token') and token and not hmac.compare_digest(str(req['token']), token):
+            room = None # Sent by the game of an earlier start
+        if room and room['status'] != 'playing':
+            print(f"[Lobby] Ignoring result for room {rid}: not playing ({room['status']})")
+            room = None
+        if room:
+            ch = game_channels.get(rid)
+            record_match(room, reason, req.get('stats') or (ch.stats if ch else None))
+
             # Clean up process if tracked
             if rid in pending_crashes: del pending_crashes[rid]
             
+            # Take the process over from the monitor before the room can be started again
             with running_games_lock:
-                if rid in running_games:
-                    proc = running_games[rid]
-                    # Wait for process to exit to avoid zombie (it should be exiting now as it reported result)
-                    # We can use wait with timeout or just let monitor reap it?
-                    # Better to wait explicitly if we know it's done.
-                    try:
-                        proc.wait(timeout=1) 
-                    except subprocess.TimeoutExpired:
-                        print(f"[Lobby] Warning: Game {rid} process slow to exit after report.")
-                    
-                    if rid in running_games:
-                        del running_games[rid]
-                        print(f"[Lobby] Process for Room {rid} reclaimed.")
+                proc = running_games.pop(rid, None)
+                if proc and not wait_exit:
+                    exiting_games.append((rid, proc, time.time() + REPORTED_EXIT_TIMEOUT))
+            if proc:
+                forget_game(rid) # Before a new start of the room can reuse its slots
+                if not wait_exit: proc = None
 
-            rooms[rid]['status'] = 'idle'
+            room['status'] = 'idle'
             # Reset port? Keep players? 
             # Requirement says: Back to room.
-            rooms[rid].pop('port', None)
+            clear_game_address(room)
             
             # Persist Result for Polling Clients
-            rooms[rid]['last_winner'] = winner
-            rooms[rid]['last_reason'] = reason
+            room['last_winner'] = winner
+            room['last_reason'] = reason
+            update_ratings(room, winner)
+            touch_room(room)
             
             # Broadcast to players
-            for p in rooms[rid]['players']:
+            for p in room['players']:
                 # Notify client to switch view
                 msg = {
                     "type": "event", 
                     "event": "game_over", 
+                    "room_id": rid,
                     "winner": winner,
                     "reason": reason
                 }
                 broadcast_to_user(p, msg)
                 
-            db.update_all('rooms', rooms)
-            
-        return {"status": "ok"}
+            room_table.put(room)
+
+    if proc:
+        # It reported its result, so it should be exiting now; reaped here, off every lock
+        try:
+            proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            print(f"[Lobby] Warning: Game {rid} process slow to exit after report, killing it.")
+            proc.kill()
+            if isinstance(proc, subprocess.Popen): proc.wait()
+        print(f"[Lobby] Process for Room {rid} reclaimed.")
+    return {"status": "ok"}
 
-def supports_room_id_arg(script_path):
+# --- Room Start Pipeline ---
+# waiting/idle/failed -> starting -> playing, or -> failed.
+# start_game only flips the room to 'starting'; launch_room places and spawns the
+# game server on start_pool, off the room's lock, so many rooms start at once.
+# The room goes 'playing' when the game sends game_ready on its control channel
+# (handled on whichever worker owns the game). Games without a control channel
+# are taken as up after LEGACY_READY_DELAY, like before.
+START_WORKERS = 8          # Game starts in flight per worker
+STARTUP_TIMEOUT = 15.0     # Seconds a control-channel game gets to send game_ready
+LEGACY_READY_DELAY = 1.0   # Seconds a game without a control channel gets to bind
+GAME_PLACEMENT_FIELDS = ('port', 'server_ip', 'game_host', 'started', 'launched', 'worker')
+
+start_pool = ThreadPoolExecutor(max_workers=START_WORKERS, thread_name_prefix='room-start')
+starting_games = {} # {room_id: deadline} for games this worker awaits game_ready from
+
+def launch_room(rid, group=None):
+    # group: the matchmaking entries, so a failed quick match can requeue them
     try:
-        with open(script_path, 'r') as f:
-            content = f.read()
-        return "--room_id" in content
-    except OSError:
+        room = room_table.get(rid)
+        if not room or room['status'] != 'starting': return
+        game = cached_game(room['game_id'])
+        room['launched'] = time.time() # Until game_ready: the game's start latency
+        if not game or not start_game_instance(room, game):
+            fail_start(rid, "Start failed", group)
+            return
+
+        legacy = game['launch']['ready'] != 'control'
+        if legacy and not room.get('game_host'):
+            time.sleep(LEGACY_READY_DELAY) # Game hosts wait for it themselves
+            with running_games_lock:
+                proc = running_games.get(rid)
+            if not proc or proc.poll() is not None:
+                fail_start(rid, "Game server exited on startup", group)
+                return
+
+        with hold_rooms(rid):
+            current = room_table.get(rid)
+            if not current or current['status'] != 'starting':
+                return # Deleted or reset meanwhile; the monitor stops the orphaned game
+            for field in GAME_PLACEMENT_FIELDS:
+                if field in room: current[field] = room[field]
+            if legacy or current.get('ready'):
+                promote_room(current)
+            else:
+                room_table.put(current) # game_ready will promote it
+    except Exception as e:
+        print(f"[Lobby] Start of room {rid} failed: {e}")
+        fail_start(rid, "Start failed", group)
+
+def mark_game_ready(rid):
+    starting_games.pop(rid, None)
+    with hold_rooms(rid):
+        room = room_table.get(rid)
+        if not room or room['status'] != 'starting': return
+        if 'port' not in room:
+            room['ready'] = True # Faster than launch_room saving the placement; it promotes
+            room_table.put(room)
+            return
+        promote_room(room)
+
+def promote_room(room):
+    # Caller holds the room's lock
+    room.pop('ready', None)
+    launched = room.pop('launched', None)
+    if launched:
+        db.hincrby('game_stats', room['game_id'], {"starts": 1, "start_seconds": round(time.time() - launched, 3)})
+    room['status'] = 'playing'
+    announce = room.pop('announce_match', False)
+    touch_room(room)
+    room_table.put(room)
+    print(f"[Lobby] Room {room['id']} playing")
+    if announce:
+        for p in room['players']:
+            broadcast_to_user(p, {"type": "event", "event": "match_found", "room": room})
+    broadcast_room_update(room)
+
+def fail_start(rid, reason, group=None):
+    dropped = None
+    with hold_rooms(rid):
+        room = room_table.get(rid)
+        if not room or room['status'] != 'starting': return
+        print(f"[Lobby] Room {rid} failed to start: {reason}")
+        if room.get('announce_match'):
+            # A quick match nobody has heard of yet: drop the room
+            dropped = room
+            room_table.delete(rid)
+            forget_room(rid)
+        else:
+            room['status'] = 'failed'
+            room['last_reason'] = reason
+            room.pop('ready', None)
+            clear_game_address(room)
+            touch_room(room)
+            room_table.put(room)
+            broadcast_room_update(room)
+    if dropped and group:
+        requeue(dropped['game_id'], group)
+    elif dropped:
+        for p in dropped['players']:
+            broadcast_to_user(p, {"type": "event", "event": "match_failed", "game_id": dropped['game_id'], "reason": reason})
+
+# --- Game Control Channel ---
+# Game servers keep one connection to the worker that started them
+# (127.0.0.1:CONTROL_PORT + WORKER, passed in GAMESTORE_CONTROL) and send
+# newline-framed JSON on it: game_ready, heartbeat, game_result. The first message
+# carries room_id + the per-game token (GAMESTORE_CONTROL_TOKEN).
+# One selector thread serves all of them; results go to a single result thread.
+# Games on a game host talk to the host agent, which relays over its lobby connection.
+# The old one-shot unframed report on the lobby port still works.
+CONTROL_PORT = 10200
+MAX_CONTROL_LINE = 65536
+
+control_tokens = {} # {room_id: token} for games started by this worker
+game_channels = {} # {room_id: GameChannel / RelayedChannel}
+result_queue = queue.Queue()
+
+class GameChannel:
+    """One game server's control connection (non-blocking socket)."""
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = b''
+        self.room_id = None
+        self.token = None # The start's control token, once authenticated
+        self.ready = False
+        self.done = False # Result delivered (or given up on): heartbeats no longer expected
+        self.stats = {} # Latest play counters the game sent (ticks, messages, bytes)
+        self.last_seen = time.time()
+        self.send_lock = threading.Lock()
+
+    def send(self, msg):
+        # Only small acks go this way; a game that can't take them loses them
+        try:
+            with self.send_lock:
+                self.sock.send((json.dumps(msg) + '\n').encode())
+        except OSError:
+            pass
+
+class RelayedChannel:
+    """Control state of a game that talks through its game host."""
+    def __init__(self, host_id):
+        self.host_id = host_id
+        self.room_id = None
+        self.token = None
+        self.ready = False
+        self.done = False
+        self.stats = {}
+        self.last_seen = time.time()
+
+    def send(self, msg):
+        pass # The host agent has acked already
+
+def handle_control_message(ch, msg):
+    # Returns False to drop the connection
+    rid = msg.get('room_id') or ch.room_id
+    if ch.room_id is None:
+        token = control_tokens.get(rid)
+        if not token or not hmac.compare_digest(str(msg.get('token') or ''), token):
+            print(f"[Lobby] Control: bad token for room {rid}")
+            return False
+        ch.room_id = rid
+        ch.token = token
+        game_channels[rid] = ch
+    elif rid != ch.room_id:
         return False
 
-def start_game_instance(room):
+    ch.last_seen = time.time()
+    if isinstance(msg.get('stats'), dict):
+        ch.stats = msg['stats']
+    action = msg.get('action')
+    if action == 'game_ready':
+        ch.ready = True
+        print(f"[Lobby] Control: room {rid} game server ready")
+        result_queue.put((dict(msg, room_id=rid), ch)) # Promotion takes the room's lock: not on this thread
+    elif action == 'game_result':
+        ch.done = True
+        result_queue.put((dict(msg, room_id=rid, token=ch.token), ch))
+    return True
+
+class ControlServer:
+    """Selector loop for every game control connection of this worker."""
+    def __init__(self, port):
+        self.sel = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', port))
+        self.listener.listen(64)
+        self.listener.setblocking(False)
+        self.sel.register(self.listener, selectors.EVENT_READ, None)
+
+    def serve_forever(self):
+        while True:
+            for key, _ in self.sel.select():
+                if key.data is None:
+                    self._accept()
+                else:
+                    self._read(key.data)
+
+    def _accept(self):
+        try:
+            sock, _ = self.listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        self.sel.register(sock, selectors.EVENT_READ, GameChannel(sock))
+
+    def _read(self, ch):
+        try:
+            data = ch.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(ch)
+            return
+        ch.buf += data
+        while b'\n' in ch.buf:
+            line, ch.buf = ch.buf.split(b'\n', 1)
+            if not line.strip(): continue
+            try:
+                msg = json.loads(line)
+            except ValueError:
+                msg = None
+            if not isinstance(msg, dict) or not handle_control_message(ch, msg):
+                self._close(ch)
+                return
+        if len(ch.buf) > MAX_CONTROL_LINE:
+            self._close(ch)
+
+    def _close(self, ch):
+        # An authenticated channel stays in game_channels: if the game is still running
+        # without having sent its result, its heartbeat runs out and the monitor kills it
+        self.sel.unregister(ch.sock)
+        ch.sock.close()
+
+def forget_game(rid):
+    # The game process is gone: its token, channel state and usage go with it
+    control_tokens.pop(rid, None)
+    game_channels.pop(rid, None)
+    starting_games.pop(rid, None)
+    usage = game_usage.pop(rid, None)
+    if usage:
+        print(f"[Lobby] Room {rid} game used {usage['cpu_seconds']}s CPU, peak {usage['peak_rss_mb']} MB")
+        db.hdel('presence', 'usage', rid)
+
+def process_results():
+    # Single consumer for readiness and results from every control channel
+    while True:
+        msg, ch = result_queue.get()
+        if msg.get('action') == 'game_ready':
+            try:
+                mark_game_ready(msg['room_id'])
+            except Exception as e:
+                print(f"[Lobby] Ready error: {e}")
+            continue
+        try:
+            resp = handle_game_result(msg, wait_exit=False)
+        except Exception as e:
+            print(f"[Lobby] Result error: {e}")
+            resp = {"status": "error", "message": str(e)}
+        ch.send(resp)
+
+# --- Game Hosts ---
+# Game servers can run on other machines: server/game_host.py registers over an
+# ordinary lobby connection and reports its load. start_game_instance places each
+# game on the least-loaded host and only spawns locally when no host can take it.
+# Hosts are listed in presence/hosts (DB) so any worker can place on any of them;
+# the start command itself goes through the worker holding the host's connection.
+GAME_HOST_SECRET = os.environ.get('GAME_HOST_SECRET', '') # Unset: only loopback hosts may register
+HOST_COMMAND_TIMEOUT = 10.0 # Seconds for a host to get a game running
+HOST_STALE_AFTER = 10.0     # Seconds without a status report before a host is skipped
+
+class HostLink:
+    """A registered game host's connection, held by the worker it connected to."""
+    def __init__(self, host_id, conn):
+        self.host_id = host_id
+        self.conn = conn
+        self.pending = {} # {cmd_id: [Event, reply]}
+        self.lock = threading.Lock()
+
+    def command(self, cmd, timeout=HOST_COMMAND_TIMEOUT, **args):
+        cmd_id = uuid.uuid4().hex
+        entry = [threading.Event(), None]
+        with self.lock:
+            self.pending[cmd_id] = entry
+        try:
+            self.conn.send(dict(args, type="command", cmd=cmd, cmd_id=cmd_id))
+            entry[0].wait(timeout)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.pending.pop(cmd_id, None)
+        return entry[1]
+
+    def resolve(self, cmd_id, reply):
+        with self.lock:
+            entry = self.pending.get(cmd_id)
+        if entry:
+            entry[1] = reply
+            entry[0].set()
+
+class RemoteProcess:
+    """Stands in for a Popen in running_games when the game runs on a game host."""
+    def __init__(self, host_id, room_id):
+        self.host_id = host_id
+        self.room_id = room_id
+        self.returncode = None
+        self.exited = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self.exited.wait(timeout):
+            raise subprocess.TimeoutExpired(f"game on {self.host_id}", timeout)
+        return self.returncode
+
+    def kill(self):
+        # The host reports the exit (host_game_exit) once the process is gone
+        with hosts_lock:
+            link = game_hosts.get(self.host_id)
+        if link:
+            threading.Thread(target=link.command, args=('stop',), kwargs={"room_id": self.room_id}, daemon=True).start()
+
+    def finish(self, code):
+        self.returncode = code
+        self.exited.set()
+
+game_hosts = {} # {host_id: HostLink} connected to this worker
+hosts_lock = threading.Lock()
+
+def handle_register_host(req, user_session, conn):
+    secret = req.get('secret') or ''
+    if GAME_HOST_SECRET:
+        allowed = hmac.compare_digest(secret, GAME_HOST_SECRET)
+    else:
+        allowed = conn.addr[0] in ('127.0.0.1', '::1')
+    host_id = req.get('host_id')
+    if not allowed or not host_id:
+        return {"status": "error", "message": "Host not allowed"}, user_session
+
+    with hosts_lock:
+        game_hosts[host_id] = HostLink(host_id, conn)
+    db.hset('presence', 'hosts', host_id, {
+        "address": req.get('address') or conn.addr[0], # What clients connect to
+        "worker": WORKER,
+        "capacity": max(1, int(req.get('capacity') or 1)),
+        "running": 0, "cpu": 0.0, "free_ports": int(req.get('free_ports') or 1),
+        "seen": time.time()
+    })
+    print(f"[Lobby] Game host {host_id} registered from {conn.addr[0]}")
+    return {"status": "ok", "message": "Host registered"}, {"type": "host", "id": host_id}
+
+def handle_host_message(req, host_id):
+    action = req.get('action')
+    if action == 'host_status':
+        for rid, usage in (req.get('games') or {}).items():
+            if isinstance(running_games.get(rid), RemoteProcess) and usage:
+                record_usage(rid, usage)
+        record = db.hget('presence', 'hosts', host_id)
+        if record:
+            record.update(running=int(req.get('running', 0)), cpu=float(req.get('cpu', 0.0)),
+                          free_ports=int(req.get('free_ports', 0)), seen=time.time())
+            db.hset('presence', 'hosts', host_id, record)
+    elif action == 'host_reply':
+        with hosts_lock:
+            link = game_hosts.get(host_id)
+        if link: link.resolve(req.get('cmd_id'), req)
+    elif action == 'host_game_exit':
+        rid = req.get('room_id')
+        with running_games_lock:
+            # An exiting game of the room goes first: it is the older one
+            procs = [proc for r, proc, _ in exiting_games if r == rid] + [running_games.get(rid)]
+        for proc in procs:
+            if isinstance(proc, RemoteProcess) and proc.host_id == host_id and proc.poll() is None:
+                proc.finish(req.get('code'))
+                break
+    elif action == 'host_control':
+        # A game's control message relayed by its host (the host acks the game itself)
+        msg = req.get('message') or {}
+        ch = game_channels.get(msg.get('room_id'))
+        if not isinstance(ch, RelayedChannel) or ch.host_id != host_id:
+            ch = RelayedChannel(host_id)
+        if not handle_control_message(ch, msg):
+            return {"status": "error", "message": "Rejected"}
+    return {"status": "ok"}
+
+def drop_game_host(host_id, conn):
+    with hosts_lock:
+        link = game_hosts.get(host_id)
+        if not link or link.conn is not conn: return # Re-registered on a new connection
+        del game_hosts[host_id]
+    db.hdel('presence', 'hosts', host_id)
+    # Its games are unreachable now; the monitor resets their rooms after the grace period
+    with running_games_lock:
+        lost = [p for p in running_games.values() if isinstance(p, RemoteProcess) and p.host_id == host_id]
+    for proc in lost:
+        proc.finish(-1)
+    print(f"[Lobby] Game host {host_id} disconnected ({len(lost)} games lost)")
+
+def rank_game_hosts():
+    # Hosts with room, least loaded first (running/capacity, then CPU)
+    now = time.time()
+    hosts = db.get('presence', 'hosts') or {}
+    candidates = [(hid, h) for hid, h in hosts.items()
+                  if now - h.get('seen', 0) < HOST_STALE_AFTER
+                  and h['running'] < h['capacity'] and h.get('free_ports', 0) > 0]
+    return sorted(candidates, key=lambda c: (c[1]['running'] / c[1]['capacity'], c[1].get('cpu', 0.0)))
+
+def run_on_host(host_id, args):
+    # On the worker holding the host's connection
+    with hosts_lock:
+        link = game_hosts.get(host_id)
+    if not link: return None
+    control = args.pop('control', False)
+    retire_game(args['room_id'])
+    control_tokens[args['room_id']] = args['control_token']
+    if control: starting_games[args['room_id']] = time.time() + HOST_COMMAND_TIMEOUT + STARTUP_TIMEOUT
+    reply = link.command('start', **args)
+    if reply and reply.get('status') == 'ok':
+        with running_games_lock:
+            running_games[args['room_id']] = RemoteProcess(host_id, args['room_id'])
+    else:
+        control_tokens.pop(args['room_id'], None)
+        starting_games.pop(args['room_id'], None)
+    return reply
+
+def serve_host_start(message):
+    bus_reply(message, run_on_host(message['host_id'], message['args']))
+
+def start_on_host(host_id, host, room, game):
+    launch = game['launch']
+    args = {"room_id": room['id'], "game_id": room['game_id'], "version": game.get('version'),
+            "entry_point": launch['entry_point'], "launch": launch, "control_token": uuid.uuid4().hex,
+            "resources": game.get('resources'), # The host applies its own GAME_CPUS
+            "control": launch['ready'] == 'control'} # Owner awaits game_ready
+    if host['worker'] == WORKER:
+        reply = run_on_host(host_id, args)
+    else:
+        reply = bus_call(host['worker'], 'host_start', {"host_id": host_id, "args": args}, HOST_COMMAND_TIMEOUT + 1)
+    if not reply or reply.get('status') != 'ok':
+        print(f"[Lobby] Host {host_id} could not start room {room['id']}: {(reply or {}).get('message', 'no reply')}")
+        return False
+
+    host['running'] += 1 # Until its next status report
+    db.hset('presence', 'hosts', host_id, host)
+    room['port'] = reply['port']
+    room['server_ip'] = host['address']
+    room['game_host'] = host_id
+    room['worker'] = host['worker']
+    print(f"Game {room['game_id']} started on {host_id} ({host['address']}:{reply['port']})")
+    return True
+
+def clear_game_address(room):
+    for field in ('port', 'server_ip', 'game_host', 'started', 'launched'):
+        room.pop(field, None)
+
+def start_game_instance(room, game):
+    # Fills in the room's placement fields; runs off-lock (launch_room)
+    started = any(start_on_host(host_id, host, room, game) for host_id, host in rank_game_hosts())
+    if started or spawn_local_game(room, game):
+        room['started'] = time.time() # Match duration for accounting
+        return True
+    return False
+
+def spawn_local_game(room, game):
+    # Fallback: run the game server on the lobby's own machine
+    gid = room['game_id']
     # Find free port
     s = socket.socket()
     s.bind(('', 0))
     port = s.getsockname()[1]
     s.close()
     
-    gid = room['game_id']
-    games = db.get('games') or {}
-    game = games.get(gid)
-    if not game: return False
-    
-    script = os.path.join(game['path'], game.get('entry_point', 'game_server.py'))
+    launch = game['launch']
     try:
-        # Standard: python3 game_server.py --port <port> --room_id <room_id> --lobby_port <lobby_port>
-        cmd = [sys.executable, script, "--port", str(port), "--lobby_port", str(PORT)]
-        if supports_room_id_arg(script):
-            cmd += ["--room_id", room['id']]
+        # Standard: python3 game_server.py --port <port> --lobby_port <lobby_port> [--room_id <room_id>]
+        cmd = launch_command(launch, game['path'], port=port, lobby_port=PORT, room_id=room['id'])
         
-        proc = subprocess.Popen(cmd, cwd=game['path'])
+        token = uuid.uuid4().hex
+        retire_game(room['id'])
+        control_tokens[room['id']] = token
+        if launch['ready'] == 'control':
+            starting_games[room['id']] = time.time() + STARTUP_TIMEOUT
+        env = dict(os.environ, GAMESTORE_CONTROL=f"127.0.0.1:{CONTROL_PORT + WORKER}", GAMESTORE_CONTROL_TOKEN=token)
+        proc = subprocess.Popen(cmd, cwd=game['path'], env=env)
+        apply_resource_profile(proc.pid, resource_profile(game.get('resources'), GAME_CPUS))
         
         with running_games_lock:
             running_games[room['id']] = proc
         
-        # Give it a second to bind
-        import time
-        time.sleep(1)
-        
         room['port'] = port
+        room['worker'] = WORKER # Whose running_games tracks the process
         print(f"Game {gid} started on port {port}")
         return True
     except Exception as e:
         print(f"Start Error: {e}")
+        forget_game(room['id'])
         return False
 
 def start_server():
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    room_locks.configure(owner, shared=SHARDS > 1)
+    user_locks.configure(owner, shared=SHARDS > 1)
+
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if SHARDS > 1:
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1) # Kernel spreads accepts over workers
     server.bind((HOST, PORT))
     server.listen(5)
-    print(f"[Lobby] Listening on {HOST}:{PORT}")
+    print(f"[Lobby] Listening on {HOST}:{PORT} (worker {WORKER}/{SHARDS})")
+
+    game_catalog.start()
+    if SHARDS > 1: join_bus()
+
+    if WORKER == 0:
+        backfill_review_stats()
+        backfill_launch_descriptors()
+    room_table.start(write_behind=SHARDS == 1)
+    recover_rooms()
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
     
     # Start Monitor Thread
     t_mon = threading.Thread(target=monitor_game_processes, daemon=True)
     t_mon.start()
+
+    t_match = threading.Thread(target=run_matchmaker, daemon=True)
+    t_match.start()
+
+    t_reap = threading.Thread(target=run_room_reaper, daemon=True)
+    t_reap.start()
+
+    control = ControlServer(CONTROL_PORT + WORKER)
+    threading.Thread(target=control.serve_forever, daemon=True).start()
+    threading.Thread(target=process_results, daemon=True).start()
     
     while True:
         client, addr = server.accept()
         t = threading.Thread(target=handle_client, args=(client, addr))
         t.start()
 
+def shutdown(signum, frame):
+    # Clean stop: nothing written behind is lost. Game servers keep running, as before.
+    print(f"[Lobby] Worker {WORKER} stopping, flushed {room_table.flush()} rooms")
+    auth.hasher.close()
+    os._exit(0)
+
+def run_workers(first, count):
+    # Supervisor: one lobby process per worker index, restarted if it dies
+    if first == 0:
+        db.update_all('presence', {}) # Nobody is connected yet
+    procs = {}
+    def spawn(i):
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', str(i), '--shards', str(SHARDS)]
+        procs[i] = subprocess.Popen(cmd)
+    for i in range(first, first + count):
+        spawn(i)
+    print(f"[Lobby] Supervising workers {first}..{first + count - 1} of {SHARDS}")
+    try:
+        while True:
+            time.sleep(1.0)
+            for i, proc in list(procs.items()):
+                if proc.poll() is not None:
+                    print(f"[Lobby] Worker {i} exited with code {proc.returncode}, restarting")
+                    spawn(i)
+    except KeyboardInterrupt:
+        for proc in procs.values():
+            proc.terminate()
+
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description='Lobby Server')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes on this node, sharing PORT')
+    parser.add_argument('--shards', type=int, default=0, help='Workers across all nodes (default: --workers)')
+    parser.add_argument('--first_worker', type=int, default=0, help="Index of this node's first worker")
+    parser.add_argument('--worker', type=int, help=argparse.SUPPRESS) # Set by the supervisor
+    args = parser.parse_args()
+
+    SHARDS = max(1, args.shards or args.workers)
+    if args.worker is None and args.workers > 1:
+        run_workers(args.first_worker, args.workers)
+    else:
+        WORKER = args.first_worker if args.worker is None else args.worker
+        start_server()
@@ -0,0 +1,146 @@
+import itertools
+import json
+import mmap
+import struct
+import zlib
+from array import array
+
+# Binary snapshot of one DB collection (<collection>.snap):
+#   header  MAGIC, u16 version, u16 flags, u64 record count
+#   values  compact JSON per record, back to back
+#   index   JSON array of the keys, then a u32 byte length per value
+#   footer  u64 index offset, u64 key array length, u32 crc32 of the values,
+#           u32 crc32 of the index, MAGIC
+# Opening a snapshot reads only the index; values stay in the (memory-mapped) file
+# until they are used. Such a value is held as a (Snapshot, offset, length) tuple,
+# which JSON never decodes to, so callers can tell it apart from a real value.
+
+MAGIC = b'GSNP'
+VERSION = 1
+HEADER = struct.Struct('<4sHHQ')
+FOOTER = struct.Struct('<QQII4s')
+
+class SnapshotError(Exception):
+    pass
+
+def is_stored(value):
+    return type(value) is tuple
+
+def load_value(ref):
+    snap, offset, length = ref
+    return json.loads(snap.mm[offset:offset + length])
+
+def raw_value(value):
+    # The value's JSON bytes, straight from the file when it was never decoded
+    if type(value) is tuple:
+        snap, offset, length = value
+        return snap.mm[offset:offset + length]
+    return json.dumps(value, separators=(',', ':')).encode()
+
+def encode(items):
+    # The whole file for {key: value} (values may still be stored refs)
+    keys = list(items)
+    values = [raw_value(items[k]) for k in keys]
+    lengths = array('I', map(len, values))
+    data = b''.join(values)
+    key_array = json.dumps(keys, separators=(',', ':')).encode()
+    index = key_array + lengths.tobytes()
+    index_offset = HEADER.size + len(data)
+    return b''.join([
+        HEADER.pack(MAGIC, VERSION, 0, len(keys)),
+        data,
+        index,
+        FOOTER.pack(index_offset, len(key_array), zlib.crc32(data), zlib.crc32(index), MAGIC),
+    ])
+
+def parse(buf, name):
+    # Checks a whole snapshot in buf; returns (keys, lengths)
+    size = len(buf)
+    if size < HEADER.size + FOOTER.size:
+        raise SnapshotError(f"{name}: truncated")
+    magic, version, _, count = HEADER.unpack_from(buf, 0)
+    index_offset, keys_len, data_crc, index_crc, end_magic = FOOTER.unpack_from(buf, size - FOOTER.size)
+    if magic != MAGIC or end_magic != MAGIC:
+        raise SnapshotError(f"{name}: not a snapshot, or truncated")
+    if version != VERSION:
+        raise SnapshotError(f"{name}: unsupported version {version}")
+    if not HEADER.size <= index_offset <= size - FOOTER.size:
+        raise SnapshotError(f"{name}: bad index offset")
+    with memoryview(buf) as view:
+        index = view[index_offset:size - FOOTER.size]
+        if zlib.crc32(index) != index_crc or zlib.crc32(view[HEADER.size:index_offset]) != data_crc:
+            raise SnapshotError(f"{name}: checksum mismatch")
+        keys = json.loads(bytes(index[:keys_len]))
+        lengths = array('I')
+        lengths.frombytes(index[keys_len:])
+        index.release()
+    if len(keys) != count or len(lengths) != count:
+        raise SnapshotError(f"{name}: index does not match the record count")
+    return keys, lengths
+
+class Snapshot:
+    """A snapshot file opened read-only; items() gives {key: stored ref}."""
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            try:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise SnapshotError(f"{path}: empty file")
+        self.keys, self.lengths = parse(self.mm, path)
+        self.count = len(self.keys)
+        # The checksum pass touched every page; let them go until values are read
+        if hasattr(self.mm, 'madvise'): self.mm.madvise(mmap.MADV_DONTNEED)
+
+    def items(self):
+        offsets = itertools.accumulate(self.lengths, initial=HEADER.size)
+        return dict(zip(self.keys, zip(itertools.repeat(self), offsets, self.lengths)))
+
+def read_all(path):
+    # {key: value}, fully decoded (tools, restores)
+    snap = Snapshot(path)
+    return {k: load_value(ref) for k, ref in snap.items().items()}
+
+# Backup file (SNAPSHOT command): every collection at one point in time.
+#   header  BACKUP_MAGIC, u16 version, u16 flags, u64 seq, u32 collection count
+#   then per collection: u16 name length, name, u64 snapshot length, the snapshot
+#   trailer BACKUP_MAGIC
+BACKUP_MAGIC = b'GSBK'
+BACKUP_HEADER = struct.Struct('<4sHHQI')
+BACKUP_ENTRY = struct.Struct('<HQ')
+
+def write_backup(f, collections, seq):
+    # Streams {name: items} to an open binary file, one collection in memory at a time
+    f.write(BACKUP_HEADER.pack(BACKUP_MAGIC, VERSION, 0, seq, len(collections)))
+    for name, items in collections.items():
+        blob = encode(items)
+        f.write(BACKUP_ENTRY.pack(len(name.encode()), len(blob)))
+        f.write(name.encode())
+        f.write(blob)
+    f.write(BACKUP_MAGIC)
+
+def read_backup(path):
+    # (seq, [(name, snapshot bytes view)]); the views point into a mmap of the file
+    with open(path, 'rb') as f:
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise SnapshotError(f"{path}: empty file")
+    if len(mm) < BACKUP_HEADER.size + len(BACKUP_MAGIC):
+        raise SnapshotError(f"{path}: truncated")
+    magic, version, _, seq, count = BACKUP_HEADER.unpack_from(mm, 0)
+    if magic != BACKUP_MAGIC or mm[-len(BACKUP_MAGIC):] != BACKUP_MAGIC:
+        raise SnapshotError(f"{path}: not a backup, or truncated")
+    if version != VERSION:
+        raise SnapshotError(f"{path}: unsupported version {version}")
+    view, pos, entries = memoryview(mm), BACKUP_HEADER.size, []
+    for _ in range(count):
+        if pos + BACKUP_ENTRY.size > len(mm): raise SnapshotError(f"{path}: truncated")
+        name_len, blob_len = BACKUP_ENTRY.unpack_from(mm, pos)
+        pos += BACKUP_ENTRY.size
+        name = bytes(view[pos:pos + name_len]).decode()
+        pos += name_len
+        if pos + blob_len > len(mm) - len(BACKUP_MAGIC): raise SnapshotError(f"{path}: truncated")
+        entries.append((name, view[pos:pos + blob_len]))
+        pos += blob_len
+    return seq, entries
@@ -1,6 +1,21 @@
+import compileall
+import contextlib
+import copy
+import heapq
 import json
+import os
 import struct
 import socket
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+try:
+    import resource
+except ImportError: # Not available on Windows; games then run unlimited
+    resource = None
 
 def send_json(sock, data):
     msg = json.dumps(data) + '\n'
@@ -26,21 +41,273 @@ def recvall(sock, n):
         data += packet
     return data
 
+def _script_mentions(script_path, marker):
+    try:
+        with open(script_path, 'r') as f:
+            return marker in f.read()
+    except OSError:
+        return False
+
+def supports_room_id_arg(script_path):
+    # Older game servers don't accept --room_id
+    return _script_mentions(script_path, "--room_id")
+
+def uses_control_channel(script_path):
+    # Games that open the lobby control channel announce themselves with game_ready
+    return _script_mentions(script_path, "GAMESTORE_CONTROL")
+
+# Launch descriptor: how to start a game's server, worked out once when the game is
+# uploaded (dev_server) and stored in its record as "launch", so starting a match
+# reads no game files. "{port}", "{lobby_port}" and "{room_id}" are filled per start.
+# ready: "control" = the game sends game_ready; "delay" = assume up after a short wait.
+def describe_launch(game_dir, entry_point='game_server.py'):
+    script = os.path.join(game_dir, entry_point)
+    args = ["--port", "{port}", "--lobby_port", "{lobby_port}"]
+    if supports_room_id_arg(script):
+        args += ["--room_id", "{room_id}"]
+    launch = {
+        "interpreter": "python3", # Whatever python runs the lobby / game host
+        "entry_point": entry_point,
+        "args": args,
+        "ready": "control" if uses_control_channel(script) else "delay"
+    }
+    # A script run by path is always compiled from source; run as a module (-m, from
+    # the game's directory) its bytecode comes from __pycache__ like any import
+    module, ext = os.path.splitext(entry_point)
+    if ext == '.py' and module.isidentifier() and module not in getattr(sys, 'stdlib_module_names', ()):
+        launch['module'] = module
+    return launch
+
+def launch_command(launch, game_dir, **values):
+    # argv for one start; game_dir is where this machine keeps the game's files (and the cwd)
+    if launch.get('module'):
+        cmd = [sys.executable, "-m", launch['module']]
+    else:
+        cmd = [sys.executable, os.path.join(game_dir, launch['entry_point'])]
+    return cmd + [a.format(**values) for a in launch['args']]
+
+def precompile_game(game_dir):
+    # Byte-compile the game's sources into its __pycache__ (one file per interpreter
+    # version) so launches skip compiling. Returns the cache tag, or None when nothing
+    # was compiled (missing directory, no sources, read-only directory, syntax error);
+    # the game then compiles on every start.
+    try:
+        sources = [f for f in os.listdir(game_dir) if f.endswith('.py')]
+        ok = bool(sources) and compileall.compile_dir(game_dir, maxlevels=0, quiet=2)
+    except OSError:
+        ok = False
+    return sys.implementation.cache_tag if ok else None
+
+def measure_cold_start(launch, game_dir, timeout=10.0, env=None, profile=None):
+    # Seconds from spawn until the game server accepts connections, None if it never does.
+    # Runs without a control channel, so the game comes up as if for a legacy lobby,
+    # under `profile` (resource_profile) like a real launch: it is untrusted game code.
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    env = {k: v for k, v in dict(os.environ, **(env or {})).items() if not k.startswith('GAMESTORE_CONTROL')}
+    cmd = launch_command(launch, game_dir, port=port, lobby_port=0, room_id="cold-start")
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=game_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if profile: apply_resource_profile(proc.pid, profile)
+    try:
+        while time.perf_counter() - t0 < timeout and proc.poll() is None:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+                return time.perf_counter() - t0
+            except OSError:
+                time.sleep(0.005)
+        return None
+    finally:
+        proc.kill()
+        proc.wait()
+
+# --- Game process limits ---
+# A game's metadata may carry "resources" (any subset of DEFAULT_GAME_RESOURCES).
+# Values are clamped to MAX_GAME_RESOURCES so an upload can't opt out of isolation.
+DEFAULT_GAME_RESOURCES = {
+    "cpu_seconds": 900, # RLIMIT_CPU: SIGXCPU once the game has burnt this much CPU time
+    "memory_mb": 512,   # RLIMIT_AS (address space, the enforceable stand-in for RSS)
+    "open_files": 256,  # RLIMIT_NOFILE
+    "nice": 10,         # Below the lobby, which stays at its own priority
+    "cpus": None        # Optional list of CPU indices to pin to
+}
+MAX_GAME_RESOURCES = {"cpu_seconds": 3600, "memory_mb": 2048, "open_files": 1024}
+
+def parse_cpu_list(spec):
+    # "0,2-3" -> {0, 2, 3}; empty -> None (no restriction)
+    cpus = set()
+    for part in filter(None, (p.strip() for p in (spec or '').split(','))):
+        lo, _, hi = part.partition('-')
+        cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus or None
+
+def resource_profile(requested, allowed_cpus=None):
+    # Effective limits for one game: its request over the defaults, clamped.
+    # allowed_cpus (e.g. from GAME_CPUS) keeps games off cores reserved for the lobby.
+    profile = dict(DEFAULT_GAME_RESOURCES)
+    for key, value in (requested if isinstance(requested, dict) else {}).items():
+        if key in profile and value is not None:
+            profile[key] = value
+    for key, default in DEFAULT_GAME_RESOURCES.items():
+        if key == 'cpus': continue
+        try:
+            profile[key] = int(profile[key])
+        except (TypeError, ValueError):
+            profile[key] = default
+    for key, ceiling in MAX_GAME_RESOURCES.items():
+        profile[key] = max(1, min(profile[key], ceiling))
+    profile['nice'] = max(0, min(profile['nice'], 19))
+
+    usable = set(allowed_cpus or (os.sched_getaffinity(0) if hasattr(os, 'sched_getaffinity') else range(os.cpu_count() or 1)))
+    wanted = profile['cpus']
+    if isinstance(wanted, list) and all(isinstance(c, int) for c in wanted):
+        profile['cpus'] = sorted(usable & set(wanted)) or sorted(usable)
+    else:
+        profile['cpus'] = sorted(usable) if allowed_cpus else None
+    return profile
+
+def apply_resource_profile(pid, profile):
+    # Called by the parent right after Popen. prlimit/setpriority/sched_setaffinity on
+    # the child are safe in our threaded servers, unlike doing it in a preexec_fn.
+    if resource is None: return
+    try:
+        cpu, mem = profile['cpu_seconds'], profile['memory_mb'] * 1024 * 1024
+        resource.prlimit(pid, resource.RLIMIT_CPU, (cpu, cpu + 5)) # Hard limit: SIGKILL
+        resource.prlimit(pid, resource.RLIMIT_AS, (mem, mem))
+        resource.prlimit(pid, resource.RLIMIT_NOFILE, (profile['open_files'], profile['open_files']))
+        os.setpriority(os.PRIO_PROCESS, pid, max(profile['nice'], os.getpriority(os.PRIO_PROCESS, 0)))
+        if profile['cpus'] and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(pid, profile['cpus'])
+    except (OSError, ValueError) as e:
+        print(f"[Limits] Could not limit pid {pid}: {e}")
+
+def raise_open_file_limit():
+    # Lift our own soft descriptor limit to the hard one (a 1024 default is too few
+    # for servers holding thousands of sockets); returns the limit now in effect
+    if resource is None: return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+            soft = hard
+        except (OSError, ValueError):
+            pass
+    return soft
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+def sample_process(pid):
+    # Usage of a running game from /proc; None once it is gone (or off Linux)
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split() # comm may contain spaces
+        mem = {}
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    mem[line[:5]] = int(line.split()[1]) # kB
+        fds = os.listdir(f'/proc/{pid}/fd')
+        sockets = 0
+        for fd in fds:
+            try:
+                sockets += os.readlink(f'/proc/{pid}/fd/{fd}').startswith('socket:')
+            except OSError:
+                pass # Closed meanwhile
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0]) - int(fields[19]) / CLOCK_TICKS # starttime
+    except (OSError, ValueError, IndexError):
+        return None
+    return {
+        "cpu_seconds": round((int(fields[11]) + int(fields[12])) / CLOCK_TICKS, 2), # utime + stime
+        "rss_mb": round(mem.get('VmRSS', 0) / 1024, 1),
+        "peak_rss_mb": round(mem.get('VmHWM', 0) / 1024, 1),
+        "open_files": len(fds),
+        "sockets": sockets,
+        "uptime": round(uptime, 1)
+    }
+
+def scan_page(items, cursor=None, count=50, where=None):
+    # Page of (key, value) from a dict in key order, strictly after `cursor`.
+    # where: {field: value or [values]} equality filter applied before paging.
+    # One linear pass with a bounded heap; a deleted cursor key still resumes correctly.
+    where = where or {}
+    def matches(value):
+        for field, want in where.items():
+            have = value.get(field) if isinstance(value, dict) else None
+            if isinstance(want, list):
+                if have not in want: return False
+            elif have != want:
+                return False
+        return True
+
+    keys = (k for k in items if (cursor is None or k > cursor) and matches(items[k]))
+    page = heapq.nsmallest(count + 1, keys)
+    result = [(k, items[k]) for k in page[:count]]
+    next_cursor = page[count - 1] if len(page) > count else None
+    return result, next_cursor
+
 class DBClient:
+    """
+    Talks newline-delimited JSON over a small pool of persistent connections, so a
+    request costs one round trip instead of a connect, a round trip and a close.
+    """
+    POOL_SIZE = 16 # Idle connections kept; busier moments open extra ones
+
     def __init__(self, host='127.0.0.1', port=10195):
         self.addr = (host, port)
-        
+        self.pool = [] # [(sock, reader)]
+        self.pool_lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection(self.addr)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock, sock.makefile('rb')
+
+    def _pooled(self):
+        # An idle connection that the DB closed (e.g. a restart), skipped before
+        # anything is sent on it: an idle connection has nothing to read unless closed
+        while True:
+            with self.pool_lock:
+                if not self.pool: return None
+                conn = self.pool.pop()
+            try:
+                conn[0].recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return conn
+            except OSError:
+                pass
+            conn[0].close()
+
     def _req(self, payload):
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(self.addr)
-            sock.sendall(json.dumps(payload).encode())
-            resp = json.loads(sock.recv(16384).decode())
-            sock.close()
+        line = (json.dumps(payload) + '\n').encode()
+        for attempt in range(2):
+            conn = self._pooled()
+            reused = conn is not None
+            sent = False
+            try:
+                conn = conn or self._connect()
+                conn[0].sendall(line)
+                sent = True
+                reply = conn[1].readline()
+                if not reply: raise ConnectionResetError("DB closed the connection")
+                resp = json.loads(reply)
+            except Exception as e:
+                if conn: conn[0].close()
+                # An idle connection may have been closed by a DB restart. Retry on a
+                # fresh one only if the send failed: once it went out the DB may have
+                # applied it, and RPUSH / HINCRBY must not run twice
+                if reused and not sent and isinstance(e, OSError): continue
+                # print(f"DB Connect Error: {e}")
+                return {"status": "error", "message": str(e)}
+            with self.pool_lock:
+                if len(self.pool) < self.POOL_SIZE:
+                    self.pool.append(conn)
+                    conn = None
+            if conn: conn[0].close()
             return resp
-        except Exception as e:
-            # print(f"DB Connect Error: {e}")
-            return {"status": "error", "message": str(e)}
+        return {"status": "error", "message": "DB unavailable"}
 
     def get(self, collection, key=None):
         return self._req({"action": "GET", "collection": collection, "key": key}).get('data')
@@ -50,6 +317,383 @@ class DBClient:
         
     def delete(self, collection, key):
         return self._req({"action": "DELETE", "collection": collection, "key": key})
+
+    def count(self, collection):
+        return self._req({"action": "COUNT", "collection": collection}).get('count', 0)
+
+    def mset(self, collection, values):
+        # {key: value}, None deletes; True once stored
+        return self._req({"action": "MSET", "collection": collection, "values": values}).get('status') == 'ok'
         
+    def hget(self, collection, key, field):
+        return self._req({"action": "HGET", "collection": collection, "key": key, "field": field}).get('data')
+
+    def hset(self, collection, key, field, value):
+        return self._req({"action": "HSET", "collection": collection, "key": key, "field": field, "value": value})
+
+    def hsetnx(self, collection, key, field, value):
+        # Set only if the field is absent; resp['created'] tells which
+        return self._req({"action": "HSETNX", "collection": collection, "key": key, "field": field, "value": value})
+
+    def hdel(self, collection, key, field):
+        return self._req({"action": "HDEL", "collection": collection, "key": key, "field": field})
+
+    def hincrby(self, collection, key, increments):
+        # increments: {field: amount}; returns the counters after the update
+        return self._req({"action": "HINCRBY", "collection": collection, "key": key, "increments": increments}).get('data')
+
+    def rpush(self, collection, key, value):
+        return self._req({"action": "RPUSH", "collection": collection, "key": key, "value": value})
+
+    def lrange(self, collection, key, start, stop=None):
+        # Returns (items, total_length); slice semantics, negative start counts from the end
+        resp = self._req({"action": "LRANGE", "collection": collection, "key": key, "start": start, "stop": stop})
+        return resp.get('data') or [], resp.get('length', 0)
+
+    def scan(self, collection, cursor=None, count=50, where=None):
+        # Returns ([(key, value)], next_cursor); next_cursor is None on the last page
+        resp = self._req({"action": "SCAN", "collection": collection, "cursor": cursor, "count": count, "where": where})
+        return [tuple(kv) for kv in resp.get('data') or []], resp.get('next_cursor')
+
     def update_all(self, collection, data):
         return self._req({"action": "UPDATE_ALL", "collection": collection, "data": data})
+
+    def snapshot(self, path=None):
+        # Point-in-time backup of every collection, written by the DB server (path is
+        # on its machine); returns once it is on disk: {"status", "path", "seq", ...}
+        return self._req({"action": "SNAPSHOT", "path": path})
+
+    def lock(self, name, owner, ttl=10.0):
+        # Non-blocking; True if `owner` now holds the lease
+        return self._req({"action": "LOCK", "key": name, "owner": owner, "ttl": ttl}).get('acquired', False)
+
+    def unlock(self, name, owner):
+        return self._req({"action": "UNLOCK", "key": name, "owner": owner})
+
+    def publish(self, channel, message):
+        # Returns how many subscribers received it
+        return self._req({"action": "PUBLISH", "channel": channel, "message": message}).get('receivers', 0)
+
+    def subscribe(self, channels, handler):
+        # handler(channel, message) runs on the subscription's own thread
+        sub = Subscription(self.addr, channels, handler)
+        sub.start()
+        return sub
+
+    def watch(self, collection, handler, key=None, on_sync=None):
+        # Change records of a collection (or one key) in order, see Watch
+        w = Watch(self.addr, collection, handler, key, on_sync)
+        w.start()
+        return w
+
+class Subscription(threading.Thread):
+    """
+    Long-lived SUBSCRIBE connection to the DB server; reconnects on failure.
+    Messages published while it is reconnecting are lost.
+    """
+    def __init__(self, addr, channels, handler):
+        super().__init__(daemon=True)
+        self.addr = addr
+        self.channels = list(channels)
+        self.handler = handler
+
+    def run(self):
+        while True:
+            try:
+                sock = socket.create_connection(self.addr)
+                sock.sendall((json.dumps({"action": "SUBSCRIBE", "channels": self.channels}) + '\n').encode())
+                f = sock.makefile('r', encoding='utf-8')
+                f.readline() # Ack
+                for line in f:
+                    msg = json.loads(line)
+                    try:
+                        self.handler(msg['channel'], msg['message'])
+                    except Exception as e:
+                        print(f"[PubSub] Handler error on {msg.get('channel')}: {e}")
+            except (OSError, ValueError) as e:
+                print(f"[PubSub] Subscription lost ({e}), retrying")
+            time.sleep(1.0)
+
+class Watch(threading.Thread):
+    """
+    Long-lived WATCH connection to the DB server. handler(change) gets every change
+    record ({"seq", "c", "op", "k", "v", ...}) in order; after a drop it resumes from
+    the last seq it saw. on_sync(reset) runs after each (re)connect: reset=True means
+    records were missed (first connect included) and local state must be reloaded.
+    """
+    def __init__(self, addr, collection, handler, key=None, on_sync=None):
+        super().__init__(daemon=True)
+        self.addr = addr
+        self.collection = collection
+        self.key = key
+        self.handler = handler
+        self.on_sync = on_sync
+        self.seq = None # Last record seen
+
+    def run(self):
+        while True:
+            try:
+                sock = socket.create_connection(self.addr)
+                req = {"action": "WATCH", "collection": self.collection, "key": self.key, "since": self.seq}
+                sock.sendall((json.dumps(req) + '\n').encode())
+                f = sock.makefile('r', encoding='utf-8')
+                ack = json.loads(f.readline())
+                if ack.get('status') != 'ok': raise ValueError(ack.get('message'))
+                reset = self.seq is None or ack['reset']
+                if self.on_sync: self.on_sync(reset)
+                if reset: self.seq = ack['seq'] # Only once the reload worked
+                for line in f:
+                    change = json.loads(line)
+                    self.seq = change['seq']
+                    try:
+                        self.handler(change)
+                    except Exception as e:
+                        print(f"[Watch] Handler error on {self.collection}: {e}")
+            except (OSError, ValueError) as e:
+                print(f"[Watch] Watch on {self.collection} lost ({e}), retrying")
+            time.sleep(1.0)
+
+def apply_change(items, change):
+    # A WATCH change record applied to a plain {key: value} copy; returns the new copy
+    op, key, value = change['op'], change.get('k'), change.get('v')
+    if op == 'SET':
+        items[key] = value
+    elif op == 'DEL':
+        items.pop(key, None)
+    elif op == 'HSET':
+        items.setdefault(key, {}).update(value)
+    elif op == 'HDEL':
+        (items.get(key) or {}).pop(change['f'], None)
+    elif op == 'RPUSH':
+        values = items.setdefault(key, [])
+        if len(values) > change['i']: values[change['i']] = value
+        else: values.append(value)
+    elif op == 'MSET':
+        for k, v in value.items():
+            if v is None: items.pop(k, None)
+            else: items[k] = v
+    elif op == 'REPLACE':
+        items = value
+    return items
+
+class CollectionMirror:
+    """
+    In-memory copy of one DB collection, loaded once and then kept current from its
+    WATCH feed; reloaded only when the feed can't resume. Records hold resulting
+    values, so changes racing the load are simply applied again.
+    on_change(keys, change), keys None for all, runs on the watch thread.
+    """
+    def __init__(self, db, collection, on_change=None):
+        self.db = db
+        self.collection = collection
+        self.on_change = on_change
+        self.items = {}
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+
+    def start(self, timeout=5.0):
+        self.db.watch(self.collection, self._apply, on_sync=self._sync)
+        self.ready.wait(timeout)
+        return self
+
+    def _sync(self, reset):
+        if not reset: return
+        items = self.db.get(self.collection)
+        if items is None: raise ValueError("DB unavailable") # The watch retries
+        with self.lock:
+            self.items = items
+        self.ready.set()
+        if self.on_change: self.on_change(None, None)
+
+    def _apply(self, change):
+        with self.lock:
+            self.items = apply_change(self.items, change)
+        if self.on_change:
+            keys = set(change['v']) if change['op'] == 'MSET' else None if change['op'] == 'REPLACE' else {change['k']}
+            self.on_change(keys, change)
+
+    def get(self, key):
+        # A private copy
+        with self.lock:
+            return copy.deepcopy(self.items.get(key))
+
+    def peek(self, key):
+        # The shared record, no copy: treat as read-only
+        with self.lock:
+            return self.items.get(key)
+
+    def all(self):
+        with self.lock:
+            return copy.deepcopy(self.items)
+
+class SharedLock:
+    """
+    Re-entrant lock that, with shared=True, also holds a named lease in the DB server
+    so processes sharing that DB serialize on it. With shared=False it's a plain RLock.
+    The lease is renewed (LeaseKeeper) for as long as it is held, so slow work under
+    the lock doesn't let it expire into another process's hands.
+    """
+    def __init__(self, db, name, owner=None, shared=False, ttl=10.0):
+        self.db = db
+        self.name = name
+        self.owner = owner
+        self.shared = shared
+        self.ttl = ttl
+        self.local = threading.RLock()
+        self.depth = 0 # Only touched while holding self.local
+        self.lease_lock = threading.Lock() # Orders renewals against the unlock
+        self.leased = False
+        self.renewed = 0.0
+
+    def acquire(self):
+        self.local.acquire()
+        if self.depth == 0 and self.shared:
+            delay = 0.001
+            while not self.db.lock(self.name, self.owner, self.ttl):
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+            with self.lease_lock:
+                self.leased, self.renewed = True, time.time()
+            lease_keeper.add(self)
+        self.depth += 1
+
+    def release(self):
+        self.depth -= 1
+        if self.depth == 0 and self.shared:
+            lease_keeper.discard(self)
+            with self.lease_lock:
+                self.leased = False
+                self.db.unlock(self.name, self.owner)
+        self.local.release()
+
+    def renew(self):
+        # Pushes the lease's expiry out again; a no-op once released
+        with self.lease_lock:
+            if not self.leased: return
+            if not self.db.lock(self.name, self.owner, self.ttl):
+                print(f"[Lock] Could not renew lease {self.name}")
+            self.renewed = time.time()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class LeaseKeeper:
+    """Background renewal of the leases of held SharedLocks, each after a third of its TTL."""
+    TICK = 0.5
+
+    def __init__(self):
+        self.held = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def add(self, shared_lock):
+        with self.lock:
+            self.held.add(shared_lock)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def discard(self, shared_lock):
+        with self.lock:
+            self.held.discard(shared_lock)
+
+    def run(self):
+        while True:
+            time.sleep(self.TICK)
+            with self.lock:
+                held = list(self.held)
+            now = time.time()
+            for shared_lock in held:
+                if now - shared_lock.renewed >= shared_lock.ttl / 3:
+                    shared_lock.renew()
+
+lease_keeper = LeaseKeeper()
+
+class LockStripes:
+    """
+    Fixed set of SharedLocks ("<name>.<i>") that keys hash onto, so holders of
+    unrelated keys rarely wait on each other. hold() takes every stripe its keys
+    map to in ascending stripe order, so two multi-key holders can't deadlock.
+    """
+    def __init__(self, db, name, count, ttl=10.0):
+        self.stripes = [SharedLock(db, f"{name}.{i}", ttl=ttl) for i in range(count)]
+
+    def configure(self, owner, shared):
+        for stripe in self.stripes:
+            stripe.owner = owner
+            stripe.shared = shared
+
+    def index(self, key):
+        return zlib.crc32(str(key).encode()) % len(self.stripes) # Same on every worker
+
+    @contextlib.contextmanager
+    def hold(self, *keys):
+        held = []
+        try:
+            for i in sorted({self.index(k) for k in keys}):
+                self.stripes[i].acquire()
+                held.append(self.stripes[i])
+            yield
+        finally:
+            for stripe in reversed(held):
+                stripe.release()
+
+class TimerWheel:
+    """
+    Hashed timer wheel: `slots` buckets of `tick` seconds each.
+    schedule()/cancel() are O(1) and advance() only visits the buckets whose time
+    has come, so a sweep costs O(timers in those buckets), not O(all timers).
+    Delays longer than one revolution carry a rounds counter.
+    """
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = slots
+        self.buckets = [{} for _ in range(slots)] # [{key: rounds_left}]
+        self.where = {} # {key: slot}
+        self.cursor = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def schedule(self, key, delay):
+        # (Re)arms the timer for key; the previous deadline is dropped
+        ticks = max(1, int(-(-delay // self.tick))) # ceil
+        with self.lock:
+            self._cancel(key)
+            slot = (self.cursor + ticks) % self.slots
+            self.buckets[slot][key] = (ticks - 1) // self.slots
+            self.where[key] = slot
+
+    def cancel(self, key):
+        with self.lock:
+            self._cancel(key)
+
+    def _cancel(self, key):
+        slot = self.where.pop(key, None)
+        if slot is not None:
+            self.buckets[slot].pop(key, None)
+
+    def advance(self, now=None):
+        # Moves the wheel up to `now` and returns the keys that expired
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            steps = int((now - self.last) / self.tick)
+            self.last += steps * self.tick
+            for _ in range(steps):
+                self.cursor = (self.cursor + 1) % self.slots
+                bucket = self.buckets[self.cursor]
+                for key, rounds in list(bucket.items()):
+                    if rounds == 0:
+                        del bucket[key]
+                        del self.where[key]
+                        expired.append(key)
+                    else:
+                        bucket[key] = rounds - 1
+        return expired
+
+    def __len__(self):
+        return len(self.where)
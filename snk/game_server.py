@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import argparse
 import json
+import os
 import random
 import socket
 import threading
@@ -15,15 +16,17 @@ TICK_HZ = 10
 
 LOBBY_HOST = "127.0.0.1"
 LOBBY_PORT = 10192
+HEARTBEAT_INTERVAL = 2.0
 
 Vec = Tuple[int, int]
 DIRS: Dict[str, Vec] = {"UP": (0, -1), "DOWN": (0, 1), "LEFT": (-1, 0), "RIGHT": (1, 0)}
 OPPOSITE = {"UP": "DOWN", "DOWN": "UP", "LEFT": "RIGHT", "RIGHT": "LEFT"}
 
 
-def send_json_line(conn: socket.socket, obj: dict) -> None:
+def send_json_line(conn: socket.socket, obj: dict) -> int:
     data = (json.dumps(obj, separators=(",", ":")) + "\n").encode("utf-8")
     conn.sendall(data)
+    return len(data)
 
 
 def recv_json_lines(conn: socket.socket):
@@ -44,6 +47,78 @@ def recv_json_lines(conn: socket.socket):
                 continue
 
 
+class LobbyChannel:
+    """
+    Persistent control connection to the lobby: game_ready, heartbeats, game_result.
+    The lobby passes its address and our token in GAMESTORE_CONTROL(_TOKEN);
+    without them we fall back to the one-shot report on --lobby_port.
+    `stats` (ticks, messages, bytes) rides along on heartbeats and the result
+    for the lobby's per-game accounting.
+    """
+
+    def __init__(self, room_id: str, lobby_port: int):
+        self.room_id = room_id
+        self.lobby_port = lobby_port
+        self.addr = os.environ.get("GAMESTORE_CONTROL")
+        self.token = os.environ.get("GAMESTORE_CONTROL_TOKEN", "")
+        self.sock: Optional[socket.socket] = None
+        self.lock = threading.Lock()
+        self.stats: Dict[str, int] = {"ticks": 0, "messages": 0, "bytes": 0}
+
+    def connect(self) -> None:
+        if not self.addr:
+            return
+        host, port = self.addr.rsplit(":", 1)
+        try:
+            self.sock = socket.create_connection((host, int(port)), timeout=2.0)
+            self._send({"action": "game_ready", "room_id": self.room_id, "token": self.token})
+        except OSError as e:
+            print(f"[SERVER] WARNING: no lobby control channel: {e}")
+            self.sock = None
+            return
+        threading.Thread(target=self._heartbeat, daemon=True).start()
+
+    def _send(self, obj: dict) -> None:
+        with self.lock:
+            if self.sock is None:
+                raise OSError("control channel closed")
+            send_json_line(self.sock, obj)
+
+    def _heartbeat(self) -> None:
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                self._send({"action": "heartbeat", "stats": dict(self.stats)})
+            except OSError:
+                return
+
+    def report(self, payload: dict) -> None:
+        payload = dict(payload, stats=dict(self.stats))
+        if self.sock is not None:
+            try:
+                self._send(payload)
+                sent = True
+            except OSError as e:
+                print(f"[SERVER] WARNING: control channel failed ({e}), using legacy report")
+                sent = False
+            try:
+                if sent:
+                    self.sock.recv(4096)  # ack: the lobby has the result
+            except OSError:
+                pass
+            finally:
+                with self.lock:
+                    self.sock.close()
+                    self.sock = None
+            if sent:
+                return
+        sock = socket.create_connection((LOBBY_HOST, self.lobby_port), timeout=2.0)
+        if self.token:
+            payload = dict(payload, token=self.token)  # lets the lobby tell our report from a forged one
+        sock.sendall(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+        sock.close()
+
+
 @dataclass
 class Player:
     pid: int
@@ -75,6 +150,7 @@ class SnakeDuelServer:
         self.food: Vec = (0, 0)
 
         self.reported = False  # ensure report once
+        self.lobby = LobbyChannel(room_id, lobby_port)
 
     def start(self):
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -82,6 +158,7 @@ class SnakeDuelServer:
         self.server_sock.bind((self.host, self.port))
         self.server_sock.listen(5)
         print(f"[SERVER] listening on {self.host}:{self.port} room_id={self.room_id}")
+        self.lobby.connect()
 
         threading.Thread(target=self._accept_loop, daemon=True).start()
         self._game_loop()
@@ -143,6 +220,7 @@ class SnakeDuelServer:
 
         try:
             for msg in recv_json_lines(p.conn):
+                self.lobby.stats["messages"] += 1
                 t = msg.get("type")
                 if t == "hello":
                     name = str(msg.get("username", msg.get("name", f"P{pid}")))[:24]
@@ -166,7 +244,8 @@ class SnakeDuelServer:
             items = list(self.players.items())
         for pid, p in items:
             try:
-                send_json_line(p.conn, obj)
+                self.lobby.stats["bytes"] += send_json_line(p.conn, obj)
+                self.lobby.stats["messages"] += 1
             except OSError:
                 dead.append(pid)
         for pid in dead:
@@ -327,11 +406,7 @@ class SnakeDuelServer:
         }
 
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(2.0)
-            sock.connect((LOBBY_HOST, self.lobby_port))
-            sock.sendall(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
-            sock.close()
+            self.lobby.report(payload)
             print(f"[SERVER] reported to lobby: {payload}")
         except OSError as e:
             print(f"[SERVER] WARNING: failed to report to lobby: {e} payload={payload}")
@@ -384,6 +459,7 @@ class SnakeDuelServer:
 
             while acc >= step_dt and self.running:
                 self.tick += 1
+                self.lobby.stats["ticks"] = self.tick
                 self._step()
 
                 self._broadcast(self._state_payload())